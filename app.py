@@ -3,6 +3,7 @@ import os
 import uuid
 import sys
 from flask import Flask, request, jsonify, render_template, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import re
 import tempfile
 import json
@@ -15,10 +16,36 @@ import warnings # Added for API key warning
 import re
 import tempfile
 import base64
+import shutil
+import sqlite3
+import threading
+import time
+import atexit
+import signal
+import zlib
+import weakref
+import functools
+import gzip
+import hashlib
+import unicodedata
+import math
+import operator
+from array import array
+from collections import OrderedDict, Counter, deque
+from collections.abc import MutableMapping
 import networkx as nx
 import matplotlib.pyplot as plt
+import numpy as np
 from io import BytesIO
 import mimetypes
+import asyncio
+import queue
+import bisect
+import random
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 添加对PyInstaller打包的支持
 def resource_path(relative_path):
@@ -48,6 +75,7 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 OPENROUTER_API_BASE = "https://openrouter.ai/api/v1" # OpenRouter Base URL
 OPENROUTER_API_KEY = None # Will be set via API endpoint
 CUSTOM_API_CONFIGS = {}  # Will store custom API configurations in memory
+ROUTE_GROUPS = {}  # 模型路由组：组ID -> {"id", "name", "members", "hedge"}
 
 # 确定是否在打包环境中运行
 if getattr(sys, 'frozen', False):
@@ -63,13 +91,19 @@ else:
     MODEL_DIR = os.path.join(os.path.dirname(__file__), 'model') # 新增：模型模板文件夹
 
 # 数据文件路径
-NOVELS_FILE = os.path.join(DATA_DIR, 'novels.json')
+NOVELS_FILE = os.path.join(DATA_DIR, 'novels.json')  # 旧版单文件存储，启动时自动迁移到 NOVELS_DIR
+NOVELS_DIR = os.path.join(DATA_DIR, 'novels')  # 每部小说一个子目录：novel.json + content.txt + chapters/<章节ID>.txt
 CHARACTERS_FILE = os.path.join(DATA_DIR, 'characters.json')
 GLOSSARY_FILE = os.path.join(DATA_DIR, 'glossary.json')
 STYLES_FILE = os.path.join(DATA_DIR, 'styles.json')
 GAMES_FILE = os.path.join(DATA_DIR, 'games.json')
 API_CONFIGS_FILE = os.path.join(DATA_DIR, 'api_configs.json')  # 自定义API配置文件
 API_KEY_FILE = os.path.join(DATA_DIR, 'api_key.json')  # OpenRouter API密钥文件
+ROUTES_FILE = os.path.join(DATA_DIR, 'routes.json')  # 模型路由组配置文件
+SQLITE_FILE = os.path.join(DATA_DIR, 'bmxh.db')  # SQLite 存储后端的数据库文件
+
+# 存储后端：json（默认，data/ 下的 JSON 文件）或 sqlite（WAL 模式的 SQLITE_FILE），启动时通过环境变量选择
+STORAGE_BACKEND = os.environ.get('BMXH_STORAGE', 'json').strip().lower()
 
 # Simple in-memory storage for novels (replace with a database for persistence)
 novels_db = {}
@@ -81,6 +115,20 @@ glossary_db = {}
 styles_db = {}
 # Simple in-memory storage for games
 games_db = {}
+# 当前使用的存储后端（JsonStorage 或 SqliteStorage），由 load_data() 创建
+storage = None
+# API 配置与密钥始终以 JSON 文件保存；JSON 后端下与 storage 是同一个对象
+settings_storage = None
+# 章节历史版本（ChapterHistory），由 load_data() 创建
+chapter_history = None
+# 全文检索索引（SearchIndex），由 load_data() 创建
+search_index = None
+# 段落向量索引（VectorIndex），由 load_data() 创建
+vector_index = None
+# 角色名与词条名的匹配器（EntityMatcher），由 load_data() 创建
+entity_matcher = None
+# ETag 的数据版本前缀，每次 load_data() 重新生成，重新加载数据后旧的 ETag 全部失效
+etag_epoch = uuid.uuid4().hex
 
 # Ensure export and data directories exist
 if not os.path.exists(EXPORT_DIR):
@@ -90,13 +138,1213 @@ if not os.path.exists(DATA_DIR):
 if not os.path.exists(MODEL_DIR): # 新增：确保模型文件夹存在
     os.makedirs(MODEL_DIR)
 
+# --- JSON 编解码 ---
+
+# 安装了 orjson 时用它序列化与解析（比标准库 json 快数倍），否则回退到标准库；
+# BMXH_JSON_CODEC=json 可强制使用标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+if os.environ.get('BMXH_JSON_CODEC', '').strip().lower() == 'json':
+    orjson = None
+JSON_CODEC = "orjson" if orjson is not None else "json"
+# 快照文件（novel.json、characters.json 等）默认缩进两格便于阅读；BMXH_JSON_COMPACT=1 时写成紧凑格式
+JSON_COMPACT = os.environ.get('BMXH_JSON_COMPACT', '0') == '1'
+
+def json_dumps(obj, indent=False):
+    """序列化为字符串，保留非 ASCII 字符；indent 为 True 时缩进两格，否则为紧凑格式"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+        except TypeError:
+            pass  # orjson 不支持的数据（非字符串键、超出 64 位的整数等）交给标准库
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+def json_loads(text):
+    """解析 JSON 字符串或字节串，出错时抛出 ValueError（json.JSONDecodeError）"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def json_file_text(obj):
+    """快照文件的内容：按 JSON_COMPACT 决定是否缩进"""
+    return json_dumps(obj, indent=not JSON_COMPACT)
+
+def read_json_file(file_path):
+    with open(file_path, 'rb') as f:
+        return json_loads(f.read())
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """让 jsonify 与 request.get_json 也使用上面的编解码"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and set(kwargs) <= {"indent", "separators"}:
+            option = orjson.OPT_PASSTHROUGH_DATETIME  # 日期仍由 Flask 的 default 处理，保持原有格式
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            try:
+                return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+app.json = CodecJSONProvider(app)
+
+# --- 并发控制 ---
+
+# Flask 以多线程处理请求：同一部小说（含其章节）的读写在该小说的锁内依次执行，
+# 人物/词条/风格/游戏库与设置各有一把库锁；后台写入序列化数据时持有同一把锁。
+# 每部小说和每个章节的 revision 在每次修改时递增，写请求可带 base_revision（请求体或查询参数），
+# 与当前值不一致时返回 409，而不是静默覆盖别处的修改
+LOCKS_GUARD = threading.Lock()
+NOVEL_LOCKS = {}  # 小说ID -> RLock
+STORE_LOCKS = {}  # 库名 -> RLock
+# 后台写入等待小说/库锁的最长时间（秒）：超时说明请求线程正持有该锁，本次跳过、留待下次写入。
+# 同步写入模式（BMXH_SAVE_DELAY=0）下不等待：持锁的请求线程随后会自己写入，互相等待会死锁
+SAVE_LOCK_TIMEOUT = 1.0
+
+def named_lock(registry, name):
+    with LOCKS_GUARD:
+        lock = registry.get(name)
+        if lock is None:
+            lock = registry[name] = threading.RLock()
+        return lock
+
+def novel_lock(novel_id):
+    return named_lock(NOVEL_LOCKS, novel_id)
+
+def store_lock(store):
+    return named_lock(STORE_LOCKS, store)
+
+def with_novel_lock(view):
+    """路由装饰器：持有 URL 中 novel_id 对应小说的锁执行"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with novel_lock(kwargs["novel_id"]):
+            return view(*args, **kwargs)
+    return wrapper
+
+def with_store_lock(store):
+    """路由装饰器：持有库锁执行"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with store_lock(store):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def bump_revision(target):
+    target["revision"] = target.get("revision", 0) + 1
+    return target["revision"]
+
+def revision_conflict(target, data=None):
+    """写请求带 base_revision 且与 target 当前的 revision 不一致时返回 409 响应，不是整数时返回 400，否则返回 None；
+    未带 base_revision 的请求保持原来的“后写覆盖”行为"""
+    base_revision = data.get("base_revision") if isinstance(data, dict) else None
+    if base_revision is None:
+        base_revision = request.args.get("base_revision")
+        if base_revision is not None:
+            try:
+                base_revision = int(base_revision)
+            except ValueError:
+                base_revision = ""  # 下面按不是整数处理
+    if base_revision is not None and type(base_revision) is not int:
+        return jsonify({"error": "base_revision 必须是整数"}), 400
+    revision = target.get("revision", 0)
+    if base_revision is None or base_revision == revision:
+        return None
+    return jsonify({"error": "内容已被修改，请重新获取后再提交", "revision": revision}), 409
+
+# --- 存储后端 ---
+
+# 人物/词条/风格/游戏库的名称与 JSON 文件名
+LIBRARY_STORES = {
+    "characters": "characters.json",
+    "glossary": "glossary.json",
+    "styles": "styles.json",
+    "games": "games.json",
+}
+# 与存储后端无关、始终以 JSON 文件保存的设置
+SETTINGS_STORES = {
+    "api_configs": "api_configs.json",
+    "api_key": "api_key.json",
+    "routes": "routes.json",
+}
+
+# 日志超过这个大小（字节）或距上次压缩超过这个时间（秒）时，压缩为快照并清空日志
+JOURNAL_COMPACT_BYTES = int(os.environ.get('BMXH_JOURNAL_COMPACT_BYTES', str(8 * 1024 * 1024)))
+JOURNAL_COMPACT_INTERVAL = float(os.environ.get('BMXH_JOURNAL_COMPACT_INTERVAL', '600'))
+
+def fsync_directory(directory):
+    """确保目录项（新建/替换的文件名）落盘；Windows 不支持对目录 fsync"""
+    if os.name == 'nt':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file_atomic(file_path, text):
+    """通过临时文件 + fsync + os.replace 原子性地写入文本文件"""
+    directory = os.path.dirname(file_path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=False, dir=directory) as tmp_file:
+        tmp_file.write(text)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    try:
+        os.replace(tmp_file.name, file_path)
+    except Exception:
+        # 如果发生错误，尝试清理临时文件
+        if os.path.exists(tmp_file.name):
+            os.remove(tmp_file.name)
+        raise
+    fsync_directory(directory)
+
+def read_text_file(file_path):
+    """读取文本文件，不存在时返回空字符串"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+def novel_meta(novel):
+    """小说的元数据部分（不含正文和章节正文）"""
+    meta = {key: val for key, val in novel.items() if key not in ("content", "chapters")}
+    meta["chapters"] = [{key: val for key, val in chapter.items() if key != "content"}
+                        for chapter in novel.get("chapters", [])]
+    return meta
+
+class Journal:
+    """追加写的操作日志，每行一条 "crc32<TAB>JSON" 记录。
+    一批记录追加完后调用 sync() 只 fsync 一次（组提交）；崩溃时写了一半的末尾记录在重放时丢弃。"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.unsynced = False
+        self.checked = False  # records() 已检查过文件末尾
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.started_at = time.monotonic() if self.size else None
+
+    def append(self, record):
+        if self.file is None:
+            if not self.checked:
+                self.records()  # 截断崩溃时留下的残行，新记录不能接在它后面
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        line = json_dumps(record)
+        entry = f"{zlib.crc32(line.encode('utf-8')):08x}\t{line}\n"
+        self.file.write(entry)
+        self.size += len(entry.encode('utf-8'))
+        self.unsynced = True
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+    def sync(self):
+        if self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+
+    def records(self):
+        """读取所有完整的记录；遇到校验失败（崩溃时未写完）的记录即停止，并把文件截断到最后一条完整记录之后，
+        否则之后追加的记录会接在残行后面、重放时随残行一起被丢弃"""
+        records = []
+        self.checked = True
+        if not os.path.exists(self.path):
+            return records
+        if self.file is not None:
+            self.sync()
+        valid = 0  # 完整记录的字节数
+        with open(self.path, 'r+b') as f:
+            for line_number, line in enumerate(f, 1):
+                checksum, _, payload = line.rstrip(b'\n').partition(b'\t')
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("missing newline")
+                    if int(checksum, 16) != zlib.crc32(payload):
+                        raise ValueError("checksum mismatch")
+                    records.append(json_loads(payload))
+                except ValueError as e:
+                    logging.warning(f"日志 {self.path} 第 {line_number} 行记录不完整，已截断其后的内容: {e}")
+                    break
+                valid += len(line)
+            if valid < f.seek(0, os.SEEK_END):
+                f.truncate(valid)
+                f.flush()
+                os.fsync(f.fileno())
+        self.size = valid
+        if not valid:
+            self.started_at = None
+        return records
+
+    def needs_compaction(self):
+        return self.size > 0 and (self.size >= JOURNAL_COMPACT_BYTES or
+                                  time.monotonic() - self.started_at >= JOURNAL_COMPACT_INTERVAL)
+
+    def truncate(self):
+        """快照写入后清空日志"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.size or os.path.exists(self.path):
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+        self.size = 0
+        self.unsynced = False
+        self.started_at = None
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+class JsonStorage:
+    """JSON 文件存储：小说按分片目录保存，人物/词条/风格/游戏库各一个 JSON 文件。
+    journaled 为 True 时，修改先以操作日志追加到 journal/<库名>.log，定期再压缩为上述快照文件；
+    为 False 时直接写快照（用作 SQLite 后端的导入/导出格式）。"""
+    name = "json"
+
+    def __init__(self, data_dir, journaled=False):
+        self.data_dir = data_dir
+        self.novels_dir = os.path.join(data_dir, 'novels')
+        self.legacy_novels_file = os.path.join(data_dir, 'novels.json')
+        self.journaled = journaled
+        self.journals = {}
+        self.lock = threading.RLock()
+        # 已写入日志、尚未压缩到分片文件的小说文件：相对路径 -> 日志记录（按写入顺序）
+        self.novel_overlay = {}
+        # 各库当前的完整数据（内存中的字典），压缩时写为快照
+        self.library_entries = {}
+        # 最近一次写入的 novel.json 校验值，元数据未变化时不再重复写入
+        self.meta_checksums = {}
+
+    def novel_dir(self, novel_id):
+        """返回单部小说的分片目录"""
+        return os.path.join(self.novels_dir, novel_id)
+
+    def library_file(self, store):
+        return os.path.join(self.data_dir, LIBRARY_STORES.get(store) or SETTINGS_STORES[store])
+
+    def journal(self, store):
+        if store not in self.journals:
+            self.journals[store] = Journal(os.path.join(self.data_dir, 'journal', f"{store}.log"))
+        return self.journals[store]
+
+    # 小说分片
+
+    def read_novel_file(self, relative_path):
+        """读取分片目录中的文件，优先使用尚未压缩的日志内容"""
+        with self.lock:
+            record = self.novel_overlay.get(relative_path)
+        if record is not None:
+            return record.get("value", "") if record["op"] == "write" else ""
+        return read_text_file(os.path.join(self.novels_dir, relative_path))
+
+    def load_novel(self, novel_id, chapter_bodies=True):
+        """从分片目录读取一部小说；chapter_bodies 为 False 时不读章节正文（由 load_chapter 按需读取）"""
+        meta_text = self.read_novel_file(f"{novel_id}/novel.json")
+        if not meta_text:
+            raise FileNotFoundError(f"{novel_id}/novel.json")
+        novel = json_loads(meta_text)
+        novel["content"] = self.read_novel_file(f"{novel_id}/content.txt")
+        if chapter_bodies:
+            for chapter in novel.get("chapters", []):
+                chapter["content"] = self.load_chapter(novel_id, chapter["id"])
+        return novel
+
+    def load_chapter(self, novel_id, chapter_id):
+        """读取单个章节的正文"""
+        return self.read_novel_file(f"{novel_id}/chapters/{chapter_id}.txt")
+
+    def load_manifest(self):
+        """只读取每部小说的 novel.json（标题与章节元数据），不读正文；
+        先重放并压缩未完成的日志，旧版单文件 novels.json 会自动迁移"""
+        os.makedirs(self.novels_dir, exist_ok=True)
+        if self.journaled:
+            self.replay_novel_journal()
+        if os.path.exists(self.legacy_novels_file):
+            self.migrate_legacy_novels()
+        manifest = {}
+        for novel_id in sorted(os.listdir(self.novels_dir)):
+            meta_text = self.read_novel_file(f"{novel_id}/novel.json")
+            if not meta_text:
+                continue
+            try:
+                manifest[novel_id] = json_loads(meta_text)
+            except Exception as e:
+                logging.error(f"加载小说分片出错 {novel_id}: {e}")
+        return manifest
+
+    def load_novels(self):
+        """读取所有小说分片（含正文）"""
+        novels = {}
+        for novel_id in self.load_manifest():
+            try:
+                novels[novel_id] = self.load_novel(novel_id)
+            except Exception as e:
+                logging.error(f"加载小说分片出错 {novel_id}: {e}")
+        return novels
+
+    def migrate_legacy_novels(self):
+        """把旧版单文件 novels.json 拆分为分片目录，成功后将原文件重命名为 novels.json.migrated"""
+        logging.info(f"检测到旧版小说数据文件，开始迁移到分片存储: {self.legacy_novels_file}")
+        try:
+            legacy_novels = read_json_file(self.legacy_novels_file)
+        except Exception as e:
+            logging.error(f"读取旧版小说数据出错，跳过迁移: {e}")
+            return False
+        for novel_id, novel in legacy_novels.items():
+            # 已存在的分片比旧文件更新，不覆盖
+            if os.path.exists(os.path.join(self.novel_dir(novel_id), 'novel.json')):
+                continue
+            if not self.save_novel(novel_id, novel, content=True, chapters=None):
+                logging.error("小说分片迁移未完成，保留旧版数据文件。")
+                return False
+        if self.journaled:
+            self.commit()
+            self.compact("novels")
+        os.replace(self.legacy_novels_file, self.legacy_novels_file + '.migrated')
+        logging.info(f"成功迁移了 {len(legacy_novels)} 部小说到 {self.novels_dir}")
+        return True
+
+    def novel_records(self, novel_id, novel, content=False, chapters=()):
+        """生成保存一部小说所需的文件操作记录（删除小说时为删除整个目录）"""
+        if novel is None:
+            self.meta_checksums.pop(novel_id, None)
+            return [{"op": "rmtree", "path": novel_id}]
+        records = []
+        if content:
+            records.append({"op": "write", "path": f"{novel_id}/content.txt", "value": novel.get("content", "")})
+        chapter_map = {chapter["id"]: chapter for chapter in novel.get("chapters", [])}
+        for chapter_id in (chapter_map if chapters is None else chapters):
+            chapter_path = f"{novel_id}/chapters/{chapter_id}.txt"
+            if chapter_id not in chapter_map:
+                records.append({"op": "delete", "path": chapter_path})
+                continue
+            # 不在内存中的章节正文没有修改，无需重写
+            chapter_content = chapter_map[chapter_id].get("content")
+            if chapter_content is not None:
+                records.append({"op": "write", "path": chapter_path, "value": chapter_content})
+        # novel.json 最后写入，保证其中列出的章节文件都已落盘
+        meta_text = json_file_text(novel_meta(novel))
+        checksum = zlib.crc32(meta_text.encode('utf-8'))
+        if self.meta_checksums.get(novel_id) != checksum:
+            records.append({"op": "write", "path": f"{novel_id}/novel.json", "value": meta_text})
+            self.meta_checksums[novel_id] = checksum
+        return records
+
+    def apply_novel_record(self, record):
+        """把一条文件操作记录应用到分片目录"""
+        file_path = os.path.join(self.novels_dir, record["path"])
+        if record["op"] == "write":
+            write_file_atomic(file_path, record["value"])
+        elif record["op"] == "delete":
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        elif record["op"] == "rmtree":
+            shutil.rmtree(file_path, ignore_errors=True)
+
+    def overlay_novel_record(self, record):
+        if record["op"] == "rmtree":
+            prefix = record["path"] + "/"
+            for path in [path for path in self.novel_overlay if path.startswith(prefix)]:
+                del self.novel_overlay[path]
+        # 重新插入到末尾，保持操作顺序
+        self.novel_overlay.pop(record["path"], None)
+        self.novel_overlay[record["path"]] = record
+
+    def save_novel(self, novel_id, novel, content=False, chapters=()):
+        """保存单部小说，novel 为 None 时删除整个分片目录。
+        novel.json 总是重写；content 为 True 时重写正文；chapters 为需要重写正文的
+        章节ID（None 表示全部），已不存在的章节会删除其文件"""
+        try:
+            records = self.novel_records(novel_id, novel, content=content, chapters=chapters)
+            with self.lock:
+                for record in records:
+                    if self.journaled:
+                        self.journal("novels").append(record)
+                        self.overlay_novel_record(record)
+                    else:
+                        self.apply_novel_record(record)
+            return True
+        except Exception as e:
+            logging.error(f"保存小说分片出错 {novel_id}: {e}")
+            return False
+
+    def replay_novel_journal(self):
+        with self.lock:
+            records = self.journal("novels").records()
+            if not records:
+                return
+            logging.info(f"重放小说日志: {len(records)} 条记录")
+            for record in records:
+                self.overlay_novel_record(record)
+            self.compact("novels")
+
+    # 章节历史版本：每个章节一个追加写入的 history/<小说ID>/<章节ID>.log，每行一条记录
+
+    def history_file(self, novel_id, chapter_id):
+        return os.path.join(self.data_dir, 'history', novel_id, f"{chapter_id}.log")
+
+    @staticmethod
+    def history_line(record):
+        return json_dumps(dict(record, data=base64.b64encode(record["data"]).decode('ascii'))) + "\n"
+
+    def load_history(self, novel_id, chapter_id):
+        """按写入顺序读取章节的历史记录，跳过写入中断留下的残行"""
+        records = []
+        try:
+            with open(self.history_file(novel_id, chapter_id), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json_loads(line)
+                        record["data"] = base64.b64decode(record["data"])
+                    except Exception:
+                        continue
+                    records.append(record)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def append_history(self, novel_id, chapter_id, record):
+        file_path = self.history_file(novel_id, chapter_id)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'a+b') as f:
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # 上一行写入中断，另起一行
+            f.write(self.history_line(record).encode('utf-8'))
+
+    def replace_history(self, novel_id, chapter_id, records):
+        write_file_atomic(self.history_file(novel_id, chapter_id),
+                          "".join(self.history_line(record) for record in records))
+
+    def delete_history(self, novel_id, chapter_id=None):
+        """删除章节的历史；chapter_id 为 None 时删除整部小说的历史"""
+        if chapter_id is None:
+            shutil.rmtree(os.path.join(self.data_dir, 'history', novel_id), ignore_errors=True)
+        elif os.path.exists(self.history_file(novel_id, chapter_id)):
+            os.remove(self.history_file(novel_id, chapter_id))
+
+    # 人物/词条/风格/游戏库与设置
+
+    def load_library(self, store):
+        """读取快照文件，再重放日志中尚未压缩的修改"""
+        with self.lock:
+            file_path = self.library_file(store)
+            entries = {}
+            if os.path.exists(file_path):
+                entries = read_json_file(file_path)
+            if self.journaled:
+                records = self.journal(store).records()
+                for record in records:
+                    if record["op"] == "put":
+                        entries[record["key"]] = record["value"]
+                    elif record["op"] == "del":
+                        entries.pop(record["key"], None)
+                self.library_entries[store] = entries
+                if records:
+                    logging.info(f"重放{store}日志: {len(records)} 条记录")
+                    self.compact(store)
+            return entries
+
+    def save_library(self, store, entries, keys=None):
+        """keys 为 None 时直接写入整个快照，否则把这些条目的修改追加到日志"""
+        with self.lock:
+            self.library_entries[store] = entries
+            if not self.journaled or keys is None:
+                write_file_atomic(self.library_file(store), json_file_text(entries))
+                if self.journaled:
+                    self.journal(store).truncate()
+                return
+            for key in keys:
+                if key in entries:
+                    self.journal(store).append({"op": "put", "key": key, "value": entries[key]})
+                else:
+                    self.journal(store).append({"op": "del", "key": key})
+
+    # 组提交与压缩
+
+    def commit(self):
+        """把本批追加的日志记录 fsync 落盘（每个日志一次），并压缩过大或过旧的日志"""
+        if not self.journaled:
+            return
+        with self.lock:
+            for journal in self.journals.values():
+                journal.sync()
+            for store, journal in list(self.journals.items()):
+                if journal.needs_compaction():
+                    self.compact(store)
+
+    def compact(self, store):
+        """把日志中的修改写入快照文件，然后清空日志"""
+        with self.lock:
+            journal = self.journal(store)
+            if journal.size == 0 and not (store == "novels" and self.novel_overlay):
+                return
+            if store == "novels":
+                for record in self.novel_overlay.values():
+                    self.apply_novel_record(record)
+                self.novel_overlay.clear()
+            elif store in self.library_entries:
+                # 快照序列化的是内存中的库，需持有库锁；库正被修改时下次再压缩
+                lock = store_lock(store)
+                if not lock.acquire(blocking=False):
+                    return
+                try:
+                    write_file_atomic(self.library_file(store), json_file_text(self.library_entries[store]))
+                finally:
+                    lock.release()
+            else:
+                return
+            journal.truncate()
+            logging.info(f"日志已压缩为快照: {store}")
+
+    def close(self):
+        if not self.journaled:
+            return
+        with self.lock:
+            self.commit()
+            for store in list(self.journals):
+                self.compact(store)
+            for journal in self.journals.values():
+                journal.close()
+
+class SqliteStorage:
+    """SQLite 存储（WAL 模式）：小说、章节、库条目和游戏消息各自成行，按行读写"""
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS novels (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT '',
+            meta TEXT NOT NULL,
+            content TEXT NOT NULL DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS chapters (
+            id TEXT PRIMARY KEY,
+            novel_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            meta TEXT NOT NULL,
+            content TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_chapters_novel ON chapters (novel_id, position);
+        CREATE TABLE IF NOT EXISTS library (
+            store TEXT NOT NULL,
+            id TEXT NOT NULL,
+            name TEXT NOT NULL DEFAULT '',
+            category TEXT NOT NULL DEFAULT '',
+            data TEXT NOT NULL,
+            PRIMARY KEY (store, id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_library_category ON library (store, category);
+        CREATE TABLE IF NOT EXISTS games (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT '',
+            meta TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS game_messages (
+            game_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (game_id, seq)
+        );
+        CREATE TABLE IF NOT EXISTS chapter_history (
+            novel_id TEXT NOT NULL,
+            chapter_id TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            checksum INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (novel_id, chapter_id, revision)
+        );
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+
+    def get_setting(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def load_novel(self, novel_id, chapter_bodies=True):
+        with self.lock:
+            row = self.conn.execute("SELECT meta, content FROM novels WHERE id = ?", (novel_id,)).fetchone()
+            if row is None:
+                return None
+            chapter_rows = self.conn.execute(
+                "SELECT id, meta" + (", content" if chapter_bodies else "")
+                + " FROM chapters WHERE novel_id = ? ORDER BY position",
+                (novel_id,)).fetchall()
+        novel = json_loads(row[0])
+        novel["content"] = row[1]
+        novel["chapters"] = []
+        for chapter_row in chapter_rows:
+            chapter = dict(json_loads(chapter_row[1]), id=chapter_row[0])
+            if chapter_bodies:
+                chapter["content"] = chapter_row[2]
+            novel["chapters"].append(chapter)
+        return novel
+
+    def load_chapter(self, novel_id, chapter_id):
+        with self.lock:
+            row = self.conn.execute("SELECT content FROM chapters WHERE id = ? AND novel_id = ?",
+                                    (chapter_id, novel_id)).fetchone()
+        return row[0] if row else ""
+
+    def load_manifest(self):
+        """只读取小说与章节的元数据，不读正文"""
+        with self.lock:
+            novel_rows = self.conn.execute("SELECT id, meta FROM novels ORDER BY id").fetchall()
+            chapter_rows = self.conn.execute(
+                "SELECT novel_id, id, meta FROM chapters ORDER BY novel_id, position").fetchall()
+        manifest = {}
+        for novel_id, meta in novel_rows:
+            manifest[novel_id] = json_loads(meta)
+            manifest[novel_id]["chapters"] = []
+        for novel_id, chapter_id, meta in chapter_rows:
+            if novel_id in manifest:
+                manifest[novel_id]["chapters"].append(dict(json_loads(meta), id=chapter_id))
+        return manifest
+
+    def load_novels(self):
+        with self.lock:
+            novel_rows = self.conn.execute("SELECT id, meta, content FROM novels ORDER BY id").fetchall()
+            chapter_rows = self.conn.execute(
+                "SELECT novel_id, id, meta, content FROM chapters ORDER BY novel_id, position").fetchall()
+        novels = {}
+        for novel_id, meta, content in novel_rows:
+            novel = json_loads(meta)
+            novel["content"] = content
+            novel["chapters"] = []
+            novels[novel_id] = novel
+        for novel_id, chapter_id, meta, content in chapter_rows:
+            if novel_id in novels:
+                novels[novel_id]["chapters"].append(dict(json_loads(meta), id=chapter_id, content=content))
+        return novels
+
+    def save_novel(self, novel_id, novel, content=False, chapters=()):
+        """行级保存：更新小说行与章节的顺序/元数据，只重写 content/chapters 指定的正文"""
+        try:
+            with self.lock, self.conn:
+                if novel is None:
+                    self.conn.execute("DELETE FROM chapters WHERE novel_id = ?", (novel_id,))
+                    self.conn.execute("DELETE FROM novels WHERE id = ?", (novel_id,))
+                    return True
+                meta = {key: val for key, val in novel.items() if key not in ("content", "chapters")}
+                self.conn.execute(
+                    "INSERT INTO novels (id, title, meta) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET title = excluded.title, meta = excluded.meta",
+                    (novel_id, novel.get("title", ""), json_dumps(meta)))
+                if content:
+                    self.conn.execute("UPDATE novels SET content = ? WHERE id = ?",
+                                      (novel.get("content", ""), novel_id))
+                chapter_list = novel.get("chapters", [])
+                chapter_map = {chapter["id"]: chapter for chapter in chapter_list}
+                positions = {chapter["id"]: i for i, chapter in enumerate(chapter_list)}
+                for chapter_id in (chapter_map if chapters is None else chapters):
+                    if chapter_id not in chapter_map:
+                        self.conn.execute("DELETE FROM chapters WHERE id = ?", (chapter_id,))
+                        continue
+                    chapter = chapter_map[chapter_id]
+                    chapter_content = chapter.get("content")
+                    if chapter_content is None:
+                        continue  # 正文不在内存中，未修改
+                    chapter_meta = {key: val for key, val in chapter.items() if key not in ("id", "content")}
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO chapters (id, novel_id, position, meta, content) VALUES (?, ?, ?, ?, ?)",
+                        (chapter_id, novel_id, positions[chapter_id],
+                         json_dumps(chapter_meta), chapter_content))
+                # 章节顺序与标题等元数据：只有发生变化的行才会被写入
+                meta_rows = []
+                for chapter_id, chapter in chapter_map.items():
+                    chapter_meta = json_dumps({key: val for key, val in chapter.items()
+                                               if key not in ("id", "content")})
+                    meta_rows.append((positions[chapter_id], chapter_meta, chapter_id, positions[chapter_id], chapter_meta))
+                self.conn.executemany(
+                    "UPDATE chapters SET position = ?, meta = ? WHERE id = ? AND (position != ? OR meta != ?)",
+                    meta_rows)
+            return True
+        except Exception as e:
+            logging.error(f"保存小说到SQLite出错 {novel_id}: {e}")
+            return False
+
+    def load_library(self, store):
+        if store == "games":
+            return self.load_games()
+        with self.lock:
+            rows = self.conn.execute("SELECT id, data FROM library WHERE store = ? ORDER BY rowid", (store,)).fetchall()
+        return {entry_id: json_loads(data) for entry_id, data in rows}
+
+    def save_library(self, store, entries, keys=None):
+        """keys 为 None 时整体替换该库，否则只写入（或删除）这些行"""
+        if store == "games":
+            return self.save_games(entries, keys)
+        replace_all = keys is None
+        keys = list(entries) if replace_all else keys
+        with self.lock, self.conn:
+            if replace_all:
+                self.conn.execute("DELETE FROM library WHERE store = ?", (store,))
+            for entry_id in keys:
+                entry = entries.get(entry_id)
+                if entry is None:
+                    self.conn.execute("DELETE FROM library WHERE store = ? AND id = ?", (store, entry_id))
+                    continue
+                self.conn.execute(
+                    "INSERT INTO library (store, id, name, category, data) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(store, id) DO UPDATE SET name = excluded.name, "
+                    "category = excluded.category, data = excluded.data",
+                    (store, entry_id, entry.get("name") or entry.get("term") or "",
+                     entry.get("category", ""), json_dumps(entry)))
+
+    def load_games(self):
+        with self.lock:
+            game_rows = self.conn.execute("SELECT id, meta FROM games ORDER BY rowid").fetchall()
+            message_rows = self.conn.execute(
+                "SELECT game_id, message FROM game_messages ORDER BY game_id, seq").fetchall()
+        games = {game_id: dict(json_loads(meta), chat_history=[]) for game_id, meta in game_rows}
+        for game_id, message in message_rows:
+            if game_id in games:
+                games[game_id]["chat_history"].append(json_loads(message))
+        return games
+
+    def save_games(self, games, keys=None):
+        replace_all = keys is None
+        keys = list(games) if replace_all else keys
+        with self.lock, self.conn:
+            if replace_all:
+                self.conn.execute("DELETE FROM games")
+                self.conn.execute("DELETE FROM game_messages")
+            for game_id in keys:
+                game = games.get(game_id)
+                self.conn.execute("DELETE FROM game_messages WHERE game_id = ?", (game_id,))
+                if game is None:
+                    self.conn.execute("DELETE FROM games WHERE id = ?", (game_id,))
+                    continue
+                meta = {k: v for k, v in game.items() if k != "chat_history"}
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO games (id, title, meta) VALUES (?, ?, ?)",
+                    (game_id, game.get("title", ""), json_dumps(meta)))
+                self.conn.executemany(
+                    "INSERT INTO game_messages (game_id, seq, message) VALUES (?, ?, ?)",
+                    [(game_id, seq, json_dumps(message))
+                     for seq, message in enumerate(game.get("chat_history", []))])
+
+    HISTORY_COLUMNS = ("revision", "created_at", "kind", "length", "checksum", "data")
+
+    def load_history(self, novel_id, chapter_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT " + ", ".join(self.HISTORY_COLUMNS) + " FROM chapter_history "
+                "WHERE novel_id = ? AND chapter_id = ? ORDER BY revision",
+                (novel_id, chapter_id)).fetchall()
+        return [dict(zip(self.HISTORY_COLUMNS, row[:-1] + (bytes(row[-1]),))) for row in rows]
+
+    def history_rows(self, novel_id, chapter_id, records):
+        return [(novel_id, chapter_id) + tuple(record[column] for column in self.HISTORY_COLUMNS)
+                for record in records]
+
+    def append_history(self, novel_id, chapter_id, record):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO chapter_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  self.history_rows(novel_id, chapter_id, [record]))
+
+    def replace_history(self, novel_id, chapter_id, records):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chapter_history WHERE novel_id = ? AND chapter_id = ?",
+                              (novel_id, chapter_id))
+            self.conn.executemany("INSERT OR REPLACE INTO chapter_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  self.history_rows(novel_id, chapter_id, records))
+
+    def delete_history(self, novel_id, chapter_id=None):
+        with self.lock, self.conn:
+            if chapter_id is None:
+                self.conn.execute("DELETE FROM chapter_history WHERE novel_id = ?", (novel_id,))
+            else:
+                self.conn.execute("DELETE FROM chapter_history WHERE novel_id = ? AND chapter_id = ?",
+                                  (novel_id, chapter_id))
+
+    def commit(self):
+        """每次写入都在各自的事务中提交，无需额外操作"""
+
+    def import_from(self, source):
+        """从另一个存储（通常是 JsonStorage）整体导入数据（含章节历史版本）"""
+        for novel_id, novel in source.load_novels().items():
+            self.save_novel(novel_id, novel, content=True, chapters=None)
+            for chapter in novel.get("chapters", []):
+                records = source.load_history(novel_id, chapter["id"])
+                if records:
+                    self.replace_history(novel_id, chapter["id"], records)
+        for store in LIBRARY_STORES:
+            self.save_library(store, source.load_library(store))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def create_storage():
+    """按 STORAGE_BACKEND 创建存储后端；首次使用 SQLite 时自动从 data/*.json 迁移"""
+    if STORAGE_BACKEND == "sqlite":
+        sqlite_storage = SqliteStorage(SQLITE_FILE)
+        if sqlite_storage.get_setting("migrated_from_json") is None:
+            logging.info(f"首次使用SQLite存储，开始从JSON数据迁移: {DATA_DIR}")
+            json_storage = JsonStorage(DATA_DIR, journaled=True)
+            sqlite_storage.import_from(json_storage)
+            json_storage.close()
+            sqlite_storage.set_setting("migrated_from_json", datetime.datetime.now().isoformat())
+            logging.info("JSON数据已迁移到SQLite。")
+        return sqlite_storage
+    if STORAGE_BACKEND != "json":
+        logging.warning(f"未知的存储后端 {STORAGE_BACKEND}，使用JSON文件存储。")
+    return JsonStorage(DATA_DIR, journaled=True)
+
+def export_storage(target_dir):
+    """把当前内存中的全部数据按 JSON 目录格式导出到 target_dir"""
+    json_storage = JsonStorage(target_dir)
+    for novel_id in list(novels_db):
+        with novel_lock(novel_id):
+            novel = novels_db.get(novel_id)
+            if novel is None:
+                continue
+            chapters = [dict(chapter, content=novels_db.chapters.get(novel_id, chapter))
+                        for chapter in novel.get("chapters", [])]
+            json_storage.save_novel(novel_id, dict(novel, chapters=chapters), content=True, chapters=None)
+    for store, entries in library_dbs().items():
+        with store_lock(store):
+            json_storage.save_library(store, entries)
+
+def library_dbs():
+    return {"characters": characters_db, "glossary": glossary_db, "styles": styles_db, "games": games_db}
+
+# --- 小说缓存（按需加载） ---
+
+# 按需加载（默认）：启动时只读取小说清单（ID、标题、章节元数据），正文在首次访问时加载；
+# 设为 0 时启动即加载全部小说
+LAZY_LOAD_NOVELS = os.environ.get('BMXH_LAZY_LOAD', '1') != '0'
+# 内存中最多保留多少部完整小说（最近最少使用的先换出；有未写入修改的小说不会被换出）
+NOVEL_CACHE_SIZE = int(os.environ.get('BMXH_NOVEL_CACHE_SIZE', '16'))
+# 章节正文缓存的内存上限（MB），超出后换出最久未访问的章节正文，需要时再从存储读取
+CHAPTER_CACHE_MB = float(os.environ.get('BMXH_CHAPTER_CACHE_MB', '64'))
+
+class ChapterCache:
+    """章节正文的 LRU 缓存，按正文占用的字节数限制内存。
+    正文直接保存在章节字典的 content 字段中，换出时删除该字段；有未写入修改的正文不会被换出"""
+
+    def __init__(self, loader, budget_bytes):
+        self.loader = loader              # (novel_id, chapter_id) -> 正文
+        self.budget = budget_bytes
+        self.entries = OrderedDict()      # (novel_id, chapter_id) -> [章节字典, 字节数]，按最近访问排序
+        self.pinned = {}                  # 换出时遇到的未写入正文：移出 entries，写入完成后放回
+        self.by_novel = {}                # novel_id -> 该小说在缓存中的章节ID集合
+        self.dirty = set()                # 尚未写入存储的 (novel_id, chapter_id)
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, novel_id, chapter):
+        """返回章节正文，不在内存中时从存储读取"""
+        key = (novel_id, chapter["id"])
+        with self.lock:
+            if "content" in chapter:
+                self.hits += 1
+                self._track(key, chapter)
+                return chapter["content"]
+            self.misses += 1
+        content = self.loader(novel_id, chapter["id"])
+        with self.lock:
+            # 读取期间可能已被其他请求写入
+            content = chapter.setdefault("content", content)
+            self._track(key, chapter)
+            self.evict()
+            return content
+
+    def peek(self, novel_id, chapter):
+        """返回章节正文；不在内存中时从存储读取，但不放入缓存（用于建立索引等一次性遍历）"""
+        content = chapter.get("content")
+        return content if content is not None else self.loader(novel_id, chapter["id"])
+
+    def put(self, novel_id, chapter, content):
+        """修改章节正文；在后台写入完成前不会被换出"""
+        key = (novel_id, chapter["id"])
+        with self.lock:
+            chapter["content"] = content
+            self.dirty.add(key)
+            self._track(key, chapter)
+            self.evict()
+
+    def adopt(self, novel_id, novel, dirty):
+        """登记一部小说中已在内存里的章节正文（新放入或重新使用的小说）"""
+        with self.lock:
+            for chapter in novel.get("chapters", []):
+                if "content" in chapter:
+                    key = (novel_id, chapter["id"])
+                    if dirty:
+                        self.dirty.add(key)
+                    self._track(key, chapter)
+            self.evict()
+
+    def _track(self, key, chapter):
+        size = sys.getsizeof(chapter["content"])
+        entry = self.entries.get(key)
+        if entry is None and key in self.pinned:
+            # 再次访问的未写入正文回到 entries 的最新一端
+            entry = self.entries[key] = self.pinned.pop(key)
+        if entry is None:
+            self.entries[key] = [chapter, size]
+            self.by_novel.setdefault(key[0], set()).add(key[1])
+        else:
+            self.size -= entry[1]
+            entry[0], entry[1] = chapter, size
+            self.entries.move_to_end(key)
+        self.size += size
+
+    def forget(self, novel_id, chapter_id):
+        with self.lock:
+            entry = self.entries.pop((novel_id, chapter_id), None)
+            if entry is None:
+                entry = self.pinned.pop((novel_id, chapter_id), None)
+            if entry is not None:
+                self.size -= entry[1]
+                self.by_novel.get(novel_id, set()).discard(chapter_id)
+            self.dirty.discard((novel_id, chapter_id))
+
+    def forget_novel(self, novel_id):
+        """小说被删除或换出时移除其全部缓存记录"""
+        with self.lock:
+            for chapter_id in list(self.by_novel.pop(novel_id, ())):
+                self.forget(novel_id, chapter_id)
+
+    def mark_saved(self, written):
+        """后台写入完成后调用：written 为 novel_id -> 已写入的章节ID集合（None 表示全部）"""
+        with self.lock:
+            for novel_id, chapter_ids in written.items():
+                if chapter_ids is None:
+                    chapter_ids = self.by_novel.get(novel_id, ())
+                for chapter_id in chapter_ids:
+                    key = (novel_id, chapter_id)
+                    self.dirty.discard(key)
+                    entry = self.pinned.pop(key, None)
+                    if entry is not None:
+                        # 放回最旧的一端，优先换出
+                        self.entries[key] = entry
+                        self.entries.move_to_end(key, last=False)
+            self.evict()
+
+    def evict(self):
+        """从最旧的一端换出正文直到不超过内存上限，保留最近访问的一章；未写入的正文移到 pinned，
+        之后的换出不再逐个跳过它们"""
+        while self.size > self.budget and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            if key in self.dirty:
+                self.pinned[key] = entry
+                continue
+            chapter, size = entry
+            self.by_novel.get(key[0], set()).discard(key[1])
+            chapter.pop("content", None)
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"chapters": len(self.entries) + len(self.pinned), "bytes": self.size, "budget_bytes": self.budget,
+                    "dirty": len(self.dirty), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+class Novel(dict):
+    """一部完整的小说；可被弱引用，换出缓存后只要还有请求在使用就不会重复加载"""
+
+class NovelStore(MutableMapping):
+    """novels_db 的实现：所有小说的清单常驻内存，完整小说按需从存储后端加载到有界 LRU 缓存"""
+
+    def __init__(self, loader, manifest, chapters, capacity=None, is_pinned=None):
+        self.loader = loader              # novel_id -> 不含章节正文的小说
+        self.manifest = manifest          # novel_id -> 元数据（不含正文）
+        self.chapters = chapters          # ChapterCache，章节正文按需加载
+        self.capacity = capacity          # None 表示不限
+        self.is_pinned = is_pinned or (lambda novel_id: False)
+        self.cache = OrderedDict()        # novel_id -> Novel，按最近访问排序
+        self.evicted = weakref.WeakValueDictionary()
+        self.fresh = set()                # 新放入、尚未交给后台写入的小说，不能换出
+        self.lock = threading.RLock()
+        self.loads = 0
+        self.versions = {}                # novel_id -> 小说对象被整体放入/替换的序号，用于 ETag
+        self.version_seq = 0
+
+    def __contains__(self, novel_id):
+        return novel_id in self.manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __iter__(self):
+        return iter(list(self.manifest))
+
+    def __getitem__(self, novel_id):
+        with self.lock:
+            novel = self.cache.get(novel_id)
+            if novel is not None:
+                self.cache.move_to_end(novel_id)
+                return novel
+            if novel_id not in self.manifest:
+                raise KeyError(novel_id)
+            novel = self.evicted.pop(novel_id, None)
+            if novel is not None:
+                self.chapters.adopt(novel_id, novel, dirty=False)
+            else:
+                try:
+                    loaded = self.loader(novel_id)
+                except FileNotFoundError:
+                    loaded = None
+                if loaded is None:
+                    raise KeyError(novel_id)
+                novel = Novel(loaded)
+                self.loads += 1
+            self.cache[novel_id] = novel
+            self.evict()
+            return novel
+
+    def __setitem__(self, novel_id, novel):
+        """保存为 Novel（普通字典会被浅拷贝一次），其中的章节正文视为尚未写入"""
+        self.put(novel_id, novel, dirty=True)
+
+    def put(self, novel_id, novel, dirty):
+        if not isinstance(novel, Novel):
+            novel = Novel(novel)
+        with self.lock:
+            self.chapters.forget_novel(novel_id)
+            self.chapters.adopt(novel_id, novel, dirty)
+            self.evicted.pop(novel_id, None)
+            self.cache[novel_id] = novel
+            self.cache.move_to_end(novel_id)
+            self.manifest[novel_id] = {"title": novel.get("title", "")}
+            self.version_seq += 1
+            self.versions[novel_id] = self.version_seq
+            if dirty:
+                self.fresh.add(novel_id)
+            self.evict()
+
+    def __delitem__(self, novel_id):
+        with self.lock:
+            del self.manifest[novel_id]
+            self.cache.pop(novel_id, None)
+            self.evicted.pop(novel_id, None)
+            self.fresh.discard(novel_id)
+            self.versions.pop(novel_id, None)
+            self.chapters.forget_novel(novel_id)
+
+    def version(self, novel_id):
+        """小说对象被整体替换（新建、导入）时变化；字段修改由 revision 反映"""
+        return self.versions.get(novel_id, 0)
+
+    def meta(self, novel_id):
+        """不加载正文读取元数据（标题、章节列表等）：已加载时返回小说本身，否则返回清单条目"""
+        with self.lock:
+            novel = self.cache.get(novel_id)
+            if novel is None:
+                novel = self.evicted.get(novel_id)
+            return novel if novel is not None else self.manifest[novel_id]
+
+    def title(self, novel_id):
+        return self.meta(novel_id).get("title", "Untitled")
+
+    def peek(self, novel_id):
+        """读取小说（不含章节正文）；未缓存时直接从存储读取，不放入缓存"""
+        with self.lock:
+            novel = self.cache.get(novel_id)
+            if novel is None:
+                novel = self.evicted.get(novel_id)
+        return novel if novel is not None else self.loader(novel_id)
+
+    def evict(self):
+        """换出超出容量的最久未访问小说，跳过最近访问的一部和有未写入修改的小说"""
+        if self.capacity is None:
+            return
+        for novel_id in list(self.cache)[:-1]:
+            if len(self.cache) <= self.capacity:
+                break
+            if novel_id in self.fresh or self.is_pinned(novel_id):
+                continue
+            novel = self.cache.pop(novel_id)
+            self.manifest[novel_id] = novel_meta(novel)
+            self.evicted[novel_id] = novel
+            self.chapters.forget_novel(novel_id)
+
+    def mark_saved(self, novel_ids):
+        """一批后台写入完成后调用：新放入的小说从此可以换出（写入失败的仍在待写入队列中，不会被换出）"""
+        with self.lock:
+            self.fresh.difference_update(novel_ids)
+            self.evict()
+
+    def stats(self):
+        with self.lock:
+            return {"novels": len(self.manifest), "cached": len(self.cache),
+                    "capacity": self.capacity, "loads": self.loads, "chapter_bodies": self.chapters.stats()}
+
+def current_rss_mb():
+    """当前进程的常驻内存（MB），无法获取时返回 None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
 # 加载持久化数据
+def load_library(store, label):
+    """从存储后端加载一个库，出错时返回空字典"""
+    try:
+        entries = storage.load_library(store)
+        logging.info(f"成功加载了 {len(entries)} {label}。")
+        return entries
+    except json.JSONDecodeError as e:
+        logging.error(f"加载{label}数据出错 (JSON解析错误): {e}")
+    except Exception as e:
+        logging.error(f"加载{label}数据出错 (其他错误): {e}")
+    return {}
+
 def load_data():
-    """从JSON文件加载数据到内存"""
-    global novels_db, characters_db, glossary_db, styles_db, games_db, CUSTOM_API_CONFIGS, OPENROUTER_API_KEY
-    
+    """从存储后端加载数据到内存"""
+    global storage, settings_storage, chapter_history, search_index, vector_index, entity_matcher, etag_epoch, novels_db, characters_db, glossary_db, styles_db, games_db, CUSTOM_API_CONFIGS, ROUTE_GROUPS, OPENROUTER_API_KEY
+
+    started = time.perf_counter()
     logging.info("尝试加载持久化数据...")
-    logging.info(f"小说数据文件路径: {NOVELS_FILE}")
+    logging.info(f"存储后端: {STORAGE_BACKEND}，数据目录: {DATA_DIR}")
 
     # 确保所有数据目录存在
     for directory in [DATA_DIR, EXPORT_DIR, MODEL_DIR]:
@@ -106,231 +1354,1447 @@ def load_data():
 
     # 确保所有数据文件存在
     data_files = {
-        NOVELS_FILE: {},
-        CHARACTERS_FILE: {},
-        GLOSSARY_FILE: {},
-        STYLES_FILE: {},
-        GAMES_FILE: {},
         API_CONFIGS_FILE: {},
-        API_KEY_FILE: {"api_key": None}
+        API_KEY_FILE: {"api_key": None},
+        ROUTES_FILE: {}
     }
+    if STORAGE_BACKEND != "sqlite":
+        data_files.update({CHARACTERS_FILE: {}, GLOSSARY_FILE: {}, STYLES_FILE: {}, GAMES_FILE: {}})
 
     for file_path, default_content in data_files.items():
         if not os.path.exists(file_path):
             try:
                 with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(default_content, f, ensure_ascii=False, indent=2)
+                    f.write(json_file_text(default_content))
                 logging.info(f"创建数据文件: {file_path}")
             except Exception as e:
                 logging.error(f"创建数据文件失败 {file_path}: {e}")
 
-    # 加载小说数据
-    if os.path.exists(NOVELS_FILE):
-        logging.info("小说数据文件存在，尝试加载...")
-        try:
-            with open(NOVELS_FILE, 'r', encoding='utf-8') as f:
-                novels_db = json.load(f)
-            logging.info(f"成功加载了 {len(novels_db)} 部小说。")
-            # 添加日志，打印加载后的小说ID列表和总数
-            logging.info(f"加载后的小说ID列表 (前5个): {list(novels_db.keys())[:5]}")
-            logging.info(f"加载后的小说总数: {len(novels_db)}")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载小说数据出错 (JSON解析错误): {e}")
-            novels_db = {}
-        except Exception as e:
-            logging.error(f"加载小说数据出错 (其他错误): {e}")
-            novels_db = {}
-    else:
-        logging.info("小说数据文件不存在，初始化为空数据库。")
-        novels_db = {}
-       
-       
-    # 加载角色数据
-    if os.path.exists(CHARACTERS_FILE):
-        try:
-            with open(CHARACTERS_FILE, 'r', encoding='utf-8') as f:
-                characters_db = json.load(f)
-            logging.info(f"成功加载了 {len(characters_db)} 个角色。")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载角色数据出错 (JSON解析错误): {e}")
-            characters_db = {}
-        except Exception as e:
-            logging.error(f"加载角色数据出错 (其他错误): {e}")
-            characters_db = {}
-    else:
-        logging.info("角色数据文件不存在，初始化为空数据库。")
-        characters_db = {}
-    
-    # 加载词条数据
-    if os.path.exists(GLOSSARY_FILE):
-        try:
-            with open(GLOSSARY_FILE, 'r', encoding='utf-8') as f:
-                glossary_db = json.load(f)
-            logging.info(f"成功加载了 {len(glossary_db)} 个词条。")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载词条数据出错 (JSON解析错误): {e}")
-            glossary_db = {}
-        except Exception as e:
-            logging.error(f"加载词条数据出错 (其他错误): {e}")
-            glossary_db = {}
-    else:
-        logging.info("词条数据文件不存在，初始化为空数据库。")
-        glossary_db = {}
-            
-    # 加载风格数据
-    if os.path.exists(STYLES_FILE):
-        try:
-            with open(STYLES_FILE, 'r', encoding='utf-8') as f:
-                styles_db = json.load(f)
-            logging.info(f"成功加载了 {len(styles_db)} 个风格词条。")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载风格数据出错 (JSON解析错误): {e}")
-            styles_db = {}
-        except Exception as e:
-            logging.error(f"加载风格数据出错 (其他错误): {e}")
-            styles_db = {}
-    else:
-        logging.info("风格数据文件不存在，初始化为空数据库。")
-        styles_db = {}
-      
-    # 加载游戏数据
-    if os.path.exists(GAMES_FILE):
-        try:
-            with open(GAMES_FILE, 'r', encoding='utf-8') as f:
-                games_db = json.load(f)
-            logging.info(f"成功加载了 {len(games_db)} 个游戏记录。")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载游戏数据出错 (JSON解析错误): {e}")
-            games_db = {}
-        except Exception as e:
-            logging.error(f"加载游戏数据出错 (其他错误): {e}")
-            games_db = {}
-    else:
-        logging.info("游戏数据文件不存在，初始化为空数据库。")
-        games_db = {}
-            
-    # 加载自定义API配置
-    if os.path.exists(API_CONFIGS_FILE):
-        try:
-            with open(API_CONFIGS_FILE, 'r', encoding='utf-8') as f:
-                CUSTOM_API_CONFIGS = json.load(f)
-            logging.info(f"成功加载了 {len(CUSTOM_API_CONFIGS)} 个自定义API配置。")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载自定义API配置出错 (JSON解析错误): {e}")
-            CUSTOM_API_CONFIGS = {}
-        except Exception as e:
-            logging.error(f"加载自定义API配置出错 (其他错误): {e}")
-            CUSTOM_API_CONFIGS = {}
-    else:
-        logging.info("自定义API配置文件不存在，初始化为空配置。")
-        CUSTOM_API_CONFIGS = {}
-            
-    # 加载OpenRouter API密钥
-    if os.path.exists(API_KEY_FILE):
-        try:
-            with open(API_KEY_FILE, 'r', encoding='utf-8') as f:
-                api_key_data = json.load(f)
-                OPENROUTER_API_KEY = api_key_data.get("api_key")
-            if OPENROUTER_API_KEY:
-                logging.info("成功加载了API密钥。")
-        except json.JSONDecodeError as e:
-            logging.error(f"加载API密钥出错 (JSON解析错误): {e}")
-            OPENROUTER_API_KEY = None
-        except Exception as e:
-            logging.error(f"加载API密钥出错 (其他错误): {e}")
-            OPENROUTER_API_KEY = None
-    else:
-        print("API密钥文件不存在或密钥未设置。")
-        OPENROUTER_API_KEY = None
-
-# 保存数据到文件
-def save_novels():
-    """保存小说数据到文件"""
-    logging.info("尝试保存小说数据...")
-    logging.info(f"小说数据文件路径: {NOVELS_FILE}")
+    if storage is not None:
+        flush_saves()
+        storage.close()
+        settings_storage.close()
+    storage = create_storage()
+    settings_storage = storage if isinstance(storage, JsonStorage) else JsonStorage(DATA_DIR, journaled=True)
+    chapter_history = ChapterHistory(storage)
+    etag_epoch = uuid.uuid4().hex
+
+    # 加载小说数据：按需加载时只读取清单，正文在首次访问时加载
+    chapter_cache = ChapterCache(storage.load_chapter, int(CHAPTER_CACHE_MB * 1024 * 1024))
+    novel_loader = lambda novel_id: storage.load_novel(novel_id, chapter_bodies=False)
     try:
-        # 使用临时文件进行原子性写入
-        with tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=False, dir=os.path.dirname(NOVELS_FILE)) as tmp_file:
-            json.dump(novels_db, tmp_file, ensure_ascii=False, indent=2)
-        # 原子性替换原文件
-        os.replace(tmp_file.name, NOVELS_FILE)
-        logging.info(f"成功保存了 {len(novels_db)} 部小说。")
-        return True
+        if LAZY_LOAD_NOVELS:
+            novels_db = NovelStore(novel_loader, storage.load_manifest(), chapter_cache,
+                                   NOVEL_CACHE_SIZE, save_scheduler.is_novel_pending)
+        else:
+            novels = storage.load_novels()
+            novels_db = NovelStore(novel_loader, {novel_id: {} for novel_id in novels}, chapter_cache)
+            for novel_id, novel in novels.items():
+                novels_db.put(novel_id, novel, dirty=False)
+        logging.info(f"成功加载了 {len(novels_db)} 部小说" + ("的清单（正文按需加载）。" if LAZY_LOAD_NOVELS else "。"))
+        # 添加日志，打印加载后的小说ID列表和总数
+        logging.info(f"加载后的小说ID列表 (前5个): {list(novels_db)[:5]}")
     except Exception as e:
-        logging.error(f"保存小说数据出错: {e}")
-        # 如果发生错误，尝试清理临时文件
-        if 'tmp_file' in locals() and os.path.exists(tmp_file.name):
-            os.remove(tmp_file.name)
-        return False
+        logging.error(f"加载小说数据出错: {e}")
+        novels_db = NovelStore(novel_loader, {}, chapter_cache)
+
+    # 加载角色、词条、风格、游戏数据
+    characters_db = load_library("characters", "个角色")
+    glossary_db = load_library("glossary", "个词条")
+    styles_db = load_library("styles", "个风格词条")
+    games_db = load_library("games", "个游戏记录")
+
+    # 全文索引按新加载的数据重新建立，向量索引读入磁盘上的索引后按新数据核对
+    if search_index is not None:
+        search_index.closed = True
+        search_index.wakeup.set()
+    search_index = SearchIndex()
+    if vector_index is not None:
+        vector_index.closed = True
+        vector_index.wakeup.set()
+    vector_index = VectorIndex(VECTOR_INDEX_FILE)
+    if SEARCH_BACKGROUND:
+        search_index.start()
+        vector_index.start()
+    entity_matcher = EntityMatcher()
 
-def save_characters():
-    """保存角色数据到文件"""
+    # 加载自定义API配置
     try:
-        with open(CHARACTERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(characters_db, f, ensure_ascii=False, indent=2)
-        print(f"成功保存了 {len(characters_db)} 个角色。")
-        return True
+        CUSTOM_API_CONFIGS = settings_storage.load_library("api_configs")
+        logging.info(f"成功加载了 {len(CUSTOM_API_CONFIGS)} 个自定义API配置。")
+    except json.JSONDecodeError as e:
+        logging.error(f"加载自定义API配置出错 (JSON解析错误): {e}")
+        CUSTOM_API_CONFIGS = {}
     except Exception as e:
-        print(f"保存角色数据出错: {e}")
-        return False
+        logging.error(f"加载自定义API配置出错 (其他错误): {e}")
+        CUSTOM_API_CONFIGS = {}
 
-def save_glossary():
-    """保存词条数据到文件"""
+    # 加载模型路由组
     try:
-        with open(GLOSSARY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(glossary_db, f, ensure_ascii=False, indent=2)
-        print(f"成功保存了 {len(glossary_db)} 个词条。")
-        return True
+        ROUTE_GROUPS = settings_storage.load_library("routes")
+        logging.info(f"成功加载了 {len(ROUTE_GROUPS)} 个模型路由组。")
     except Exception as e:
-        print(f"保存词条数据出错: {e}")
-        return False
+        logging.error(f"加载模型路由组出错: {e}")
+        ROUTE_GROUPS = {}
 
-def save_styles():
-    """保存风格数据到文件"""
+    # 加载OpenRouter API密钥
     try:
-        with open(STYLES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(styles_db, f, ensure_ascii=False, indent=2)
-        print(f"成功保存了 {len(styles_db)} 个风格词条。")
-        return True
+        OPENROUTER_API_KEY = settings_storage.load_library("api_key").get("api_key")
+        if OPENROUTER_API_KEY:
+            logging.info("成功加载了API密钥。")
+        else:
+            print("API密钥文件不存在或密钥未设置。")
+    except json.JSONDecodeError as e:
+        logging.error(f"加载API密钥出错 (JSON解析错误): {e}")
+        OPENROUTER_API_KEY = None
     except Exception as e:
-        print(f"保存风格数据出错: {e}")
-        return False
+        logging.error(f"加载API密钥出错 (其他错误): {e}")
+        OPENROUTER_API_KEY = None
 
-def save_games():
-    """保存游戏数据到文件"""
+    rss = current_rss_mb()
+    logging.info(f"数据加载完成，用时 {time.perf_counter() - started:.2f} 秒"
+                 + (f"，常驻内存 {rss:.1f} MB" if rss is not None else ""))
+
+# --- 章节历史版本 ---
+
+# 每次章节正文修改（revision 递增）都记录一个历史版本：关键帧保存 zlib 压缩的全文，
+# 其余版本只保存与上一版本之间的替换操作（同样压缩）。自上一关键帧以来的增量累计超过
+# 关键帧大小的 HISTORY_KEYFRAME_RATIO 倍，或连续增量达到 HISTORY_KEYFRAME_INTERVAL 条时写入新的关键帧，
+# 因此历史总大小约为修改量的 (1 + 1/比例) 倍，读取任一版本最多回放一段增量
+HISTORY_KEYFRAME_RATIO = float(os.environ.get('BMXH_HISTORY_KEYFRAME_RATIO', '2'))
+HISTORY_KEYFRAME_INTERVAL = int(os.environ.get('BMXH_HISTORY_KEYFRAME_INTERVAL', '200'))
+# 每个章节最多保留的历史版本数（0 表示不限）；超出一成后丢弃最早的版本
+HISTORY_MAX_REVISIONS = int(os.environ.get('BMXH_HISTORY_MAX_REVISIONS', '1000'))
+
+def common_prefix_length(a, b):
+    """两个字符串公共前缀的长度（二分比较切片，避免逐字符的 Python 循环）"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def common_suffix_length(a, b, limit):
+    """两个字符串公共后缀的长度，最多 limit 个字符"""
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def text_delta(old, new):
+    """计算把 old 变为 new 的操作（apply_text_ops 的格式）：去掉公共前后缀后的一个替换操作"""
+    if old == new:
+        return []
+    start = common_prefix_length(old, new)
+    end = common_suffix_length(old, new, min(len(old), len(new)) - start)
+    return [{"pos": start, "delete": len(old) - start - end, "insert": new[start:len(new) - end]}]
+
+def text_checksum(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+class ChapterHistory:
+    """章节历史版本的记录与读取，数据保存在存储后端（load/append/replace/delete_history）"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        # (小说ID, 章节ID) -> 历史摘要（最新版本号、校验值、关键帧与增量大小），首次写入时从存储读取
+        self.summaries = {}
+
+    @staticmethod
+    def keyframe(revision, text, created_at):
+        return {"revision": revision, "created_at": created_at, "kind": "key", "length": len(text),
+                "checksum": text_checksum(text), "data": zlib.compress(text.encode('utf-8'))}
+
+    @staticmethod
+    def reconstruct(records, index):
+        """从 index 之前最近的关键帧开始回放增量，得到第 index 条记录的正文"""
+        start = index
+        while records[start]["kind"] != "key":
+            start -= 1
+            if start < 0:
+                raise ValueError("缺少关键帧")
+        text = zlib.decompress(records[start]["data"]).decode('utf-8')
+        for record in records[start + 1:index + 1]:
+            ops = json_loads(zlib.decompress(record["data"]))
+            text = apply_text_ops(text, [{"pos": pos, "delete": delete, "insert": insert}
+                                         for pos, delete, insert in ops])
+        if text_checksum(text) != records[index]["checksum"]:
+            raise ValueError(f"版本 {records[index]['revision']} 校验失败")
+        return text
+
+    def summary(self, novel_id, chapter_id):
+        key = (novel_id, chapter_id)
+        if key not in self.summaries:
+            summary = {"count": 0, "revision": None, "checksum": None,
+                       "key_bytes": 0, "delta_bytes": 0, "deltas": 0}
+            for record in self.storage.load_history(novel_id, chapter_id):
+                self.update_summary(summary, record)
+            self.summaries[key] = summary
+        return self.summaries[key]
+
+    @staticmethod
+    def update_summary(summary, record):
+        summary["count"] += 1
+        summary["revision"] = record["revision"]
+        summary["checksum"] = record["checksum"]
+        if record["kind"] == "key":
+            summary["key_bytes"] = len(record["data"])
+            summary["delta_bytes"] = summary["deltas"] = 0
+        else:
+            summary["delta_bytes"] += len(record["data"])
+            summary["deltas"] += 1
+
+    def append(self, novel_id, chapter_id, record):
+        self.storage.append_history(novel_id, chapter_id, record)
+        self.update_summary(self.summary(novel_id, chapter_id), record)
+
+    def record(self, novel_id, chapter_id, revision, old_content, content):
+        """记录章节正文修改后的版本 revision；old_content 是修改前（版本 revision - 1）的正文。
+        历史写入失败只记日志，不影响正文的保存"""
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            try:
+                summary = self.summary(novel_id, chapter_id)
+                if summary["revision"] is not None and summary["revision"] >= revision:
+                    # 版本号回退（例如上次退出前正文未落盘），丢弃这之后的历史
+                    self.truncate(novel_id, chapter_id, revision)
+                    summary = self.summary(novel_id, chapter_id)
+                # 标题等元数据的修改也会递增 revision，历史中的版本号可以不连续，以正文校验值判断是否衔接
+                old_checksum = text_checksum(old_content)
+                if (old_content and summary["checksum"] != old_checksum
+                        and (summary["revision"] is None or summary["revision"] < revision - 1)):
+                    # 首次记录该章节（或中间有未记录的正文修改）时，先保存修改前的版本
+                    self.append(novel_id, chapter_id, self.keyframe(revision - 1, old_content, now))
+                record = None
+                if summary["checksum"] == old_checksum and summary["deltas"] < HISTORY_KEYFRAME_INTERVAL:
+                    ops = text_delta(old_content, content)
+                    payload = json_dumps([[op["pos"], op["delete"], op["insert"]] for op in ops])
+                    data = zlib.compress(payload.encode('utf-8'))
+                    if summary["delta_bytes"] + len(data) <= HISTORY_KEYFRAME_RATIO * summary["key_bytes"]:
+                        record = {"revision": revision, "created_at": now, "kind": "delta", "length": len(content),
+                                  "checksum": text_checksum(content), "data": data}
+                self.append(novel_id, chapter_id, record or self.keyframe(revision, content, now))
+                if HISTORY_MAX_REVISIONS and summary["count"] > HISTORY_MAX_REVISIONS * 1.1:
+                    self.prune(novel_id, chapter_id)
+            except Exception as e:
+                logging.error(f"记录章节历史版本出错 {novel_id}/{chapter_id}: {e}")
+
+    def truncate(self, novel_id, chapter_id, revision):
+        """只保留 revision 之前的历史"""
+        records = self.storage.load_history(novel_id, chapter_id)
+        self.storage.replace_history(novel_id, chapter_id, [r for r in records if r["revision"] < revision])
+        self.summaries.pop((novel_id, chapter_id), None)
+
+    def prune(self, novel_id, chapter_id):
+        """丢弃最早的版本，只保留最近 HISTORY_MAX_REVISIONS 个；保留部分的第一条转为关键帧"""
+        records = self.storage.load_history(novel_id, chapter_id)
+        drop = len(records) - HISTORY_MAX_REVISIONS
+        if drop <= 0:
+            return
+        first = records[drop]
+        if first["kind"] != "key":
+            records[drop] = self.keyframe(first["revision"], self.reconstruct(records, drop), first["created_at"])
+        self.storage.replace_history(novel_id, chapter_id, records[drop:])
+        self.summaries.pop((novel_id, chapter_id), None)
+        logging.info(f"章节历史已裁剪 {novel_id}/{chapter_id}: 丢弃最早的 {drop} 个版本")
+
+    def list(self, novel_id, chapter_id):
+        """历史版本列表（最新的在前），不解压正文"""
+        with self.lock:
+            records = self.storage.load_history(novel_id, chapter_id)
+        return [{"revision": record["revision"], "created_at": record["created_at"],
+                 "length": record["length"], "keyframe": record["kind"] == "key"}
+                for record in reversed(records)]
+
+    def get(self, novel_id, chapter_id, revision):
+        """读取某个版本的正文，返回 {"revision", "created_at", "content"}，不存在时返回 None"""
+        with self.lock:
+            records = self.storage.load_history(novel_id, chapter_id)
+        for index, record in enumerate(records):
+            if record["revision"] == revision:
+                return {"revision": revision, "created_at": record["created_at"],
+                        "content": self.reconstruct(records, index)}
+        return None
+
+    def forget(self, novel_id, chapter_id=None):
+        """删除章节（chapter_id 为 None 时整部小说）的历史"""
+        with self.lock:
+            self.storage.delete_history(novel_id, chapter_id)
+            for key in [key for key in self.summaries
+                        if key[0] == novel_id and chapter_id in (None, key[1])]:
+                del self.summaries[key]
+
+# --- 全文检索 ---
+
+# 小说正文、章节、人物、词条、风格的进程内倒排索引。中日韩文字按相邻两字（bigram）切分，
+# 英文与数字按单词切分（小写）；安装了 jieba 时另外索引分词得到的三字以上词语，用于提高排序。
+# 倒排表为 词 -> (文档号数组, 词频数组)；文档修改后分配新的文档号，旧文档号留在倒排表中
+# 直到已删除的文档多于存活的文档时整体压缩。修改数据的接口通过 save_novel / schedule_store_save
+# 把变化的小说和条目标记为待更新，下一次检索前只重新索引这些文档（章节按 revision 与标题判断是否变化）
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:
+    jieba = None
+
+# 在后台线程建立索引，并在数据修改 SEARCH_REFRESH_DELAY 秒后更新；设为 0 时只在检索时建立和更新
+SEARCH_BACKGROUND = os.environ.get('BMXH_SEARCH_BACKGROUND', '1') != '0'
+SEARCH_REFRESH_DELAY = 1.0
+SEARCH_LIMIT_MAX = 100
+SNIPPET_RADIUS = 40   # 摘要在命中位置前后各保留的字数
+MAX_HIT_OFFSETS = 50  # 每个结果最多返回的命中位置数
+# 参与检索的库：库名 -> (标题字段, 正文字段)
+SEARCH_STORES = {
+    "characters": ("name", "description"),
+    "glossary": ("term", "description"),
+    "styles": ("name", "content"),
+}
+SEARCH_KINDS = ("novel", "chapter") + tuple(SEARCH_STORES)
+
+CJK_RUN_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+WORD_RE = re.compile(r'[0-9a-z]+')
+
+def tokenize(text):
+    """文本 -> 词频 Counter（bigram、英文单词，以及 jieba 分出的长词）"""
+    runs = CJK_RUN_RE.findall(text)
+    counts = Counter(bigram for run in runs for bigram in map(operator.add, run, run[1:]))
+    if jieba is not None:
+        counts.update(word for run in runs if len(run) > 2 for word in jieba.cut_for_search(run) if len(word) > 2)
+    counts.update(WORD_RE.findall(text.lower()))
+    return counts
+
+class DocumentIndex:
+    """从小说、章节与库条目派生的索引的公共部分。请求线程通过 mark_novel / mark_store 标记修改，
+    refresh 时按指纹（章节为 revision 与标题，库条目为文本的 CRC32）只重新处理变化的文档。
+    文档键为 ("novel", 小说ID)、("chapter", 小说ID, 章节ID) 或 (库名, 条目ID)；
+    子类实现 prepare（锁外处理文本）、add 与 drop（持有 self.lock 时修改索引）"""
+
+    label = "索引"
+    thread_name = "document-index"
+    idle_interval = None  # 后台线程空闲时调用 idle 的间隔（秒），None 表示不调用
+
+    def __init__(self):
+        self.lock = threading.RLock()          # 保护索引内容
+        self.fingerprints = {}                 # 文档键 -> 指纹
+        self.novel_chapters = {}               # 小说ID -> 已索引的章节ID集合
+        self.pending_lock = threading.Lock()   # 保护待更新集合；持有时不获取其它锁
+        self.pending_novels = {}               # 小说ID -> 必须重新索引的章节ID集合（None 表示全部）
+        self.pending_stores = {}               # 库名 -> 条目ID集合（None 表示整个库）
+        self.refresh_lock = threading.Lock()   # 同一时间只有一个线程在重新索引
+        self.wakeup = threading.Event()        # 有待更新的数据时唤醒后台线程
+        self.built = False
+        self.closed = False
+
+    # 标记待更新（请求线程调用，只记录不索引）
+
+    def mark_novel(self, novel_id, content=True, chapters=None):
+        with self.pending_lock:
+            pending = self.pending_novels.get(novel_id, set())
+            if chapters is None or pending is None:
+                pending = None
+            else:
+                pending.update(chapters)
+                if content:
+                    pending.add(None)  # None 表示小说本身（标题与正文）
+            self.pending_novels[novel_id] = pending
+        self.wakeup.set()
+
+    def mark_store(self, store, key=None):
+        if store not in SEARCH_STORES:
+            return
+        with self.pending_lock:
+            pending = self.pending_stores.get(store, set())
+            if key is None or pending is None:
+                self.pending_stores[store] = None
+            else:
+                pending.add(key)
+                self.pending_stores[store] = pending
+        self.wakeup.set()
+
+    def start(self):
+        threading.Thread(target=self.run, name=self.thread_name, daemon=True).start()
+
+    def run(self):
+        """后台线程：建立索引，之后把一段时间内的修改合并为一次更新"""
+        while not self.closed:
+            self.refresh()
+            self.idle()
+            if self.wakeup.wait(self.idle_interval):
+                time.sleep(SEARCH_REFRESH_DELAY)
+                self.wakeup.clear()
+
+    def idle(self):
+        pass
+
+    # 索引维护
+
+    def refresh(self):
+        """建立索引（第一次调用时）并处理所有待更新的小说与条目"""
+        with self.refresh_lock:
+            if not self.built:
+                started = time.perf_counter()
+                # 与已有内容（从磁盘读入的索引）按指纹核对，已删除的小说也要处理
+                with self.lock:
+                    novel_ids = {key[1] for key in self.fingerprints if key[0] == "novel"}
+                with self.pending_lock:
+                    self.pending_novels = {novel_id: set() for novel_id in novel_ids.union(novels_db)}
+                    self.pending_stores = {store: None for store in SEARCH_STORES}
+            while not self.closed:
+                with self.pending_lock:
+                    if not self.pending_novels and not self.pending_stores:
+                        break
+                    novels, self.pending_novels = self.pending_novels, {}
+                    stores, self.pending_stores = self.pending_stores, {}
+                for novel_id, chapters in novels.items():
+                    try:
+                        self.index_novel(novel_id, chapters)
+                    except Exception as e:
+                        logging.error(f"[{self.label}] 索引小说 {novel_id} 失败: {e}")
+                for store, keys in stores.items():
+                    self.index_store(store, keys)
+            if not self.built:
+                self.built = True
+                self.on_built(time.perf_counter() - started)
+
+    def on_built(self, seconds):
+        pass
+
+    def index_novel(self, novel_id, forced):
+        """按当前数据更新一部小说的文档：forced 中的章节（None 表示全部）一律重新索引，
+        其余章节只在 revision 或标题变化时重新索引；小说已删除时移除其全部文档"""
+        updates, removed = [], []
+        with novel_lock(novel_id):
+            if novel_id not in novels_db:
+                removed = [("novel", novel_id)] + [("chapter", novel_id, chapter_id)
+                                                   for chapter_id in self.novel_chapters.get(novel_id, ())]
+            else:
+                meta = novels_db.meta(novel_id)
+                fingerprint = (meta.get("revision", 0), meta.get("title", ""))
+                key = ("novel", novel_id)
+                if forced is None or None in forced or self.fingerprint(key) != fingerprint:
+                    novel = novels_db.peek(novel_id)
+                    updates.append((key, fingerprint, novel.get("title", ""), novel.get("content", "")))
+                chapter_ids = set()
+                for chapter in meta.get("chapters", []):
+                    chapter_ids.add(chapter["id"])
+                    key = ("chapter", novel_id, chapter["id"])
+                    fingerprint = (chapter.get("revision", 0), chapter.get("title", ""))
+                    if forced is None or chapter["id"] in forced or self.fingerprint(key) != fingerprint:
+                        updates.append((key, fingerprint, chapter.get("title", ""),
+                                        novels_db.chapters.peek(novel_id, chapter)))
+                removed = [("chapter", novel_id, chapter_id)
+                           for chapter_id in self.novel_chapters.get(novel_id, set()) - chapter_ids]
+        self.apply(updates, removed)
+
+    def index_store(self, store, keys):
+        """重新索引库中的指定条目（None 表示整个库）中文本有变化的部分，已删除的条目移除"""
+        title_field, body_field = SEARCH_STORES[store]
+        updates, removed = [], []
+        with store_lock(store):
+            entries = library_dbs()[store]
+            if keys is None:
+                with self.lock:
+                    keys = {key[1] for key in self.fingerprints if key[0] == store}
+                keys.update(entries)
+            for entry_id in keys:
+                entry = entries.get(entry_id)
+                if entry is None:
+                    removed.append((store, entry_id))
+                    continue
+                title, body = str(entry.get(title_field, "")), str(entry.get(body_field, ""))
+                fingerprint = zlib.crc32((title + "\n" + body).encode('utf-8'))
+                if self.fingerprint((store, entry_id)) != fingerprint:
+                    updates.append(((store, entry_id), fingerprint, title, body))
+        self.apply(updates, removed)
+
+    def fingerprint(self, key):
+        with self.lock:
+            return self.fingerprints.get(key)
+
+    def apply(self, updates, removed):
+        """prepare 在锁外进行，锁内只修改索引"""
+        prepared = [(key, fingerprint, self.prepare(key, title, body)) for key, fingerprint, title, body in updates]
+        with self.lock:
+            for key in removed:
+                self.remove(key)
+            for key, fingerprint, item in prepared:
+                self.remove(key)
+                self.add(key, item)
+                self.fingerprints[key] = fingerprint
+                if key[0] == "chapter":
+                    self.novel_chapters.setdefault(key[1], set()).add(key[2])
+            self.applied()
+
+    def remove(self, key):
+        self.fingerprints.pop(key, None)
+        self.drop(key)
+        if key[0] == "chapter":
+            chapters = self.novel_chapters.get(key[1])
+            if chapters is not None:
+                chapters.discard(key[2])
+                if not chapters:
+                    del self.novel_chapters[key[1]]
+
+    def prepare(self, key, title, body):
+        raise NotImplementedError
+
+    def add(self, key, item):
+        raise NotImplementedError
+
+    def drop(self, key):
+        raise NotImplementedError
+
+    def applied(self):
+        pass
+
+class SearchIndex(DocumentIndex):
+    """倒排索引"""
+
+    label = "全文索引"
+    thread_name = "search-index"
+
+    def __init__(self):
+        super().__init__()
+        self.terms = {}                        # 词 -> (array 文档号, array 词频)
+        self.docs = {}                         # 文档号 -> (文档键, 词数)
+        self.doc_ids = {}                      # 文档键 -> 文档号
+        self.next_doc = 0
+        self.total_length = 0
+        self.dead = 0                          # 已删除但仍在倒排表中的文档号数量
+
+    # 索引维护
+
+    def on_built(self, seconds):
+        logging.info(f"全文索引建立完成：{len(self.docs)} 个文档，{len(self.terms)} 个词，用时 {seconds:.2f} 秒")
+
+    def prepare(self, key, title, body):
+        return tokenize(title + "\n" + body)
+
+    def add(self, key, counts):
+        doc_id = self.next_doc
+        self.next_doc += 1
+        length = sum(counts.values())
+        self.docs[doc_id] = (key, length)
+        self.doc_ids[key] = doc_id
+        self.total_length += length
+        for term, count in counts.items():
+            postings = self.terms.get(term)
+            if postings is None:
+                postings = self.terms[term] = (array('I'), array('I'))
+            postings[0].append(doc_id)
+            postings[1].append(count)
+
+    def drop(self, key):
+        doc_id = self.doc_ids.pop(key, None)
+        if doc_id is None:
+            return
+        self.total_length -= self.docs.pop(doc_id)[1]
+        self.dead += 1
+
+    def applied(self):
+        if self.dead > max(1000, len(self.docs)):
+            self.compact()
+
+    def compact(self):
+        """从倒排表中去掉已删除的文档号"""
+        docs = self.docs
+        terms = {}
+        for term, (doc_ids, counts) in self.terms.items():
+            kept = [i for i, doc_id in enumerate(doc_ids) if doc_id in docs]
+            if kept:
+                terms[term] = (array('I', [doc_ids[i] for i in kept]), array('I', [counts[i] for i in kept]))
+        self.terms = terms
+        self.dead = 0
+
+    # 检索
+
+    def search(self, query, kinds=None, novel_id=None, limit=20):
+        """返回 (结果列表, 候选文档数)；所有 bigram 与单词都出现的文档才是候选，按 BM25 排序，
+        包含完整检索词的结果排在前面"""
+        self.refresh()
+        counts = tokenize(query)
+        required = [term for term in counts if len(term) <= 2 or WORD_RE.fullmatch(term)]
+        if not required:
+            return None, 0
+        with self.lock:
+            total_docs = len(self.docs) or 1
+            average_length = self.total_length / total_docs or 1
+            postings = []
+            for term in counts:
+                entry = self.terms.get(term)
+                if entry is None:
+                    if term in required:
+                        return [], 0
+                    continue
+                postings.append((term in required, entry))
+            # 从最短的倒排表开始求交集：候选只取自最短的表，较长的表只对剩下的候选二分查找词频（倒排表按
+            # 文档号递增）；表长不超过候选数的 8 倍时直接扫描更快。一次检索的开销与最短的表而不是所有倒排表的总长相当
+            postings.sort(key=lambda item: (not item[0], len(item[1][0])))
+            candidates = None
+            scores = {}
+            for is_required, (doc_ids, term_counts) in postings:
+                if candidates is None:
+                    frequencies = {doc_id: count for doc_id, count in zip(doc_ids, term_counts) if doc_id in self.docs}
+                    candidates = set(frequencies)
+                elif len(doc_ids) <= len(candidates) * 8:
+                    frequencies = {doc_id: count for doc_id, count in zip(doc_ids, term_counts) if doc_id in candidates}
+                    if is_required:
+                        candidates = set(frequencies)
+                else:
+                    frequencies = {}
+                    for doc_id in candidates:
+                        index = bisect.bisect_left(doc_ids, doc_id)
+                        if index < len(doc_ids) and doc_ids[index] == doc_id:
+                            frequencies[doc_id] = term_counts[index]
+                    if is_required:
+                        candidates = set(frequencies)
+                document_frequency = len(doc_ids)
+                idf = math.log(1 + (total_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+                for doc_id, frequency in frequencies.items():
+                    length = self.docs[doc_id][1]
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * 2.2 / (
+                        frequency + 1.2 * (0.25 + 0.75 * length / average_length))
+            ranked = []
+            for doc_id in candidates:
+                key = self.docs[doc_id][0]
+                if kinds and key[0] not in kinds:
+                    continue
+                if novel_id and (key[0] not in ("novel", "chapter") or key[1] != novel_id):
+                    continue
+                ranked.append((scores.get(doc_id, 0.0), key))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+
+        # 只读取排名靠前的文档正文，确认完整检索词的位置并生成摘要
+        phrases = [re.compile(re.escape(part), re.IGNORECASE) for part in query.split()]
+        results = []
+        for score, key in ranked[:max(limit * 3, 30)]:
+            hit = self.describe(key, phrases)
+            if hit is not None:
+                hit["score"] = round(score, 4)
+                results.append(hit)
+        results.sort(key=lambda hit: (not hit["phrase_match"], -hit["score"]))
+        return results[:limit], len(ranked)
+
+    def describe(self, key, phrases):
+        """读取文档当前的标题与正文，返回检索结果（命中位置以正文中的字符计）；文档已删除时返回 None"""
+        kind = key[0]
+        if kind in ("novel", "chapter"):
+            with novel_lock(key[1]):
+                if key[1] not in novels_db:
+                    return None
+                hit = {"type": kind, "novel_id": key[1], "novel_title": novels_db.title(key[1])}
+                if kind == "novel":
+                    novel = novels_db.peek(key[1])
+                    hit.update(id=key[1], title=novel.get("title", ""))
+                    body = novel.get("content", "")
+                else:
+                    chapter = find_chapter(key[1], key[2])
+                    if chapter is None:
+                        return None
+                    hit.update(id=key[2], chapter_id=key[2], title=chapter.get("title", ""))
+                    body = novels_db.chapters.peek(key[1], chapter)
+        else:
+            title_field, body_field = SEARCH_STORES[kind]
+            with store_lock(kind):
+                entry = library_dbs()[kind].get(key[1])
+                if entry is None:
+                    return None
+                hit = {"type": kind, "id": key[1], "title": str(entry.get(title_field, ""))}
+                body = str(entry.get(body_field, ""))
+
+        offsets, lengths = [], {}
+        for phrase in phrases:
+            for match in phrase.finditer(body):
+                offsets.append(match.start())
+                lengths[match.start()] = match.end() - match.start()
+                if len(offsets) >= MAX_HIT_OFFSETS * len(phrases):
+                    break
+        offsets.sort()
+        hit["offsets"] = offsets[:MAX_HIT_OFFSETS]
+        hit["title_match"] = all(phrase.search(hit["title"]) for phrase in phrases)
+        hit["phrase_match"] = hit["title_match"] or all(phrase.search(body) for phrase in phrases)
+        if offsets:
+            start = offsets[0]
+            begin, end = max(0, start - SNIPPET_RADIUS), min(len(body), start + lengths[start] + SNIPPET_RADIUS)
+            snippet = body[begin:end].replace("\r", " ").replace("\n", " ")
+            hit["snippet"] = ("…" if begin > 0 else "") + snippet + ("…" if end < len(body) else "")
+        else:
+            hit["snippet"] = body[:SNIPPET_RADIUS * 2].replace("\r", " ").replace("\n", " ")
+        return hit
+
+    def stats(self):
+        with self.lock:
+            return {"built": self.built, "documents": len(self.docs), "terms": len(self.terms),
+                    "dead_documents": self.dead, "segmenter": "jieba" if jieba is not None else None}
+
+# --- 向量检索 ---
+
+# 按字面相似度查找段落：章节与小说正文按段落切成约 VECTOR_PASSAGE_CHARS 字的片段，角色/词条/风格各为一段；
+# 每段取相邻两字与三字（哈希到 2^VECTOR_FEATURE_BITS 个特征），按次数的对数加权后随机投影（特征哈希）到
+# VECTOR_DIM 维并归一化，所有段落的向量放在一个 float32 矩阵中。查询先用向量的前 VECTOR_PREFIX_DIM 维
+# （单独连续存放，扫描的内存量只有全部维度的几分之一）选出 VECTOR_RESCORE 个候选，再按全部维度重新计分。
+# idf 只加在查询向量上，语料变化不需要重新计算已有段落的向量；文档频率只增不减，
+# 修改累计的段落数超过存活段落的两倍时在后台重新统计。索引保存在 VECTOR_INDEX_FILE，
+# 启动时读入后按指纹只处理变化的文档；后台线程每 VECTOR_SAVE_INTERVAL 秒及退出时写入
+VECTOR_DIM = int(os.environ.get('BMXH_VECTOR_DIM', '256'))
+VECTOR_PREFIX_DIM = min(64, VECTOR_DIM)
+VECTOR_RESCORE = 1000
+VECTOR_FEATURE_BITS = 20
+VECTOR_PASSAGE_CHARS = 400
+VECTOR_SAVE_INTERVAL = 30
+VECTOR_RECOUNT_MIN = 10000  # 修改累计的段落数至少达到这么多才重新统计文档频率
+VECTOR_LIMIT_MAX = 50
+VECTOR_INDEX_FILE = os.path.join(DATA_DIR, 'vectors', 'index.npz')
+VECTOR_FORMAT = 1
+
+NON_WORD_RE = re.compile(r'[\W_]+')
+NGRAM_PRIME = np.uint64(1000003)
+TRIGRAM_SALT = np.uint64(0x5BD1E995)
+FEATURE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+PROJECT_MULTIPLIER = np.uint64(0xC2B2AE3D27D4EB4F)
+
+def ngram_features(text):
+    """文本 -> (特征号数组, 次数数组)；标点与空白视为分隔"""
+    text = NON_WORD_RE.sub(" ", text.lower())
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < 2:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    bigrams = codes[:-1] * NGRAM_PRIME + codes[1:]
+    trigrams = (bigrams[:-1] * NGRAM_PRIME + codes[2:]) ^ TRIGRAM_SALT
+    grams = np.concatenate((bigrams, trigrams)) * FEATURE_MULTIPLIER
+    return np.unique(grams >> np.uint64(64 - VECTOR_FEATURE_BITS), return_counts=True)
+
+def project_features(features, weights):
+    """特征哈希：每个特征按哈希落到一维并带上随机符号，结果归一化"""
+    mixed = features * PROJECT_MULTIPLIER
+    dims = (mixed >> np.uint64(40)) % np.uint64(VECTOR_DIM)
+    signs = np.where((mixed >> np.uint64(39)) & np.uint64(1), -1.0, 1.0)
+    vector = np.bincount(dims.astype(np.intp), weights=weights * signs, minlength=VECTOR_DIM).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def split_passages(text):
+    """按段落切分为约 VECTOR_PASSAGE_CHARS 字的片段，返回 [(起点, 终点)]；过长的段落按字数切开"""
+    spans, start, end = [], 0, 0
+    for line in text.splitlines(keepends=True):
+        end += len(line)
+        if end - start >= VECTOR_PASSAGE_CHARS:
+            while end - start >= VECTOR_PASSAGE_CHARS * 2:
+                spans.append((start, start + VECTOR_PASSAGE_CHARS))
+                start += VECTOR_PASSAGE_CHARS
+            spans.append((start, end))
+            start = end
+    if end > start:
+        if spans and end - start < VECTOR_PASSAGE_CHARS // 4 and end - spans[-1][0] < VECTOR_PASSAGE_CHARS * 2:
+            spans[-1] = (spans[-1][0], end)  # 过短的结尾并入上一段
+        else:
+            spans.append((start, end))
+    return [(start, end) for start, end in spans if text[start:end].strip()]
+
+def passage_text(kind, title, body):
+    """参与向量化的文本：库条目带上标题，小说与章节只用正文"""
+    return body if kind in ("novel", "chapter") else f"{title}\n{body}"
+
+class VectorIndex(DocumentIndex):
+    """段落向量矩阵；行号可复用，空闲行的类型为 -1"""
+
+    label = "向量索引"
+    thread_name = "vector-index"
+    idle_interval = VECTOR_SAVE_INTERVAL
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.vectors = np.zeros((1024, VECTOR_DIM), dtype=np.float32)
+        self.prefix = np.zeros((1024, VECTOR_PREFIX_DIM), dtype=np.float32)  # 向量的前几维
+        self.kinds = np.full(1024, -1, dtype=np.int8)       # 行 -> SEARCH_KINDS 中的序号
+        self.novels = np.full(1024, -1, dtype=np.int32)     # 行 -> 小说编号（库条目为 -1）
+        self.size = 0                  # 用过的行数
+        self.free = []                 # 可复用的空闲行
+        self.rows = []                 # 行 -> (文档键, 起点, 终点)，空闲行为 None
+        self.key_rows = {}             # 文档键 -> [行]
+        self.novel_codes = {}          # 小说ID -> 小说编号
+        self.df = np.zeros(1 << VECTOR_FEATURE_BITS, dtype=np.int32)
+        self.doc_count = 0             # 计入 df 的段落数
+        self.recounting = False        # 正在重新统计文档频率时不写入磁盘
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.save_lock = threading.Lock()
+        self.load()
+
+    # 索引维护
+
+    def on_built(self, seconds):
+        logging.info(f"向量索引就绪：{self.size - len(self.free)} 个段落，用时 {seconds:.2f} 秒")
+
+    def refresh(self):
+        super().refresh()
+        if not self.closed:
+            with self.pending_lock:
+                if not self.pending_novels and not self.pending_stores:
+                    self.recounting = False
+
+    def idle(self):
+        if self.dirty and time.monotonic() - self.saved_at >= VECTOR_SAVE_INTERVAL:
+            self.save()
+
+    def prepare(self, key, title, body):
+        text = passage_text(key[0], title, body)
+        spans, vectors, features = [], [], []
+        for start, end in split_passages(text):
+            ids, counts = ngram_features(text[start:end])
+            if len(ids):
+                spans.append((start, end))
+                vectors.append(project_features(ids, 1 + np.log(counts)))
+                features.append(ids)
+        return spans, vectors, features
+
+    def add(self, key, item):
+        spans, vectors, features = item
+        if not spans:
+            return
+        kind = SEARCH_KINDS.index(key[0])
+        novel = self.novel_codes.setdefault(key[1], len(self.novel_codes)) if key[0] in ("novel", "chapter") else -1
+        rows = []
+        for (start, end), vector in zip(spans, vectors):
+            row = self.free.pop() if self.free else self.allocate()
+            self.vectors[row] = vector
+            self.prefix[row] = vector[:VECTOR_PREFIX_DIM]
+            self.kinds[row] = kind
+            self.novels[row] = novel
+            self.rows[row] = (key, start, end)
+            rows.append(row)
+        self.key_rows[key] = rows
+        features, counts = np.unique(np.concatenate(features), return_counts=True)
+        self.df[features.astype(np.intp)] += counts.astype(np.int32)
+        self.doc_count += len(spans)
+        self.dirty = True
+
+    def allocate(self):
+        if self.size == len(self.kinds):
+            self.vectors = np.concatenate((self.vectors, np.zeros_like(self.vectors)))
+            self.prefix = np.concatenate((self.prefix, np.zeros_like(self.prefix)))
+            self.kinds = np.concatenate((self.kinds, np.full_like(self.kinds, -1)))
+            self.novels = np.concatenate((self.novels, np.full_like(self.novels, -1)))
+        self.rows.append(None)
+        self.size += 1
+        return self.size - 1
+
+    def drop(self, key):
+        for row in self.key_rows.pop(key, ()):
+            self.kinds[row] = -1
+            self.rows[row] = None
+            self.free.append(row)
+            self.dirty = True
+
+    def applied(self):
+        live = self.size - len(self.free)
+        if self.doc_count > 2 * live + VECTOR_RECOUNT_MIN:
+            # 旧段落仍计在文档频率中：清零后重新处理全部文档（向量本身不受影响）
+            logging.info(f"[向量索引] 重新统计文档频率：{live} 个段落")
+            novel_ids = {key[1] for key in self.fingerprints if key[0] in ("novel", "chapter")}
+            self.df[:] = 0
+            self.doc_count = 0
+            self.fingerprints.clear()
+            self.recounting = True
+            for novel_id in novel_ids:
+                self.mark_novel(novel_id)
+            for store in SEARCH_STORES:
+                self.mark_store(store)
+
+    # 查询
+
+    def query(self, text, limit=10, kinds=None, novel_id=None, exclude=()):
+        """返回与 text 最相似的段落 [(分数, 文档键, 起点, 终点)]，分数为余弦相似度；
+        exclude 为 [(文档键, 起点, 终点)]，与其重叠的段落不参与排序（起点为 None 时排除整个文档）"""
+        self.refresh()
+        features, counts = ngram_features(text)
+        if not len(features):
+            return []
+        with self.lock:
+            n = self.size
+            idf = np.log((self.doc_count + 1) / (self.df[features.astype(np.intp)] + 1.0)) + 1
+            vector = project_features(features, (1 + np.log(counts)) * idf)
+            row_kinds = self.kinds[:n]
+            # 按类型查表，最后一项对应空闲行（类型 -1）
+            allowed = np.array([not kinds or kind in kinds for kind in SEARCH_KINDS] + [False])
+            mask = allowed[row_kinds]
+            if novel_id is not None:
+                mask &= self.novels[:n] == self.novel_codes.get(novel_id, -2)
+            for key, start, end in exclude:
+                for row in self.key_rows.get(key, ()):
+                    if start is None or (self.rows[row][1] < end and start < self.rows[row][2]):
+                        mask[row] = False
+            candidates = np.flatnonzero(mask)
+            if len(candidates) > VECTOR_RESCORE:
+                coarse = self.prefix[:n] @ vector[:VECTOR_PREFIX_DIM]
+                coarse[~mask] = -np.inf
+                candidates = np.argpartition(coarse, n - VECTOR_RESCORE)[-VECTOR_RESCORE:]
+            scores = self.vectors[candidates] @ vector
+            top = np.argsort(-scores, kind='stable')[:limit]
+            return [(round(float(scores[i]), 4),) + self.rows[candidates[i]] for i in top]
+
+    def describe(self, key, start, end):
+        """读取段落当前的文本，返回结果字典；文档已删除时返回 None"""
+        kind = key[0]
+        if kind in ("novel", "chapter"):
+            with novel_lock(key[1]):
+                if key[1] not in novels_db:
+                    return None
+                hit = {"type": kind, "novel_id": key[1], "novel_title": novels_db.title(key[1])}
+                if kind == "novel":
+                    hit.update(id=key[1], title=novels_db.title(key[1]))
+                    body = novels_db.peek(key[1]).get("content", "")
+                else:
+                    chapter = find_chapter(key[1], key[2])
+                    if chapter is None:
+                        return None
+                    hit.update(id=key[2], chapter_id=key[2], title=chapter.get("title", ""))
+                    body = novels_db.chapters.peek(key[1], chapter)
+            hit.update(start=start, end=end)
+        else:
+            title_field, body_field = SEARCH_STORES[kind]
+            with store_lock(kind):
+                entry = library_dbs()[kind].get(key[1])
+                if entry is None:
+                    return None
+                hit = {"type": kind, "id": key[1], "title": str(entry.get(title_field, ""))}
+                body = passage_text(kind, hit["title"], str(entry.get(body_field, "")))
+        hit["text"] = body[start:end]
+        return hit
+
+    # 持久化
+
+    def save(self):
+        """把索引写入 self.path（先写临时文件再替换）"""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty or self.recounting or not self.built:
+                    return
+                n = self.size
+                arrays = {"vectors": self.vectors[:n].astype(np.float16), "kinds": self.kinds[:n].copy(),
+                          "novels": self.novels[:n].copy(), "df": self.df.copy()}
+                meta = {"format": VECTOR_FORMAT, "dim": VECTOR_DIM, "feature_bits": VECTOR_FEATURE_BITS,
+                        "backend": STORAGE_BACKEND, "doc_count": self.doc_count, "rows": self.rows,
+                        "fingerprints": list(self.fingerprints.items()), "novel_codes": self.novel_codes}
+                self.dirty = False
+                self.saved_at = time.monotonic()
+            arrays["meta"] = np.frombuffer(json_dumps(meta).encode('utf-8'), dtype=np.uint8)
+            temp_path = self.path + ".tmp"
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(temp_path, 'wb') as f:
+                    np.savez(f, **arrays)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logging.error(f"[向量索引] 写入 {self.path} 失败: {e}")
+                self.dirty = True
+
+    def load(self):
+        """读入 self.path 中的索引；格式或参数不一致时忽略，之后由 refresh 重新建立"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                meta = json_loads(data["meta"].tobytes())
+                expected = {"format": VECTOR_FORMAT, "dim": VECTOR_DIM, "feature_bits": VECTOR_FEATURE_BITS,
+                            "backend": STORAGE_BACKEND}
+                if any(meta.get(name) != value for name, value in expected.items()):
+                    logging.info("[向量索引] 磁盘上的索引参数不同，重新建立")
+                    return
+                vectors, kinds, novels, df = data["vectors"], data["kinds"], data["novels"], data["df"]
+        except Exception as e:
+            logging.error(f"[向量索引] 读取 {self.path} 失败，重新建立: {e}")
+            return
+        n = len(kinds)
+        capacity = max(1024, 1 << n.bit_length())
+        self.vectors = np.zeros((capacity, VECTOR_DIM), dtype=np.float32)
+        self.vectors[:n] = vectors
+        self.prefix = np.zeros((capacity, VECTOR_PREFIX_DIM), dtype=np.float32)
+        self.prefix[:n] = self.vectors[:n, :VECTOR_PREFIX_DIM]
+        self.kinds = np.full(capacity, -1, dtype=np.int8)
+        self.kinds[:n] = kinds
+        self.novels = np.full(capacity, -1, dtype=np.int32)
+        self.novels[:n] = novels
+        self.df = df.astype(np.int32)
+        self.doc_count = meta["doc_count"]
+        self.size = n
+        self.novel_codes = meta["novel_codes"]
+        for row, item in enumerate(meta["rows"]):
+            if item is None:
+                self.rows.append(None)
+                self.free.append(row)
+            else:
+                key = tuple(item[0])
+                self.rows.append((key, item[1], item[2]))
+                self.key_rows.setdefault(key, []).append(row)
+        for key, fingerprint in meta["fingerprints"]:
+            key = tuple(key)
+            self.fingerprints[key] = tuple(fingerprint) if isinstance(fingerprint, list) else fingerprint
+            if key[0] == "chapter":
+                self.novel_chapters.setdefault(key[1], set()).add(key[2])
+        logging.info(f"[向量索引] 读入 {n - len(self.free)} 个段落")
+
+    def stats(self):
+        with self.lock:
+            return {"built": self.built, "passages": self.size - len(self.free), "rows": self.size,
+                    "documents": len(self.fingerprints), "dim": VECTOR_DIM,
+                    "memory_mb": round((self.vectors.nbytes + self.prefix.nbytes) / 1024 / 1024, 1)}
+
+# --- 实体识别 ---
+
+# 用 Aho-Corasick 自动机一次扫描找出文本中出现的全部词条名（glossary 的 term）与角色名（characters 的 name）。
+# 自动机建立后只读：库修改时新出现的名称放入一个小的增量自动机，删除或改名由匹配结果与当前名称表
+# 比对过滤；增量超过主自动机的 1/8（至少 ENTITY_EXTRA_MAX 个）时才整体重建。英文字母不区分大小写，
+# 以字母或数字开头/结尾的名称要求在单词边界上；多个名称重叠时取最靠左、最长的一个
+ENTITY_STORES = {"characters": "name", "glossary": "term"}
+ENTITY_MIN_LENGTH = 2
+ENTITY_EXTRA_MAX = 256
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def normalize_entity_text(text):
+    """只转换 ASCII 大写字母，保证字符位置不变"""
+    return text.translate(ASCII_LOWER)
+
+class Automaton:
+    """只读的 Aho-Corasick 自动机"""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        goto, output = [{}], [()]
+        for pattern_id, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = goto[state][char] = len(goto)
+                    goto.append({})
+                    output.append(())
+                state = next_state
+            output[state] += (pattern_id,)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                target = fail[state]
+                while target and char not in goto[target]:
+                    target = fail[target]
+                fail[next_state] = goto[target].get(char, 0)
+                output[next_state] += output[fail[next_state]]
+        self.goto, self.fail, self.output = goto, fail, output
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def find(self, text):
+        """返回 [(起点, 终点, 模式串)]，包括相互重叠的出现"""
+        goto, fail, output, patterns = self.goto, self.fail, self.output, self.patterns
+        found = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for pattern_id in output[state]:
+                    pattern = patterns[pattern_id]
+                    found.append((end - len(pattern), end, pattern))
+        return found
+
+def is_word_char(char):
+    return char.isascii() and char.isalnum()
+
+class EntityMatcher:
+    """文本中出现的角色与词条；库的修改由 schedule_store_save 标记，下一次匹配前合并"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}           # 规范化的名称 -> {(库名, 条目ID)}
+        self.entry_names = {}     # (库名, 条目ID) -> 规范化的名称
+        self.base = Automaton(())
+        self.extra = Automaton(())
+        self.pending = {}         # 库名 -> 条目ID集合（None 表示整个库）
+        self.refresh_lock = threading.Lock()  # 同一时间只有一个线程合并修改
+        self.built = False
+
+    def mark_store(self, store, key=None):
+        if store not in ENTITY_STORES:
+            return
+        with self.lock:
+            pending = self.pending.get(store, set())
+            if key is None or pending is None:
+                self.pending[store] = None
+            else:
+                pending.add(key)
+                self.pending[store] = pending
+
+    def refresh(self):
+        with self.refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        with self.lock:
+            if not self.built:
+                self.pending = {store: None for store in ENTITY_STORES}
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        changes = []
+        for store, keys in pending.items():
+            field = ENTITY_STORES[store]
+            with store_lock(store):
+                entries = library_dbs()[store]
+                if keys is None:
+                    with self.lock:
+                        keys = {key[1] for key in self.entry_names if key[0] == store}
+                    keys.update(entries)
+                for entry_id in keys:
+                    entry = entries.get(entry_id)
+                    name = normalize_entity_text(str(entry.get(field) or "").strip()) if entry is not None else ""
+                    changes.append(((store, entry_id), name if len(name) >= ENTITY_MIN_LENGTH else None))
+        with self.lock:
+            added = []
+            for key, name in changes:
+                old = self.entry_names.pop(key, None)
+                if old is not None:
+                    owners = self.names.get(old)
+                    owners.discard(key)
+                    if not owners:
+                        del self.names[old]
+                if name is not None:
+                    self.entry_names[key] = name
+                    if name not in self.names:
+                        added.append(name)
+                    self.names.setdefault(name, set()).add(key)
+            known = set(self.base.patterns)
+            extra = [name for name in self.extra.patterns if name in self.names]
+            extra = list(dict.fromkeys(extra + [name for name in added if name not in known]))
+            if not self.built or len(extra) > max(ENTITY_EXTRA_MAX, len(self.base) // 8):
+                started = time.perf_counter()
+                self.base = Automaton(self.names)
+                self.extra = Automaton(())
+                logging.info(f"实体自动机已重建：{len(self.names)} 个名称，"
+                             f"用时 {time.perf_counter() - started:.2f} 秒")
+            elif added or len(extra) != len(self.extra):
+                self.extra = Automaton(extra)
+            self.built = True
+
+    def match(self, text):
+        """返回不重叠的命中 [(起点, 终点, [(库名, 条目ID)...])]，按位置排序"""
+        self.refresh()
+        with self.lock:
+            base, extra, names = self.base, self.extra, self.names
+        normalized = normalize_entity_text(text)
+        found = base.find(normalized) + extra.find(normalized)
+        # 最靠左、最长优先，跳过与已选命中重叠的
+        found.sort(key=lambda item: (item[0], item[0] - item[1]))
+        spans = []
+        last_end = 0
+        with self.lock:
+            for start, end, name in found:
+                if start < last_end or name not in names:
+                    continue
+                if is_word_char(name[0]) and start > 0 and is_word_char(text[start - 1]):
+                    continue
+                if is_word_char(name[-1]) and end < len(text) and is_word_char(text[end]):
+                    continue
+                spans.append((start, end, sorted(names[name])))
+                last_end = end
+        return spans
+
+    def stats(self):
+        with self.lock:
+            return {"names": len(self.names), "base_patterns": len(self.base), "extra_patterns": len(self.extra)}
+
+# --- 后台写入调度 ---
+
+# 合并写入窗口（秒）：最后一次修改后等待这么久再落盘；设为 0 时每次修改都同步写入
+SAVE_DELAY = float(os.environ.get('BMXH_SAVE_DELAY', '1.0'))
+# 最长未落盘时间（秒）：持续修改时也保证在这个时间内写入一次
+SAVE_MAX_DELAY = float(os.environ.get('BMXH_SAVE_MAX_DELAY', '5.0'))
+
+STORE_LABELS = {
+    "characters": "个角色",
+    "glossary": "个词条",
+    "styles": "个风格词条",
+    "games": "个游戏记录",
+    "api_configs": "个自定义API配置",
+    "routes": "个模型路由组",
+}
+
+class SaveScheduler:
+    """后台写入调度器：请求线程只标记哪些数据需要保存，后台线程把一段时间内的
+    多次修改合并为一次写入，请求不再等待序列化和磁盘 I/O"""
+
+    def __init__(self, delay, max_delay):
+        self.delay = delay
+        self.max_delay = max(max_delay, delay)
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.novels = {}     # novel_id -> [是否重写正文, 需要重写的章节ID集合（None 表示全部）]
+        self.writing = set() # 正在写入的小说ID
+        self.stores = {}     # 库名 -> 需要写入的条目ID集合（None 表示整体写入）
+        self.first_dirty = None
+        self.last_dirty = None
+        self.thread = None
+        self.stopped = False
+
+    def mark_novel(self, novel_id, content=False, chapters=()):
+        with self.cond:
+            pending = self.novels.setdefault(novel_id, [False, set()])
+            pending[0] = pending[0] or content
+            if chapters is None or pending[1] is None:
+                pending[1] = None
+            else:
+                pending[1].update(chapters)
+            self._touch()
+
+    def mark_store(self, store, keys=None):
+        with self.cond:
+            if keys is None or (store in self.stores and self.stores[store] is None):
+                self.stores[store] = None
+            else:
+                self.stores.setdefault(store, set()).update(keys)
+            self._touch()
+
+    def is_novel_pending(self, novel_id):
+        """小说是否有尚未写入的修改（包括正在写入的）"""
+        with self.cond:
+            return novel_id in self.novels or novel_id in self.writing
+
+    def pending_count(self):
+        with self.cond:
+            return len(self.novels) + len(self.stores)
+
+    def _touch(self):
+        now = time.monotonic()
+        if self.first_dirty is None:
+            self.first_dirty = now
+        self.last_dirty = now
+        if self.delay > 0 and not self.stopped and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self._run, name="save-scheduler", daemon=True)
+            self.thread.start()
+        self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopped and self.first_dirty is None:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                due = min(self.last_dirty + self.delay, self.first_dirty + self.max_delay)
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+            self.flush()
+
+    def flush(self, lock_timeout=None):
+        """立即写入所有待保存的数据，返回是否全部成功；失败的部分会留待下次重试。
+        正被请求线程修改的小说/库（lock_timeout 秒内拿不到锁）重新排队，不算失败"""
+        if lock_timeout is None:
+            lock_timeout = SAVE_LOCK_TIMEOUT if self.delay > 0 else 0
+        with self.flush_lock:
+            with self.cond:
+                novels, stores = self.novels, self.stores
+                self.novels, self.stores = {}, {}
+                self.writing = set(novels)
+                self.first_dirty = self.last_dirty = None
+            ok = True
+            written = {}
+            for novel_id, (content, chapters) in novels.items():
+                result = write_novel(novel_id, content, chapters, lock_timeout)
+                if result:
+                    written[novel_id] = chapters
+                else:
+                    ok = ok and result is None
+                    self.mark_novel(novel_id, content, chapters)
+            for store, keys in stores.items():
+                result = write_store(store, keys, lock_timeout)
+                if not result:
+                    ok = ok and result is None
+                    self.mark_store(store, keys)
+            if (novels or stores) and not commit_storage():
+                # 本批记录未能确认落盘，整批重新排队
+                ok = False
+                written = {}
+                for novel_id, (content, chapters) in novels.items():
+                    self.mark_novel(novel_id, content, chapters)
+                for store, keys in stores.items():
+                    self.mark_store(store, keys)
+            with self.cond:
+                self.writing = set()
+            if written:
+                novels_db.mark_saved(written)
+                novels_db.chapters.mark_saved(written)
+            if novels or stores:
+                logging.info(f"后台写入完成: {len(novels)} 部小说, {len(stores)} 个库" + ("" if ok else "（部分失败，稍后重试）"))
+            return ok
+
+    def stop(self):
+        """停止后台线程并写入剩余数据（进程退出时调用），随后把日志压缩为快照"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        ok = self.flush(lock_timeout=SAVE_LOCK_TIMEOUT)
+        for backend in {id(storage): storage, id(settings_storage): settings_storage}.values():
+            try:
+                backend.close()
+            except Exception as e:
+                logging.error(f"关闭存储出错: {e}")
+        return ok
+
+def write_novel(novel_id, content=False, chapters=(), lock_timeout=SAVE_LOCK_TIMEOUT):
+    """把单部小说写入存储后端；小说已被删除时移除其存储。
+    返回是否成功，小说正被修改（拿不到锁）时返回 None"""
+    lock = novel_lock(novel_id)
+    if not lock.acquire(timeout=lock_timeout):
+        return None
+    try:
+        ok = storage.save_novel(novel_id, novels_db.get(novel_id), content=content, chapters=chapters)
+    finally:
+        lock.release()
+    if ok and novel_id not in novels_db:
+        logging.info(f"已删除小说存储: {novel_id}")
+    return ok
+
+def write_store(store, keys=None, lock_timeout=SAVE_LOCK_TIMEOUT):
+    """把一个库（或 API 配置、API 密钥、路由组）写入存储；返回值同 write_novel"""
+    lock = store_lock(store)
+    if not lock.acquire(timeout=lock_timeout):
+        return None
     try:
-        with open(GAMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(games_db, f, ensure_ascii=False, indent=2)
-        print(f"成功保存了 {len(games_db)} 个游戏记录。")
+        if store == "api_key":
+            settings_storage.save_library(store, {"api_key": OPENROUTER_API_KEY}, keys)
+            logging.info("成功保存了API密钥。")
+            return True
+        if store in ("api_configs", "routes"):
+            entries = CUSTOM_API_CONFIGS if store == "api_configs" else ROUTE_GROUPS
+            settings_storage.save_library(store, entries, keys)
+        else:
+            entries = library_dbs()[store]
+            storage.save_library(store, entries, keys)
+        logging.info(f"成功保存了 {len(entries)} {STORE_LABELS[store]}。")
         return True
     except Exception as e:
-        print(f"保存游戏数据出错: {e}")
+        logging.error(f"保存{store}数据出错: {e}")
         return False
+    finally:
+        lock.release()
 
-def save_api_configs():
-    """保存自定义API配置到文件"""
+def commit_storage():
+    """组提交：一批写入之后每个日志只 fsync 一次"""
     try:
-        with open(API_CONFIGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(CUSTOM_API_CONFIGS, f, ensure_ascii=False, indent=2)
-        print(f"成功保存了 {len(CUSTOM_API_CONFIGS)} 个自定义API配置。")
+        storage.commit()
+        if settings_storage is not storage:
+            settings_storage.commit()
         return True
     except Exception as e:
-        print(f"保存自定义API配置出错: {e}")
+        logging.error(f"提交存储日志出错: {e}")
         return False
 
+save_scheduler = SaveScheduler(SAVE_DELAY, SAVE_MAX_DELAY)
+
+def flush_saves():
+    """立即写入所有待保存的数据"""
+    return save_scheduler.flush()
+
+def schedule_store_save(store, key=None):
+    bump_store_version(store)
+    search_index.mark_store(store, key)
+    vector_index.mark_store(store, key)
+    entity_matcher.mark_store(store, key)
+    save_scheduler.mark_store(store, None if key is None else [key])
+    return flush_saves() if SAVE_DELAY <= 0 else True
+
+# 保存数据到文件（标记为待保存，由后台线程合并写入）
+def save_novel(novel_id, content=False, chapters=()):
+    """保存单部小说发生变化的部分；小说已被删除时移除其存储"""
+    save_scheduler.mark_novel(novel_id, content=content, chapters=chapters)
+    search_index.mark_novel(novel_id, content=content, chapters=chapters)
+    vector_index.mark_novel(novel_id, content=content, chapters=chapters)
+    return flush_saves() if SAVE_DELAY <= 0 else True
+
+def save_novels():
+    """保存全部小说数据"""
+    for novel_id in list(novels_db):
+        save_scheduler.mark_novel(novel_id, content=True, chapters=None)
+        search_index.mark_novel(novel_id)
+        vector_index.mark_novel(novel_id)
+    return flush_saves() if SAVE_DELAY <= 0 else True
+
+def save_characters(character_id=None):
+    """保存角色数据（SQLite 后端下只写入指定的一行）"""
+    return schedule_store_save("characters", character_id)
+
+def save_glossary(entry_id=None):
+    """保存词条数据"""
+    return schedule_store_save("glossary", entry_id)
+
+def save_styles(style_id=None):
+    """保存风格数据"""
+    return schedule_store_save("styles", style_id)
+
+def save_games(game_id=None):
+    """保存游戏数据"""
+    return schedule_store_save("games", game_id)
+
+def save_api_configs(api_id=None):
+    """保存自定义API配置到文件"""
+    return schedule_store_save("api_configs", api_id)
+
+def save_routes(group_id=None):
+    """保存模型路由组到文件"""
+    return schedule_store_save("routes", group_id)
+
 def save_api_key():
     """保存OpenRouter API密钥到文件"""
-    try:
-        with open(API_KEY_FILE, 'w', encoding='utf-8') as f:
-            json.dump({"api_key": OPENROUTER_API_KEY}, f, ensure_ascii=False, indent=2)
-        print("成功保存了API密钥。")
-        return True
-    except Exception as e:
-        print(f"保存API密钥出错: {e}")
-        return False
+    return schedule_store_save("api_key")
+
+def save_vector_index():
+    if vector_index is not None:
+        vector_index.save()
+
+def install_shutdown_hooks():
+    """进程退出或收到终止信号时写入剩余数据与向量索引；收到 SIGUSR1 时立即写入但不退出"""
+    atexit.register(save_scheduler.stop)
+    atexit.register(save_vector_index)
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def handle_exit_signal(signum, frame):
+        logging.info(f"收到信号 {signum}，正在保存未写入的数据...")
+        save_scheduler.stop()
+        previous = previous_handlers.get(signum)
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            sys.exit(0)
+
+    previous_handlers = {}
+    for name in ("SIGTERM", "SIGBREAK", "SIGHUP"):
+        signum = getattr(signal, name, None)
+        if signum is not None:
+            previous_handlers[signum] = signal.signal(signum, handle_exit_signal)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: flush_saves())
 
 # 在应用启动时加载数据
 load_data()
+install_shutdown_hooks()
 
 # --- Helper Functions ---
 
@@ -366,6 +2830,1556 @@ def get_available_models():
     #     print(f"An unexpected error occurred while fetching models: {e}")
     #     return None
 
+# --- 正文增量更新 ---
+
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def apply_text_ops(text, ops):
+    """按插入/删除操作修改文本。
+
+    每个操作形如 {"pos": 起点, "delete": 删除字符数, "insert": 插入文本}，
+    位置按 Unicode 字符计算，且都相对于修改前的原文，操作之间不能重叠。
+    """
+    if not isinstance(ops, list):
+        raise ValueError("ops 必须是数组")
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ValueError("每个操作必须是对象")
+        pos, delete, insert = op.get("pos"), op.get("delete", 0), op.get("insert", "")
+        if type(pos) is not int or type(delete) is not int or pos < 0 or delete < 0:
+            raise ValueError("pos 和 delete 必须是非负整数")
+        if not isinstance(insert, str):
+            raise ValueError("insert 必须是字符串")
+    pieces = []
+    cursor = 0
+    for op in sorted(ops, key=lambda op: op["pos"]):
+        pos, delete = op["pos"], op.get("delete", 0)
+        if pos < cursor or pos + delete > len(text):
+            raise ValueError(f"操作位置越界或互相重叠: pos={pos}")
+        pieces.append(text[cursor:pos])
+        pieces.append(op.get("insert", ""))
+        cursor = pos + delete
+    pieces.append(text[cursor:])
+    return "".join(pieces)
+
+def apply_unified_diff(text, diff):
+    """把 unified diff（按行）应用到文本上，上下文或删除行与原文不符时报错"""
+    if not isinstance(diff, str):
+        raise ValueError("diff 必须是字符串")
+    lines = text.splitlines(keepends=True)
+    diff_lines = diff.splitlines(keepends=True)
+    result = []
+    pos = 0
+    i = 0
+    while i < len(diff_lines):
+        header = HUNK_HEADER_RE.match(diff_lines[i])
+        i += 1
+        if not header:
+            continue  # 跳过 ---/+++ 文件头
+        old_start = int(header.group(1))
+        old_len = int(header.group(2) or 1)
+        new_len = int(header.group(4) or 1)
+        start = old_start - 1 if old_len else old_start
+        if start < pos or start > len(lines):
+            raise ValueError(f"补丁块位置无效: {diff_lines[i - 1].strip()}")
+        result.extend(lines[pos:start])
+        pos = start
+        old_seen = new_seen = 0
+        last_tag = None
+        while i < len(diff_lines) and not diff_lines[i].startswith('@@'):
+            line = diff_lines[i]
+            i += 1
+            tag, body = line[:1], line[1:]
+            if tag == '\\':
+                # "\ No newline at end of file"：上一行没有换行符
+                if last_tag in (' ', '+') and result:
+                    result[-1] = result[-1].rstrip('\r\n')
+                continue
+            if tag in (' ', '-'):
+                if pos >= len(lines) or lines[pos].rstrip('\r\n') != body.rstrip('\r\n'):
+                    raise ValueError(f"补丁与原文第 {pos + 1} 行不一致")
+                if tag == ' ':
+                    result.append(lines[pos])
+                    new_seen += 1
+                pos += 1
+                old_seen += 1
+            elif tag == '+':
+                result.append(body)
+                new_seen += 1
+            elif line.strip():
+                raise ValueError(f"无法识别的补丁行: {line.strip()}")
+            last_tag = tag
+        if old_seen != old_len or new_seen != new_len:
+            raise ValueError("补丁块的行数与块头不一致")
+    result.extend(lines[pos:])
+    return "".join(result)
+
+def apply_content_patch(text, data):
+    """根据请求体（ops 或 diff）计算补丁后的正文"""
+    if "ops" in data:
+        return apply_text_ops(text, data["ops"])
+    if "diff" in data:
+        return apply_unified_diff(text, data["diff"])
+    raise ValueError("请求需要提供 ops 或 diff")
+
+def patch_content(target, data, content):
+    """对小说或章节的正文 content 应用补丁，返回 (响应体, 状态码, 新正文)；
+    成功时递增 target 的 revision，新正文由调用方写回。
+
+    base_revision 与当前 revision 不一致时返回 409，客户端需重新获取正文后再提交。
+    """
+    base_revision = data.get("base_revision")
+    if type(base_revision) is not int:
+        return {"error": "base_revision 必须是整数"}, 400, None
+    revision = target.get("revision", 0)
+    if base_revision != revision:
+        return {"error": "内容已被修改，请重新获取后再提交", "revision": revision}, 409, None
+    try:
+        content = apply_content_patch(content, data)
+    except ValueError as e:
+        return {"error": f"补丁无效: {e}"}, 400, None
+    target["revision"] = revision + 1
+    return {"revision": target["revision"], "length": len(content)}, 200, content
+
+# --- 章节索引 ---
+
+# 章节的 order 是稀疏的排序键：移动或插入章节时取相邻两章的中间值，
+# 只有相邻键之间没有空隙时才整体重新编号
+CHAPTER_ORDER_STEP = 1024
+
+def chapter_index(novel_id):
+    """返回小说的 章节id -> 章节 字典。
+    索引保存在 Novel 对象上并与 chapters 列表对象绑定：列表被整体替换（导入、重排）
+    或增删未经索引时会自动重建，小说换出缓存时随之释放"""
+    novel = novels_db[novel_id]
+    chapter_list = novel.setdefault("chapters", [])
+    cached = getattr(novel, "chapter_index", None)
+    if cached is None or cached[0] is not chapter_list or len(cached[1]) != len(chapter_list):
+        cached = novel.chapter_index = (chapter_list, {chapter["id"]: chapter for chapter in chapter_list})
+    return cached[1]
+
+def find_chapter(novel_id, chapter_id):
+    return chapter_index(novel_id).get(chapter_id)
+
+def chapter_position(chapter_list, chapter):
+    """章节在列表中的下标：order 递增时二分查找，否则顺序查找"""
+    order = chapter.get("order", 0)
+    lo, hi = 0, len(chapter_list)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if chapter_list[mid].get("order", 0) < order:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(chapter_list) and chapter_list[lo] is chapter:
+        return lo
+    return next(i for i, ch in enumerate(chapter_list) if ch is chapter)
+
+def renumber_chapters(chapter_list):
+    for i, chapter in enumerate(chapter_list):
+        chapter["order"] = i * CHAPTER_ORDER_STEP
+
+def assign_chapter_order(chapter_list, i):
+    """为位于下标 i 的章节取一个介于前后两章之间的 order，返回 order 被修改的章节"""
+    prev_order = chapter_list[i - 1].get("order", 0) if i > 0 else None
+    next_order = chapter_list[i + 1].get("order", 0) if i + 1 < len(chapter_list) else None
+    if prev_order is None and next_order is None:
+        order = 0
+    elif prev_order is None:
+        order = next_order - CHAPTER_ORDER_STEP
+    elif next_order is None:
+        order = prev_order + CHAPTER_ORDER_STEP
+    elif next_order - prev_order >= 2:
+        order = (prev_order + next_order) // 2
+    else:
+        renumber_chapters(chapter_list)
+        return list(chapter_list)
+    chapter_list[i]["order"] = order
+    return [chapter_list[i]]
+
+def insert_chapter(novel_id, chapter, index=None):
+    """把新章节插入到下标 index（默认末尾），返回 order 被修改的章节"""
+    chapter_list = novels_db[novel_id].setdefault("chapters", [])
+    index = len(chapter_list) if index is None else max(0, min(index, len(chapter_list)))
+    chapter_list.insert(index, chapter)
+    chapter_index(novel_id)[chapter["id"]] = chapter
+    return assign_chapter_order(chapter_list, index)
+
+def move_chapter(novel_id, chapter, index):
+    """把章节移动到下标 index，返回 order 被修改的章节"""
+    chapter_list = novels_db[novel_id]["chapters"]
+    chapter_list.pop(chapter_position(chapter_list, chapter))
+    index = max(0, min(index, len(chapter_list)))
+    chapter_list.insert(index, chapter)
+    return assign_chapter_order(chapter_list, index)
+
+def remove_chapter(novel_id, chapter):
+    """删除章节，其余章节的 order 保持不变"""
+    chapter_list = novels_db[novel_id]["chapters"]
+    chapter_list.pop(chapter_position(chapter_list, chapter))
+    chapter_index(novel_id).pop(chapter["id"], None)
+    novels_db.chapters.forget(novel_id, chapter["id"])
+
+# --- 上游 HTTP 连接 ---
+
+# 调用 OpenRouter 与自定义 API 共用一个 requests.Session：每个主机一个连接池，连接在请求之间保持 keep-alive，
+# 生成时不必每次重新做 DNS 查询与 TCP/TLS 握手。启动时（以及修改 API 密钥或自定义 API 配置后）在后台
+# 预先连上已配置的服务。所有请求都带连接超时与读取超时（流式请求的读取超时是两次收到数据之间的最长间隔）
+UPSTREAM_POOL_HOSTS = int(os.environ.get('BMXH_UPSTREAM_POOL_HOSTS', '10'))  # 保留连接池的主机数
+UPSTREAM_POOL_SIZE = int(os.environ.get('BMXH_UPSTREAM_POOL_SIZE', '10'))  # 每个主机保留的空闲连接数
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('BMXH_UPSTREAM_CONNECT_TIMEOUT', '10'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('BMXH_UPSTREAM_READ_TIMEOUT', '120'))
+UPSTREAM_WARMUP = os.environ.get('BMXH_UPSTREAM_WARMUP', '1') != '0'
+UPSTREAM_DRAIN_BYTES = 64 * 1024  # 流提前结束时最多再读这么多剩余数据，以便把连接还给连接池
+
+def create_upstream_session():
+    session = requests.Session()
+    # 只在连接失败（请求还没有发出）时重试一次，POST 不会被重复发送
+    retry = Retry(total=1, connect=1, read=0, status=0, redirect=0, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=UPSTREAM_POOL_HOSTS, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # 多个线程共用会话，不保存上游设置的 cookie
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+upstream_session = create_upstream_session()
+logging.getLogger('urllib3').setLevel(logging.ERROR)  # 连接失败的重试由下面的日志记录
+
+def upstream_post(url, **kwargs):
+    """经连接池发送 POST；未指定 timeout 时使用默认的连接/读取超时"""
+    kwargs.setdefault('timeout', (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    return upstream_session.post(url, **kwargs)
+
+def stream_lines(response):
+    """同 response.iter_lines()；调用方提前结束迭代（如收到 finish_reason）时先读掉剩余的少量数据，
+    连接才能回到连接池复用（直接丢弃未读完的迭代器会关闭连接）"""
+    lines = response.iter_lines()
+    try:
+        for line in lines:
+            yield line
+    finally:
+        remaining = UPSTREAM_DRAIN_BYTES
+        try:
+            # 调用方已关闭响应（如被取消的对冲请求）时不再读取
+            for line in (() if response.raw.closed else lines):
+                remaining -= len(line) + 1
+                if remaining <= 0:
+                    break
+        except requests.exceptions.RequestException:
+            pass
+
+def upstream_origins(urls=None):
+    """服务地址 -> 去重后的 scheme://host/；默认为设置了密钥时的 OpenRouter 与各自定义 API"""
+    if urls is None:
+        urls = [OPENROUTER_API_BASE] if OPENROUTER_API_KEY else []
+        urls += [api_config['baseUrl'] for api_config in list(CUSTOM_API_CONFIGS.values()) if api_config.get('baseUrl')]
+    origins = []
+    for url in urls:
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            continue
+        origin = f"{parts.scheme}://{parts.netloc}/"
+        if parts.scheme in ('http', 'https') and parts.netloc and origin not in origins:
+            origins.append(origin)
+    return origins
+
+def warm_upstreams(urls=None):
+    """在后台向各服务发一个 HEAD 请求，建立的连接留在连接池中供随后的生成请求使用"""
+    if not UPSTREAM_WARMUP:
+        return
+    origins = upstream_origins(urls)
+
+    def run():
+        for origin in origins:
+            started = time.perf_counter()
+            try:
+                upstream_session.head(origin, timeout=(UPSTREAM_CONNECT_TIMEOUT, 5), allow_redirects=False)
+                logging.info(f"[上游连接] 已预先连接 {origin}，用时 {time.perf_counter() - started:.2f} 秒")
+            except requests.exceptions.RequestException as e:
+                logging.info(f"[上游连接] 预先连接 {origin} 失败: {e}")
+
+    if origins:
+        threading.Thread(target=run, name="upstream-warmup", daemon=True).start()
+        # 以异步网关运行时，同时在 httpx 的连接池中预先连接
+        if asgi_app is not None and asgi_app.loop is not None:
+            asyncio.run_coroutine_threadsafe(asgi_app.warm(origins), asgi_app.loop)
+
+def upstream_stats():
+    """各主机累计发出的请求数与当前连接池中保持着的空闲连接数"""
+    pools = upstream_session.get_adapter('https://').poolmanager.pools
+    stats = []
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None and pool.pool is not None:
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None and conn.sock is not None)
+            stats.append({"host": f"{key.key_scheme}://{key.key_host}:{key.key_port or ''}".rstrip(':'),
+                          "requests": pool.num_requests, "idle_connections": idle})
+    return stats
+
+# --- 上游请求调度 ---
+
+# 每个服务（OpenRouter、每个自定义 API）一个令牌桶与并发上限，超出时请求排队：交互的 /api/generate 排在
+# 图谱抽取等批量任务前面，同一优先级先到先得。排队中的生成请求通过 SSE 事件 {"queue": {...}} 收到自己的位置，
+# 不会因为长时间没有数据而超时。上游返回 429 或 5xx 时按 Retry-After（没有时按指数退避）等待后重试，429 的
+# 等待对该服务的所有请求生效。自定义 API 配置中的 requestsPerMinute 与 maxConcurrency 覆盖默认值
+UPSTREAM_RPM = float(os.environ.get('BMXH_UPSTREAM_RPM', '120'))  # 每个服务每分钟的请求数，0 为不限
+UPSTREAM_BURST = int(os.environ.get('BMXH_UPSTREAM_BURST', '20'))  # 令牌桶容量：空闲一段时间后允许连续发出的请求数
+UPSTREAM_CONCURRENCY = int(os.environ.get('BMXH_UPSTREAM_CONCURRENCY', '16'))  # 每个服务同时进行的请求数
+UPSTREAM_RETRIES = int(os.environ.get('BMXH_UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BASE = 1.0        # 第一次重试前的等待（秒），之后每次加倍
+UPSTREAM_RETRY_MAX_DELAY = 30.0  # 需要等待更久（如 Retry-After 很长）时不再重试
+QUEUE_PROGRESS_INTERVAL = 1.0    # 排队时发送位置的间隔（秒）
+PRIORITY_INTERACTIVE, PRIORITY_BATCH = 0, 1
+
+def provider_key(model):
+    """调度按服务区分：每个自定义 API 单独计算，其余模型都属于 OpenRouter"""
+    return model if model.startswith('custom-') else 'openrouter'
+
+def provider_limits(key):
+    """(每分钟请求数, 令牌桶容量, 并发上限)"""
+    rpm, concurrency = UPSTREAM_RPM, UPSTREAM_CONCURRENCY
+    api_config = CUSTOM_API_CONFIGS.get(key.replace('custom-', '', 1)) if key.startswith('custom-') else None
+    if api_config:
+        rpm = api_config.get('requestsPerMinute') or rpm
+        concurrency = api_config.get('maxConcurrency') or concurrency
+    burst = max(1, min(UPSTREAM_BURST, int(rpm))) if rpm > 0 else UPSTREAM_BURST
+    return rpm, burst, concurrency
+
+def upstream_limits_error(data):
+    """自定义 API 配置中的 requestsPerMinute（正数）与 maxConcurrency（正整数）：不合法时返回错误信息"""
+    rpm, concurrency = data.get('requestsPerMinute'), data.get('maxConcurrency')
+    if not (rpm is None or (type(rpm) in (int, float) and rpm >= 0)):
+        return "requestsPerMinute 必须是正数"
+    if not (concurrency is None or (type(concurrency) is int and concurrency >= 0)):
+        return "maxConcurrency 必须是正整数"
+    return None
+
+def retry_after_seconds(value):
+    """Retry-After 响应头中的秒数；HTTP 日期格式等无法解析时返回 None"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+class UpstreamTicket:
+    """排队等待某个服务的一个请求名额"""
+
+    def __init__(self, key, priority, seq, not_before):
+        self.key, self.priority, self.seq = key, priority, seq
+        self.not_before = not_before  # 重试的请求在这个时间（time.monotonic()）之前不发出
+        self.granted = self.released = False
+        self.event = threading.Event()
+        self.loop = self.future = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def watch(self):
+        """在事件循环中等待时调用（在调度器的锁内）：分配到名额时同时唤醒等待的协程"""
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        if self.granted:
+            self.future.set_result(True)
+
+    def notify(self):
+        self.event.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+class ProviderLimiter:
+    """一个服务的令牌桶、进行中的请求数与等待队列"""
+
+    def __init__(self, key):
+        self.key = key
+        self.tokens = None
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.waiting = []  # 按 (优先级, 序号) 排序的 UpstreamTicket
+        self.paused_until = 0.0
+        self.granted = self.queued = self.retries = self.throttled = 0
+
+    def refill(self, now, rpm, burst):
+        if self.tokens is None:
+            self.tokens = float(burst)
+        elif rpm > 0:
+            self.tokens = min(float(burst), self.tokens + (now - self.refilled) * rpm / 60)
+        self.refilled = now
+
+class UpstreamScheduler:
+    """按服务限速、限制并发，并按优先级分配请求名额。线程与事件循环中的请求共用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiters = {}  # 服务 -> ProviderLimiter
+        self.seq = 0
+
+    def limiter(self, key):
+        """在锁内调用"""
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            limiter = self.limiters[key] = ProviderLimiter(key)
+        return limiter
+
+    def dispatch(self, limiter, now):
+        """按队列顺序把名额分给可以发出的请求（在锁内调用）；返回多久之后需要再检查（秒），None 表示等有请求结束"""
+        rpm, burst, concurrency = provider_limits(limiter.key)
+        limiter.refill(now, rpm, burst)
+        if now < limiter.paused_until:
+            return limiter.paused_until - now
+        hint = None
+        for ticket in list(limiter.waiting):
+            if limiter.active >= concurrency:
+                break
+            if ticket.not_before > now:
+                hint = min(hint or math.inf, ticket.not_before - now)
+                continue
+            if rpm > 0:
+                if limiter.tokens < 1:
+                    hint = min(hint or math.inf, (1 - limiter.tokens) * 60 / rpm)
+                    break
+                limiter.tokens -= 1
+            limiter.waiting.remove(ticket)
+            limiter.active += 1
+            limiter.granted += 1
+            ticket.granted = True
+            ticket.notify()
+        return hint
+
+    def request(self, key, priority, delay=0.0):
+        """排队请求一个名额；delay 秒之内不分配（重试前的等待）"""
+        with self.lock:
+            limiter = self.limiter(key)
+            self.seq += 1
+            ticket = UpstreamTicket(key, priority, self.seq, time.monotonic() + delay)
+            bisect.insort(limiter.waiting, ticket)
+            self.dispatch(limiter, time.monotonic())
+            if not ticket.granted and not delay:
+                limiter.queued += 1
+        return ticket
+
+    def release(self, ticket):
+        """请求结束或放弃排队；可重复调用"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            limiter = self.limiters[ticket.key]
+            if ticket.granted:
+                limiter.active -= 1
+            else:
+                limiter.waiting.remove(ticket)
+            self.dispatch(limiter, time.monotonic())
+
+    def poll(self, ticket):
+        """(排队位置，从 1 开始；已分配到名额时为 None, 多久之后需要再检查)"""
+        with self.lock:
+            hint = self.dispatch(self.limiters[ticket.key], time.monotonic())
+            if ticket.granted:
+                return None, None
+            position = self.limiters[ticket.key].waiting.index(ticket) + 1
+        return position, QUEUE_PROGRESS_INTERVAL if hint is None else min(hint, QUEUE_PROGRESS_INTERVAL)
+
+    def wait(self, ticket):
+        """在线程中等待名额；等待期间每 QUEUE_PROGRESS_INTERVAL 秒（或位置变化时）产出排队位置"""
+        last, sent = None, 0.0
+        while True:
+            position, timeout = self.poll(ticket)
+            if position is None:
+                return
+            # 等待重试期间客户端已收到重试事件，不再发送位置
+            if ticket.not_before <= time.monotonic() and (
+                    position != last or time.monotonic() - sent >= QUEUE_PROGRESS_INTERVAL):
+                last, sent = position, time.monotonic()
+                yield position
+            ticket.event.wait(timeout)
+
+    async def async_wait(self, ticket):
+        """同 wait，在事件循环中等待"""
+        with self.lock:
+            ticket.watch()
+        last, sent = None, 0.0
+        while True:
+            position, timeout = self.poll(ticket)
+            if position is None:
+                return
+            # 等待重试期间客户端已收到重试事件，不再发送位置
+            if ticket.not_before <= time.monotonic() and (
+                    position != last or time.monotonic() - sent >= QUEUE_PROGRESS_INTERVAL):
+                last, sent = position, time.monotonic()
+                yield position
+            await asyncio.wait([ticket.future], timeout=timeout)
+
+    def retry_delay(self, key, status, retry_after, retry, retries):
+        """429/5xx 响应重试前等待的秒数，不重试时返回 None；429 的等待对该服务的所有请求生效"""
+        if status != 429 and status < 500:
+            return None
+        with self.lock:
+            limiter = self.limiter(key)
+            if status == 429:
+                limiter.throttled += 1
+            if retry >= retries:
+                return None
+            delay = retry_after if retry_after is not None else UPSTREAM_RETRY_BASE * 2 ** retry * random.uniform(1, 1.5)
+            if delay > UPSTREAM_RETRY_MAX_DELAY:
+                return None
+            if status == 429:
+                limiter.paused_until = max(limiter.paused_until, time.monotonic() + delay)
+            limiter.retries += 1
+        logging.info(f"[上游调度] {key} 返回 {status}，{delay:.1f} 秒后重试")
+        return delay
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            stats = {}
+            for key, limiter in self.limiters.items():
+                rpm, burst, concurrency = provider_limits(key)
+                limiter.refill(now, rpm, burst)
+                stats[key] = {"active": limiter.active, "waiting": len(limiter.waiting),
+                              "tokens": round(limiter.tokens, 1), "paused": round(max(0.0, limiter.paused_until - now), 1),
+                              "rpm": rpm, "concurrency": concurrency, "granted": limiter.granted,
+                              "queued": limiter.queued, "retries": limiter.retries, "throttled": limiter.throttled}
+            return stats
+
+upstream_scheduler = UpstreamScheduler()
+
+def scheduled_post(model, priority, url, **kwargs):
+    """非流式的上游请求：等待该服务的名额，429/5xx 时按 Retry-After 或退避重试"""
+    key, delay = provider_key(model), 0.0
+    for retry in range(UPSTREAM_RETRIES + 1):
+        ticket = upstream_scheduler.request(key, priority, delay)
+        try:
+            for _ in upstream_scheduler.wait(ticket):
+                pass
+            response = upstream_post(url, **kwargs)
+        finally:
+            upstream_scheduler.release(ticket)
+        delay = upstream_scheduler.retry_delay(key, response.status_code,
+                                               retry_after_seconds(response.headers.get('Retry-After')),
+                                               retry, UPSTREAM_RETRIES)
+        if delay is None:
+            return response
+        response.close()
+
+# --- 生成结果缓存 ---
+
+# 同样的提示词与采样参数再次请求时直接返回上次的结果，不再调用上游：图谱抽取默认使用缓存，
+# /api/generate 只在 temperature 为 0 时默认使用；请求体中的 "cache": true/false 可覆盖默认值。
+# 键由服务（请求地址）、模型、规范化后的提示词与采样参数计算。内存中保留最近使用的若干条，
+# 同时写入 GENERATION_CACHE_DIR 下的文件，总大小超过上限时删除最久未使用的文件；条目过期后不再使用
+GENERATION_CACHE_ENABLED = os.environ.get('BMXH_GENERATION_CACHE', '1') != '0'
+GENERATION_CACHE_DIR = os.path.join(DATA_DIR, 'cache', 'generations')
+GENERATION_CACHE_ENTRIES = int(os.environ.get('BMXH_GENERATION_CACHE_ENTRIES', '256'))  # 内存中的条目数
+GENERATION_CACHE_DISK_MB = float(os.environ.get('BMXH_GENERATION_CACHE_DISK_MB', '200'))
+GENERATION_CACHE_TTL = float(os.environ.get('BMXH_GENERATION_CACHE_TTL', str(7 * 24 * 3600)))  # 秒
+LINE_END_SPACE_RE = re.compile(r'[ \t　]+(?=\n)')
+
+def normalize_prompt(prompt):
+    """统一换行与 Unicode 形式、去掉行尾与首尾空白，只有这些差别的提示词使用同一个缓存条目"""
+    prompt = unicodedata.normalize('NFC', str(prompt)).replace('\r\n', '\n').replace('\r', '\n')
+    return LINE_END_SPACE_RE.sub('', prompt).strip()
+
+def generation_cache_key(kind, api_url, payload):
+    """kind（接口）+ 请求地址 + 请求体（提示词规范化，stream 等不影响结果的字段除外）-> 缓存键"""
+    params = {name: value for name, value in payload.items() if name not in ('messages', 'stream')}
+    messages = [[message.get('role'), normalize_prompt(message.get('content', ''))]
+                for message in payload.get('messages', [])]
+    text = json.dumps([kind, api_url, params, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def use_generation_cache(data, default):
+    """请求体中的 cache 字段优先，否则使用接口的默认值"""
+    if not GENERATION_CACHE_ENABLED:
+        return False
+    return bool(data.get('cache', default)) if isinstance(data, dict) else default
+
+class GenerationCache:
+    """两级缓存：内存 LRU（条目数限制）+ 磁盘文件（总字节数限制，按最近使用时间淘汰）"""
+
+    def __init__(self, directory, entries, disk_bytes, ttl):
+        self.directory = directory
+        self.max_entries = entries
+        self.disk_budget = disk_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key -> (过期时间, value)
+        self.disk = None             # key -> [字节数, 最近使用时间]，首次使用时扫描目录建立
+        self.disk_size = 0
+        self.hits = self.disk_hits = self.misses = self.stores = self.evictions = self.expired = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def scan(self):
+        """建立磁盘条目的索引（在锁内调用）"""
+        if self.disk is not None:
+            return
+        self.disk, self.disk_size = {}, 0
+        if not os.path.isdir(self.directory):
+            return
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    stat = os.stat(os.path.join(root, name))
+                    self.disk[name[:-5]] = [stat.st_size, stat.st_mtime]
+                    self.disk_size += stat.st_size
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                # 磁盘上的同一条目同时过期
+                del self.memory[key]
+                self.scan()
+                self.remove_file(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.scan()
+            on_disk = key in self.disk
+        if on_disk:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    record = json_loads(f.read())
+            except (OSError, ValueError):
+                record = None
+            with self.lock:
+                if record is not None and record.get("expires", 0) > now:
+                    if key in self.disk:
+                        try:
+                            os.utime(self.path(key), (now, now))
+                            self.disk[key][1] = now
+                        except OSError:
+                            # 文件在读取后被删除（如外部清理）：只保留内存中的条目
+                            self.remove_file(key)
+                    self.remember(key, record["expires"], record["value"])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return record["value"]
+                if record is not None:
+                    self.expired += 1
+                self.remove_file(key)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        text = json_dumps({"expires": expires, "value": value})
+        try:
+            write_file_atomic(self.path(key), text)
+        except OSError as e:
+            logging.warning(f"[生成缓存] 写入缓存文件失败: {e}")
+            text = None
+        with self.lock:
+            self.stores += 1
+            self.remember(key, expires, value)
+            self.scan()
+            if text is not None:
+                size = len(text.encode('utf-8'))
+                self.disk_size += size - (self.disk[key][0] if key in self.disk else 0)
+                self.disk[key] = [size, time.time()]
+                self.evict_disk()
+
+    def remember(self, key, expires, value):
+        self.memory[key] = (expires, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def remove_file(self, key):
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_size -= entry[0]
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict_disk(self):
+        if self.disk_size <= self.disk_budget:
+            return
+        for key, _ in sorted(self.disk.items(), key=lambda item: item[1][1]):
+            if self.disk_size <= self.disk_budget * 0.9:
+                break
+            self.memory.pop(key, None)
+            self.remove_file(key)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.scan()
+            for key in list(self.disk):
+                self.remove_file(key)
+
+    def stats(self):
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {"enabled": GENERATION_CACHE_ENABLED, "memory_entries": len(self.memory),
+                    "disk_entries": len(self.disk) if self.disk is not None else None,
+                    "disk_mb": round(self.disk_size / 1024 / 1024, 2), "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "hit_rate": round(self.hits / requests_count, 3) if requests_count else None,
+                    "stores": self.stores, "evictions": self.evictions, "expired": self.expired}
+
+generation_cache = GenerationCache(GENERATION_CACHE_DIR, GENERATION_CACHE_ENTRIES,
+                                   GENERATION_CACHE_DISK_MB * 1024 * 1024, GENERATION_CACHE_TTL)
+
+# --- 合并相同的上游请求 ---
+
+# 多个标签页或用户同时发出完全相同的请求（同一段文本的图谱抽取、同样提示词的生成）时只调用一次上游：
+# 非流式请求由第一个调用者执行，其余调用者等待并共享同一个响应；流式生成由一个后台生产者读取上游，
+# 产生的 SSE 事件转发给每个订阅者（后加入的订阅者先收到已产生的事件）。所有订阅者都断开后停止读取上游
+COALESCE_REQUESTS = os.environ.get('BMXH_COALESCE_REQUESTS', '1') != '0'
+
+class StreamFlight:
+    """一个上游流产生的 SSE 事件，供多个订阅者按各自的进度读取"""
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def abandoned(self):
+        return self.subscribers <= 0
+
+    def subscribe(self):
+        """依次产出全部事件；调用前 SingleFlight.join_stream 已为本订阅者计数"""
+        index = 0
+        try:
+            while True:
+                with self.condition:
+                    while index >= len(self.events) and not self.done:
+                        self.condition.wait()
+                    batch = self.events[index:]
+                    finished = self.done
+                index += len(batch)
+                yield from batch
+                if finished and not batch:
+                    return
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+class SingleFlight:
+    """相同键的并发调用只执行一次"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}    # key -> [完成事件, 结果, 异常]
+        self.streams = {}  # key -> StreamFlight
+        self.shared_calls = self.shared_streams = 0
+
+    def run(self, key, fn):
+        """执行 fn()；同一键已有调用在进行时等待它并返回同一结果（或抛出同一异常）"""
+        if not COALESCE_REQUESTS:
+            return fn()
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+            else:
+                self.shared_calls += 1
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fn()
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            # 先移出再通知：之后到达的相同请求重新调用（或命中生成结果缓存）
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+
+    def join_stream(self, key, produce):
+        """订阅 key 对应的流；没有进行中的流时启动后台线程运行 produce()（产出 SSE 事件的生成器）"""
+        if not COALESCE_REQUESTS:
+            return produce()
+        with self.lock:
+            flight = self.streams.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.streams[key] = StreamFlight()
+            else:
+                self.shared_streams += 1
+            # 先计数再启动生产者：第一个事件（如排队位置）可能立即产生，此时不能被当作无人订阅
+            with flight.condition:
+                flight.subscribers += 1
+            if leader:
+                threading.Thread(target=self.produce, args=(key, flight, produce), name="stream-producer",
+                                 daemon=True).start()
+        return flight.subscribe()
+
+    def produce(self, key, flight, produce):
+        events = produce()
+        try:
+            for event in events:
+                flight.publish(event)
+                if flight.abandoned():
+                    logging.info("[请求合并] 所有订阅者都已断开，停止读取上游")
+                    break
+        except Exception as e:
+            logging.error(f"[请求合并] 读取上游流时出错: {e}")
+            flight.publish(sse_event({'error': f"An unexpected error occurred during generation: {e}"}))
+        finally:
+            events.close()
+            with self.lock:
+                del self.streams[key]
+            flight.finish()
+
+    def stats(self):
+        with self.lock:
+            return {"enabled": COALESCE_REQUESTS, "calls_in_flight": len(self.calls),
+                    "streams_in_flight": len(self.streams), "shared_calls": self.shared_calls,
+                    "shared_streams": self.shared_streams}
+
+single_flight = SingleFlight()
+
+# --- 模型路由 ---
+
+# 路由组把几个等价的模型（OpenRouter 模型或自定义 API）合成一个可选的模型 route-<组ID>。每次生成都记录模型
+# 第一个输出的等待时间（TTFT）与成败：路由组按最近 TTFT 的中位数与错误率把健康的成员排在前面，失败（含 429
+# 限流，遵守 Retry-After）的成员冷却一段时间，连续失败时冷却时间加倍，冷却中的成员只作为最后的选择。
+# 成员在第一个输出之前失败时改用下一个成员；第一个输出迟迟不来（超过该成员 TTFT 的 ROUTE_HEDGE_PERCENTILE
+# 分位数）时再向下一个成员发出同样的请求，先产生输出的一方胜出，另一方被取消
+ROUTE_SAMPLES = 50            # 每个模型保留最近多少次的 TTFT 与成败
+ROUTE_DEFAULT_TTFT = 3.0      # 还没有记录的模型假定的 TTFT（秒）
+ROUTE_ERROR_PENALTY = 4.0     # 排序分数 = TTFT 中位数 × (1 + 错误率 × 该系数)
+ROUTE_COOLDOWN = float(os.environ.get('BMXH_ROUTE_COOLDOWN', '15'))  # 第一次失败后的冷却时间（秒）
+ROUTE_COOLDOWN_MAX = 300
+ROUTE_HEDGE = os.environ.get('BMXH_ROUTE_HEDGE', '1') != '0'
+ROUTE_HEDGE_PERCENTILE = float(os.environ.get('BMXH_ROUTE_HEDGE_PERCENTILE', '90'))
+ROUTE_HEDGE_MIN_SAMPLES = 5   # 记录少于这么多次时按 ROUTE_HEDGE_DEFAULT 等待
+ROUTE_HEDGE_DEFAULT = 10.0
+ROUTE_HEDGE_MIN_DELAY = 1.0
+ROUTE_MAX_MEMBERS = 8
+
+class UpstreamError(Exception):
+    """一次生成请求失败；消息是返回给客户端的错误说明"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class ProviderHealth:
+    """一个模型最近的 TTFT 与成败"""
+
+    def __init__(self):
+        self.ttfts = deque(maxlen=ROUTE_SAMPLES)
+        self.outcomes = deque(maxlen=ROUTE_SAMPLES)  # True 成功 / False 失败
+        self.failures = 0  # 连续失败次数
+        self.cooldown_until = 0.0
+        self.requests = self.errors = 0
+        self.last_error = None
+
+    def percentile(self, percent):
+        values = sorted(self.ttfts)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else None
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self):
+        ttft = self.percentile(50)
+        return (ROUTE_DEFAULT_TTFT if ttft is None else ttft) * (1 + self.error_rate() * ROUTE_ERROR_PENALTY)
+
+    def stats(self, now):
+        p50, p90 = self.percentile(50), self.percentile(90)
+        return {"requests": self.requests, "errors": self.errors, "error_rate": round(self.error_rate(), 3),
+                "ttft_p50": round(p50, 3) if p50 is not None else None,
+                "ttft_p90": round(p90, 3) if p90 is not None else None,
+                "cooldown": round(max(0.0, self.cooldown_until - now), 1), "last_error": self.last_error}
+
+class ProviderRouter:
+    """按模型ID记录健康状况，决定路由组成员的尝试顺序与对冲等待时间"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.health = {}  # 模型ID -> ProviderHealth
+        self.failovers = self.hedges = self.hedge_wins = 0
+
+    def entry(self, model):
+        """在锁内调用"""
+        health = self.health.get(model)
+        if health is None:
+            health = self.health[model] = ProviderHealth()
+        return health
+
+    def record_success(self, model, ttft):
+        with self.lock:
+            health = self.entry(model)
+            health.requests += 1
+            health.ttfts.append(ttft)
+            health.outcomes.append(True)
+            health.failures = 0
+            health.cooldown_until = 0.0
+
+    def record_failure(self, model, error):
+        with self.lock:
+            health = self.entry(model)
+            health.requests += 1
+            health.errors += 1
+            health.outcomes.append(False)
+            health.failures += 1
+            health.last_error = str(error)[:200]
+            cooldown = min(ROUTE_COOLDOWN_MAX, ROUTE_COOLDOWN * 2 ** min(health.failures - 1, 16))
+            if error.retry_after is not None:
+                cooldown = max(cooldown, min(error.retry_after, ROUTE_COOLDOWN_MAX))
+            health.cooldown_until = time.time() + cooldown
+        logging.info(f"[模型路由] {model} 请求失败，{cooldown:.0f} 秒内优先使用其它模型")
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def order(self, models):
+        """尝试顺序：不在冷却中的按分数从小到大，冷却中的按冷却结束时间排在后面；分数相同时保持配置的顺序"""
+        now = time.time()
+        with self.lock:
+            def rank(item):
+                position, model = item
+                health = self.health.get(model)
+                if health is None:
+                    return (0, ROUTE_DEFAULT_TTFT, position)
+                if health.cooldown_until > now:
+                    return (1, health.cooldown_until, position)
+                return (0, health.score(), position)
+            return [model for _, model in sorted(enumerate(models), key=rank)]
+
+    def hedge_delay(self, model):
+        """等待第一个输出多久之后向下一个成员发出对冲请求"""
+        with self.lock:
+            health = self.health.get(model)
+            if health is None or len(health.ttfts) < ROUTE_HEDGE_MIN_SAMPLES:
+                return ROUTE_HEDGE_DEFAULT
+            return max(ROUTE_HEDGE_MIN_DELAY, health.percentile(ROUTE_HEDGE_PERCENTILE))
+
+    def health_stats(self, models=None):
+        now = time.time()
+        with self.lock:
+            models = list(self.health) if models is None else models
+            return {model: self.health[model].stats(now) for model in models if model in self.health}
+
+    def stats(self):
+        with self.lock:
+            counters = {"failovers": self.failovers, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+        return dict(counters, models=self.health_stats())
+
+provider_router = ProviderRouter()
+
+# --- Token 估算 ---
+
+# 发送给模型前估算 token 数：按模型名匹配分词器，安装了 tiktoken 时 OpenAI 系列模型精确计数，
+# 其余模型按字符类别估算（中日韩文字、英文单词、数字、标点分别计）。估算用于在调用上游之前检查
+# 提示词是否超出模型的上下文长度并截断，以及在每次生成后报告输入与输出的 token 数
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 给输出预留的 token 数（/api/generate 未指定 max_tokens 时）
+COMPLETION_RESERVE = int(os.environ.get('BMXH_COMPLETION_RESERVE', '2048'))
+DEFAULT_CONTEXT_WINDOW = 32000
+TOKENS_PER_MESSAGE = 4  # 对话格式中每条消息的角色与分隔符
+TOKENS_PER_REPLY = 3
+ASCII_WORD_RE = re.compile(r'[A-Za-z]+')
+DIGIT_RE = re.compile(r'\d')
+PUNCT_RE = re.compile(r'[^\w\s]')
+SPACE_CHAR_RE = re.compile(r'\s')
+
+class HeuristicTokenizer:
+    """按字符类别估算：中日韩文字每字 cjk 个 token，英文每 chars_per_token 个字母 1 个（每个单词至少 1 个），
+    数字每 3 位 1 个，标点每个 punct 个，其余字符每个 0.5 个"""
+
+    exact = False
+
+    def __init__(self, name, cjk=1.0, chars_per_token=4.0, punct=1.0):
+        self.name, self.cjk, self.chars_per_token, self.punct = name, cjk, chars_per_token, punct
+
+    def count(self, text):
+        if not text:
+            return 0
+        cjk = sum(map(len, CJK_RUN_RE.findall(text)))
+        words = ASCII_WORD_RE.findall(text)
+        letters = sum(map(len, words))
+        digits = len(DIGIT_RE.findall(text))
+        punct = len(PUNCT_RE.findall(text))
+        other = len(text) - cjk - letters - digits - punct - len(SPACE_CHAR_RE.findall(text))
+        return math.ceil(cjk * self.cjk + max(len(words), letters / self.chars_per_token)
+                         + digits / 3 + punct * self.punct + max(0, other) * 0.5)
+
+    def truncate(self, text, tokens, keep_end=False):
+        """按 count 二分查找不超过 tokens 的最长开头（keep_end 时为结尾）"""
+        # 除空白外每个 token 最多对应约 chars_per_token 个字符，据此缩小查找范围
+        low, high = 0, min(len(text), int(tokens * (self.chars_per_token + 2)) + 64)
+        while low < high:
+            middle = (low + high + 1) // 2
+            piece = text[len(text) - middle:] if keep_end else text[:middle]
+            if self.count(piece) <= tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[len(text) - low:] if keep_end else text[:low]
+
+class TiktokenTokenizer:
+    """tiktoken 精确计数"""
+
+    exact = True
+
+    def __init__(self, encoding):
+        self.name = encoding
+        self.encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text, tokens, keep_end=False):
+        ids = self.encoding.encode(text, disallowed_special=())
+        if len(ids) <= tokens:
+            return text
+        ids = ids[len(ids) - tokens:] if keep_end else ids[:max(0, tokens)]
+        # 截断处可能切开一个多字节字符
+        return self.encoding.decode(ids).strip("\ufffd")
+
+DEFAULT_TOKENIZER = HeuristicTokenizer("heuristic")
+
+def tiktoken_or(encoding, fallback):
+    """安装了 tiktoken 时使用精确分词器，否则使用 fallback 估算"""
+    return lambda: TiktokenTokenizer(encoding) if tiktoken is not None else fallback
+
+# 模型名（OpenRouter 的模型 ID 或自定义 API 的 modelName，不区分大小写）-> 分词器，先匹配的优先
+TOKENIZER_RULES = [
+    (re.compile(r'gpt-4o|gpt-4\.1|gpt-5|(^|/)o[134]'), tiktoken_or("o200k_base", HeuristicTokenizer("o200k-heuristic", cjk=0.8))),
+    (re.compile(r'gpt-4|gpt-3\.5'), tiktoken_or("cl100k_base", HeuristicTokenizer("cl100k-heuristic", cjk=1.3))),
+    (re.compile(r'deepseek'), lambda: HeuristicTokenizer("deepseek-heuristic", cjk=0.6, chars_per_token=3.3)),
+    (re.compile(r'qwen'), lambda: HeuristicTokenizer("qwen-heuristic", cjk=0.7)),
+]
+# 模型名 -> 上下文长度（token），取各服务商公布值中较保守的一个；自定义 API 可在配置中用 contextWindow 指定
+CONTEXT_WINDOW_RULES = [
+    (re.compile(r'gemini'), 1000000),
+    (re.compile(r'gpt-4o|gpt-4\.1|llama-4|(^|/)o[134]'), 128000),
+    (re.compile(r'gemma-3'), 96000),
+    (re.compile(r'deepseek'), 64000),
+    (re.compile(r'qwen3'), 40000),
+    (re.compile(r'qwen2\.5-vl'), 32000),
+    (re.compile(r'gpt-4'), 8000),
+]
+tokenizer_cache = {}
+
+def register_tokenizer(pattern, factory):
+    """为匹配 pattern 的模型注册分词器（factory() 返回带 count/truncate 的对象），优先于已有规则"""
+    TOKENIZER_RULES.insert(0, (re.compile(pattern), factory))
+    tokenizer_cache.clear()
+
+def resolve_model(model):
+    """/api/generate 等接口的 model 参数 -> (实际的模型名, 自定义 API 配置或 None)"""
+    model = model or ""
+    if model.startswith('custom-'):
+        api_config = CUSTOM_API_CONFIGS.get(model.replace('custom-', '', 1))
+        if api_config is not None:
+            return str(api_config.get('modelName') or ""), api_config
+    return model, None
+
+def tokenizer_for(model):
+    name = resolve_model(model)[0].lower()
+    tokenizer = tokenizer_cache.get(name)
+    if tokenizer is None:
+        tokenizer = next((factory() for pattern, factory in TOKENIZER_RULES if pattern.search(name)), DEFAULT_TOKENIZER)
+        tokenizer_cache[name] = tokenizer
+    return tokenizer
+
+def valid_context_window(value):
+    """自定义 API 配置中的 contextWindow：不填或正整数"""
+    return value is None or value == 0 or (type(value) is int and value > 0)
+
+def context_window(model):
+    name, api_config = resolve_model(model)
+    if api_config is not None and api_config.get('contextWindow'):
+        return int(api_config['contextWindow'])
+    return next((tokens for pattern, tokens in CONTEXT_WINDOW_RULES if pattern.search(name.lower())),
+                DEFAULT_CONTEXT_WINDOW)
+
+def estimate_tokens(text, model=None):
+    return (tokenizer_for(model) if model else DEFAULT_TOKENIZER).count(text)
+
+def message_tokens(tokenizer, messages):
+    """对话消息列表的输入 token 数"""
+    return sum(tokenizer.count(str(message.get("content", ""))) + TOKENS_PER_MESSAGE
+               for message in messages) + TOKENS_PER_REPLY
+
+def truncate_to_tokens(text, tokens, keep_end=False, tokenizer=DEFAULT_TOKENIZER):
+    """截取不超过 tokens 的开头（keep_end 时为结尾），尽量在换行处断开"""
+    if tokenizer.count(text) <= tokens:
+        return text
+    piece = tokenizer.truncate(text, max(0, tokens), keep_end)
+    if keep_end:
+        newline = piece.find("\n")
+        if 0 <= newline < len(piece) // 2:
+            piece = piece[newline + 1:]
+    else:
+        newline = piece.rfind("\n")
+        if newline > len(piece) // 2:
+            piece = piece[:newline]
+    return piece
+
+def fit_prompt(model, prompt, reserve=None, keep_end=False, fixed=""):
+    """保证 fixed + prompt 作为一条用户消息时给输出留出 reserve 个 token；超出时截断 prompt。
+    返回 (截断后的 prompt, 输入 token 数, 是否截断)"""
+    tokenizer = tokenizer_for(model)
+    limit = context_window(model) - (COMPLETION_RESERVE if reserve is None else reserve)
+    overhead = message_tokens(tokenizer, [{"content": fixed}])
+    tokens = overhead + tokenizer.count(prompt)
+    if tokens <= limit:
+        return prompt, tokens, False
+    prompt = truncate_to_tokens(prompt, limit - overhead, keep_end, tokenizer)
+    tokens = overhead + tokenizer.count(prompt)
+    logging.warning(f"[Token 估算] 提示词超出 {model} 的上下文长度，已截断为 {tokens} tokens")
+    return prompt, tokens, True
+
+def usage_report(model, prompt_tokens, completion_text, upstream=None, truncated=False):
+    """生成结束后的 token 统计；上游返回了 usage 时以上游为准"""
+    tokenizer = tokenizer_for(model)
+    report = {"prompt_tokens": prompt_tokens, "completion_tokens": tokenizer.count(completion_text),
+              "estimated": True, "tokenizer": tokenizer.name, "truncated": truncated}
+    if isinstance(upstream, dict) and upstream.get("prompt_tokens") is not None:
+        report.update(prompt_tokens=upstream["prompt_tokens"],
+                      completion_tokens=upstream.get("completion_tokens", report["completion_tokens"]),
+                      estimated=False)
+    report["total_tokens"] = report["prompt_tokens"] + report["completion_tokens"]
+    return report
+
+# --- 上下文组装 ---
+
+# /api/generate 带 context 时由服务端组装提示词：光标前的正文、光标附近提到的角色与词条、
+# 小说关联的角色/词条/风格，以及前几章的结尾，按相关度排序后在 token 预算内装入，
+# 放不下的条目截断或丢弃；组装结果与 token 统计在生成开始前作为第一个 SSE 事件返回
+CONTEXT_BUDGET = int(os.environ.get('BMXH_CONTEXT_BUDGET', '4000'))  # 默认 token 预算（含写作提示）
+CONTEXT_BUDGET_MAX = 128000
+CONTEXT_RECENT_SHARE = 0.35   # 光标前正文最多占预算的比例
+CONTEXT_WINDOW_CHARS = 4000   # 在光标前多少字内查找提到的角色与词条
+CONTEXT_PREVIOUS_CHAPTERS = 3 # 参与排序的前文章节数
+CONTEXT_CHAPTER_TAIL_CHARS = 1500
+CONTEXT_MIN_PIECE = 48        # 剩余预算少于这么多 token 时不再截断装入
+CONTEXT_RELATED_PASSAGES = 3  # 从本书其它章节取相似段落的数量
+CONTEXT_MIN_SIMILARITY = 0.25 # 相似度低于此值的段落与条目不因相似度加分
+# 组装顺序与标题（与前端原来拼接提示词时的标题一致）
+CONTEXT_SECTIONS = (("styles", "风格提示"), ("characters", "角色设定"), ("glossary", "关联知识"),
+                    ("related_passages", "相关段落"), ("previous_chapters", "前文回顾"),
+                    ("recent_text", "当前内容"), ("prompt", "写作提示"))
+
+def context_candidates(novel_id, chapter_id, window, prompt):
+    """候选上下文 [(分数, 分区, ID, 标题, 文本)]：光标附近与写作提示中提到的角色/词条按提及次数
+    与离光标的距离计分，小说关联的条目与向量检索相似的条目另加分，关联的风格固定高分，
+    前几章的结尾按距离递减，本书其它章节中相似的段落按相似度计分"""
+    mentions = {}
+    for text, weight, near_cursor in ((window, 1.0, True), (prompt, 3.0, False)):
+        for start, end, owners in entity_matcher.match(text):
+            # 越靠近光标（窗口末尾）权重越高，最多 2 倍
+            score = weight * (1 + start / len(text)) if near_cursor else weight
+            for owner in owners:
+                mentions[owner] = mentions.get(owner, 0.0) + score
+    with novel_lock(novel_id):
+        meta = novels_db[novel_id]
+        tags = {store: {tag.get("id") if isinstance(tag, dict) else tag for tag in meta.get(key, []) or []}
+                for store, key in LIBRARY_TAG_KEYS.items()}
+        previous = []
+        # 当前章节与已作为前文回顾装入的章节结尾不再作为相关段落
+        exclude = [(("chapter", novel_id, chapter_id), None, None)] if chapter_id else []
+        chapter_list = meta.get("chapters", [])
+        chapter = find_chapter(novel_id, chapter_id) if chapter_id else None
+        if chapter is not None:
+            position = chapter_position(chapter_list, chapter)
+            for distance, earlier in enumerate(reversed(chapter_list[max(0, position - CONTEXT_PREVIOUS_CHAPTERS):position]), 1):
+                body = novels_db.chapters.peek(novel_id, earlier)
+                tail = body[-CONTEXT_CHAPTER_TAIL_CHARS:]
+                exclude.append((("chapter", novel_id, earlier["id"]), len(body) - len(tail), len(body)))
+                if tail.strip():
+                    previous.append((2.0 / distance, "previous_chapters", earlier["id"],
+                                     earlier.get("title", ""), f"《{earlier.get('title', '')}》结尾：\n{tail}"))
+
+    # 向量检索在小说锁外进行（更新索引时会获取小说锁）
+    query = window[-VECTOR_PASSAGE_CHARS * 2:] + "\n" + prompt
+    similar = {key: score for score, key, _, _ in vector_index.query(query, 10, {"characters", "glossary"})
+               if score >= CONTEXT_MIN_SIMILARITY}
+    candidates = previous
+    for score, key, start, end in vector_index.query(query, CONTEXT_RELATED_PASSAGES, {"chapter"}, novel_id, exclude):
+        hit = vector_index.describe(key, start, end) if score >= CONTEXT_MIN_SIMILARITY else None
+        if hit is not None and hit["text"].strip():
+            candidates.append((3.0 * score, "related_passages", f"{key[2]}:{start}", hit["title"],
+                               f"《{hit['title']}》：\n{hit['text'].strip()}"))
+    for store, (title_field, body_field) in (("characters", ("name", "description")),
+                                             ("glossary", ("term", "description"))):
+        with store_lock(store):
+            entries = library_dbs()[store]
+            for entry_id in set(tags[store]) | {key[1] for key in list(mentions) + list(similar) if key[0] == store}:
+                entry = entries.get(entry_id)
+                if entry is None:
+                    continue
+                score = (mentions.get((store, entry_id), 0.0) + (1.0 if entry_id in tags[store] else 0.0)
+                         + 2.0 * similar.get((store, entry_id), 0.0))
+                title = str(entry.get(title_field, ""))
+                candidates.append((score, store, entry_id, title, f"{title}: {entry.get(body_field, '')}"))
+    with store_lock("styles"):
+        for style_id in tags["styles"]:
+            style = styles_db.get(style_id)
+            if style is not None:
+                candidates.append((5.0, "styles", style_id, style.get("name", ""), str(style.get("content", ""))))
+    candidates.sort(key=lambda item: item[0], reverse=True)
+    return candidates
+
+def assemble_context(novel_id, prompt, chapter_id=None, cursor=None, recent_text=None, budget=None,
+                     tokenizer=DEFAULT_TOKENIZER):
+    """组装提示词，返回 (提示词, token 统计)；novel_id 必须存在，token 数按 tokenizer 计"""
+    budget = min(budget or CONTEXT_BUDGET, CONTEXT_BUDGET_MAX)
+    if recent_text is None:
+        with novel_lock(novel_id):
+            chapter = find_chapter(novel_id, chapter_id) if chapter_id else None
+            body = (novels_db.chapters.get(novel_id, chapter) if chapter is not None
+                    else novels_db[novel_id].get("content", ""))
+        recent_text = body[:cursor] if cursor is not None else body
+    window = recent_text[-CONTEXT_WINDOW_CHARS:]
+
+    pieces = {name: [] for name, _ in CONTEXT_SECTIONS}
+    items, dropped = [], []
+    pieces["prompt"].append(prompt)
+    # 先扣除写作提示与各分区标题、分隔符
+    remaining = budget - tokenizer.count(prompt) - sum(tokenizer.count(f"{heading}:\n\n\n") for _, heading in CONTEXT_SECTIONS)
+    recent = truncate_to_tokens(window, max(0, min(remaining, int(budget * CONTEXT_RECENT_SHARE))),
+                                keep_end=True, tokenizer=tokenizer)
+    if recent.strip():
+        pieces["recent_text"].append(recent)
+        remaining -= tokenizer.count(recent)
+
+    # 按分数装入放得下的整条，之后再按分数把放不下的截断装入剩余预算，避免一条长文本挤掉其后的短条目
+    deferred = []
+    for score, section, item_id, title, text in context_candidates(novel_id, chapter_id, window, prompt):
+        item = {"type": section, "id": item_id, "title": title, "score": round(score, 3),
+                "tokens": tokenizer.count(text) + 1}  # 加上与上一条之间的换行
+        if item["tokens"] <= remaining:
+            pieces[section].append(text)
+            remaining -= item["tokens"]
+            items.append(item)
+        else:
+            deferred.append((item, text))
+    for item, text in deferred:
+        if remaining < CONTEXT_MIN_PIECE:
+            dropped.append(item)
+            continue
+        text = truncate_to_tokens(text, remaining - 1, keep_end=item["type"] == "previous_chapters",
+                                  tokenizer=tokenizer)
+        item.update(tokens=tokenizer.count(text) + 1, truncated=True)
+        pieces[item["type"]].append(text)
+        remaining -= item["tokens"]
+        items.append(item)
+
+    parts, sections = [], {}
+    for name, heading in CONTEXT_SECTIONS:
+        if pieces[name]:
+            text = "\n".join(pieces[name])
+            parts.append(f"{heading}:\n{text}")
+            sections[name] = tokenizer.count(text)
+    full_prompt = "\n\n".join(parts)
+    accounting = {"budget": budget, "used": tokenizer.count(full_prompt), "tokenizer": tokenizer.name,
+                  "sections": sections, "items": items, "dropped": dropped}
+    return full_prompt, accounting
+
+def context_request(data):
+    """从 /api/generate 或 /api/context 的请求体读取 context，返回 (提示词, token 统计, 错误响应)"""
+    context = data.get("context")
+    if not isinstance(context, dict) or not context.get("novel_id"):
+        return None, None, (jsonify({"error": "context 需要包含 novel_id"}), 400)
+    novel_id = context["novel_id"]
+    cursor, budget = context.get("cursor"), context.get("budget")
+    if (cursor is not None and type(cursor) is not int) or (budget is not None and (type(budget) is not int or budget <= 0)):
+        return None, None, (jsonify({"error": "cursor 与 budget 必须是整数"}), 400)
+    recent_text = context.get("recent_text")
+    if recent_text is not None and not isinstance(recent_text, str):
+        return None, None, (jsonify({"error": "recent_text 必须是字符串"}), 400)
+    if novel_id not in novels_db:
+        return None, None, (jsonify({"error": "小说不存在"}), 404)
+    if context.get("chapter_id") and find_chapter(novel_id, context["chapter_id"]) is None:
+        return None, None, (jsonify({"error": "章节不存在"}), 404)
+    # 选择了模型时按模型的分词器计数，预算不超过模型的上下文长度减去给输出预留的部分
+    model = data.get("model")
+    if model:
+        budget = min(budget or CONTEXT_BUDGET, context_window(model) - COMPLETION_RESERVE)
+    prompt, accounting = assemble_context(novel_id, data.get("prompt", ""), context.get("chapter_id"),
+                                          cursor, recent_text, budget, tokenizer_for(model))
+    return prompt, accounting, None
+
+# --- 条件请求与压缩 ---
+
+# 读接口的响应带强 ETag：小说/章节由 revision 得出，库列表由库的修改序号得出，
+# 匹配 If-None-Match 时直接返回 304，不再读取正文和序列化；其余 JSON 响应按内容哈希生成 ETag。
+# 响应按 Accept-Encoding 压缩（安装了 brotli 时优先 br，否则 gzip），不同编码的 ETag 带 -br/-gzip 后缀
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于这个大小（字节）的响应不压缩
+COMPRESS_MIN_BYTES = int(os.environ.get('BMXH_COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_ENCODINGS = (["br"] if brotli is not None else []) + ["gzip"]
+
+STORE_VERSIONS = {}  # 库名 -> 修改序号
+store_version_seq = 0
+
+def bump_store_version(store):
+    global store_version_seq
+    with LOCKS_GUARD:
+        store_version_seq += 1
+        STORE_VERSIONS[store] = store_version_seq
+
+def make_etag(*parts):
+    """由数据版本生成不透明的强 ETag（不含引号）"""
+    key = repr((etag_epoch,) + parts).encode('utf-8')
+    return hashlib.blake2b(key, digest_size=12).hexdigest()
+
+def matched_etag(etag):
+    """返回 If-None-Match 中与 etag（任一编码的变体）匹配的标签，没有则返回 None"""
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        return etag
+    for tag in if_none_match.as_set(include_weak=True):
+        if tag.partition('-')[0] == etag:
+            return tag
+    return None
+
+def not_modified_response(tag):
+    response = app.response_class(status=304)
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def with_etag(etag_func):
+    """路由装饰器：etag_func(**URL 参数) 返回资源当前的 ETag（资源不存在时返回 None）。
+    请求的 If-None-Match 匹配时直接返回 304，不执行视图"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = etag_func(**kwargs)
+            tag = matched_etag(etag) if etag is not None else None
+            if tag is not None:
+                return not_modified_response(tag)
+            response = app.make_response(view(*args, **kwargs))
+            if etag is not None and response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+def novel_etag(novel_id):
+    if novel_id not in novels_db:
+        return None
+    return make_etag("novel", novel_id, novels_db.version(novel_id), novels_db.meta(novel_id).get("revision", 0))
+
+def chapter_etag(novel_id, chapter_id):
+    if novel_id not in novels_db:
+        return None
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
+        return None
+    return make_etag("chapter", novel_id, novels_db.version(novel_id), chapter_id,
+                     chapter.get("revision", 0), chapter.get("order", 0))
+
+def store_etag(store):
+    """库列表与条目的 ETag：库的任何修改都会使其变化"""
+    return lambda **kwargs: make_etag("store", store, STORE_VERSIONS.get(store, 0))
+
+@app.after_request
+def tag_and_compress(response):
+    """为 /api/ 下的 JSON GET 响应补上 ETag、处理 If-None-Match，并按 Accept-Encoding 压缩"""
+    if (request.method not in ('GET', 'HEAD') or not request.path.startswith('/api/')
+            or response.status_code != 200 or response.mimetype != 'application/json'
+            or response.direct_passthrough or response.is_streamed):
+        return response
+    data = response.get_data()
+    etag = response.get_etag()[0]
+    if etag is None:
+        etag = hashlib.blake2b(data, digest_size=12).hexdigest()
+        response.set_etag(etag)
+    tag = matched_etag(etag)
+    if tag is not None:
+        return not_modified_response(tag)
+    response.headers['Cache-Control'] = 'no-cache'  # 浏览器可缓存，但每次都带 If-None-Match 重新验证
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES or 'Content-Encoding' in response.headers:
+        return response
+    if encoding == "br":
+        data = brotli.compress(data, quality=5)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.set_etag(f"{etag}-{encoding}")
+    return response
+
+# --- 库列表分页 ---
+
+# 人物/词条/风格库的列表接口按游标分页：默认每页 LIBRARY_PAGE_SIZE 条，limit 最多 LIBRARY_PAGE_MAX，
+# 响应体仍是条目数组，还有下一页时带 X-Next-Cursor 头。fields= 指定返回的字段（不截断），
+# category= 按分类过滤（可重复），novel_id= 只返回该小说关联（character_tags/glossary_tags/style_tags）的条目
+LIBRARY_PAGE_SIZE = int(os.environ.get('BMXH_LIBRARY_PAGE_SIZE', '200'))
+LIBRARY_PAGE_MAX = 1000
+SUMMARY_LENGTH = 50  # 默认字段中长文本截断到的字数
+
+# 库名 -> (默认字段, 截断的字段, 可选字段, 名称字段的缺省值)
+LIBRARY_LISTS = {
+    "characters": (("name", "description"), "description", ("name", "description", "details"), ("name", "未命名")),
+    "glossary": (("term", "category", "description"), "description",
+                 ("term", "category", "description", "details"), ("term", "未命名词条")),
+    "styles": (("name", "category", "content"), "content", ("name", "category", "content", "details"),
+               ("name", "未命名风格")),
+}
+LIBRARY_TAG_KEYS = {"characters": "character_tags", "glossary": "glossary_tags", "styles": "style_tags"}
+
+list_orders = {}  # 库名 -> (库对象, etag_epoch, 修改序号, 条目ID列表, ID -> 位置)
+
+def library_order(store, entries):
+    """库条目ID的顺序与位置，库未修改时复用上次的结果（须持有库锁）"""
+    key = (entries, etag_epoch, STORE_VERSIONS.get(store, 0))
+    cached = list_orders.get(store)
+    if cached is None or cached[0] is not entries or cached[1:3] != key[1:]:
+        ids = list(entries)
+        cached = list_orders[store] = key + (ids, {entry_id: i for i, entry_id in enumerate(ids)})
+    return cached[3], cached[4]
+
+def encode_cursor(ids, position):
+    """游标记录下一页的起点、上一页最后一条与下一页第一条的ID"""
+    state = [position, ids[position - 1], ids[position]]
+    return base64.urlsafe_b64encode(json_dumps(state).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, ids, positions):
+    """游标 -> 下一页在 ids 中的起点；两页之间有条目被删除时按仍存在的ID定位"""
+    try:
+        position, last_id, next_id = json_loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        position = int(position)
+        if not all(item_id is None or isinstance(item_id, str) for item_id in (last_id, next_id)):
+            raise ValueError("cursor ids must be strings")
+    except (ValueError, TypeError):
+        raise ValueError("无效的分页游标")
+    if next_id in positions:
+        return positions[next_id]
+    if last_id in positions:
+        return positions[last_id] + 1
+    # 两条都被删除：起点之前至少少了一条
+    return min(max(position - 1, 0), len(ids))
+
+def novel_tag_ids(novel_id, store):
+    """小说关联的条目ID（标签是条目对象或ID）与小说当前的版本"""
+    with novel_lock(novel_id):
+        if novel_id not in novels_db:
+            return None, None
+        novel = novels_db.meta(novel_id)
+        tags = novel.get(LIBRARY_TAG_KEYS[store], []) or []
+        ids = [tag.get("id") if isinstance(tag, dict) else tag for tag in tags]
+        return ids, (novels_db.version(novel_id), novel.get("revision", 0))
+
+def positive_int_arg(name, default):
+    """查询参数中的正整数；未提供时返回 default，不是正整数（含 abc、0、-5）时返回 None"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+def list_library(store, novel_id=None):
+    """分页列出库条目：不含 fields= 时返回摘要字段（长文本截断），带 ETag"""
+    default_fields, truncated, allowed, (name_field, default_name) = LIBRARY_LISTS[store]
+    fields = request.args.get('fields')
+    if fields:
+        fields = [field.strip() for field in fields.split(',') if field.strip() and field.strip() != 'id']
+        unknown = [field for field in fields if field not in allowed]
+        if unknown:
+            return jsonify({"error": f"未知字段: {', '.join(unknown)}"}), 400
+    limit = positive_int_arg('limit', LIBRARY_PAGE_SIZE)
+    if limit is None:
+        return jsonify({"error": "limit 必须是正整数"}), 400
+    limit = min(limit, LIBRARY_PAGE_MAX)
+    categories = set(request.args.getlist('category'))
+
+    novel_id = novel_id or request.args.get('novel_id')
+    tag_ids = novel_version = None
+    if novel_id:
+        tag_ids, novel_version = novel_tag_ids(novel_id, store)
+        if tag_ids is None:
+            return jsonify({"error": "小说不存在"}), 404
+
+    with store_lock(store):
+        etag = make_etag("library", store, STORE_VERSIONS.get(store, 0), novel_id, novel_version)
+        tag = matched_etag(etag)
+        if tag is not None:
+            return not_modified_response(tag)
+        entries = library_dbs()[store]
+        if tag_ids is None:
+            ids, positions = library_order(store, entries)
+        else:
+            ids = list(dict.fromkeys(entry_id for entry_id in tag_ids if entry_id in entries))
+            positions = {entry_id: i for i, entry_id in enumerate(ids)}
+        start = 0
+        if request.args.get('cursor'):
+            try:
+                start = decode_cursor(request.args['cursor'], ids, positions)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+        items, next_cursor = [], None
+        for i in range(start, len(ids)):
+            data = entries[ids[i]]
+            if categories and data.get("category", "") not in categories:
+                continue
+            if len(items) == limit:
+                next_cursor = encode_cursor(ids, i)
+                break
+            item = {"id": ids[i]}
+            for field in fields or default_fields:
+                value = data.get(field, default_name if field == name_field else {} if field == "details" else "")
+                if not fields and field == truncated and isinstance(value, str) and len(value) > SUMMARY_LENGTH:
+                    value = value[:SUMMARY_LENGTH] + "..."
+                item[field] = value
+            items.append(item)
+
+    response = jsonify(items)
+    response.set_etag(etag)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
 # --- API Endpoints ---
 
 @app.route('/')
@@ -381,11 +4395,19 @@ def list_models():
     
     # Get custom API models from configurations
     custom_models = []
-    for api_id, config in CUSTOM_API_CONFIGS.items():
-        custom_models.append({
-            "id": f"custom-{api_id}", 
-            "name": f"{config['name']} - {config['modelName']}"
-        })
+    with store_lock("api_configs"):
+        for api_id, config in CUSTOM_API_CONFIGS.items():
+            custom_models.append({
+                "id": f"custom-{api_id}", 
+                "name": f"{config['name']} - {config['modelName']}"
+            })
+    # Routing groups: requests go to the fastest healthy member
+    with store_lock("routes"):
+        for group_id, group in ROUTE_GROUPS.items():
+            custom_models.append({
+                "id": f"route-{group_id}",
+                "name": f"路由组: {group['name']}（{len(group['members'])} 个模型）"
+            })
     
     # Combine both lists
     all_models = openrouter_models + custom_models
@@ -399,7 +4421,7 @@ def list_models():
 def get_novels():
     """API endpoint to list all novels."""
     # Return a list of novels with id and title
-    novel_list = [{"id": novel_id, "title": data.get("title", "Untitled")} for novel_id, data in novels_db.items()]
+    novel_list = [{"id": novel_id, "title": novels_db.title(novel_id)} for novel_id in novels_db]
     return jsonify(novel_list)
 
 @app.route('/api/novels', methods=['POST'])
@@ -424,7 +4446,7 @@ def create_novel():
     novels_db[novel_id] = new_novel
     logging.info(f"Created novel in memory: {novel_id} - {data['title']}")
     
-    if save_novels():  # 保存小说数据并检查结果
+    if save_novel(novel_id, content=True):  # 保存小说数据并检查结果
         logging.info(f"Successfully saved novel {novel_id} to file.")
         return jsonify({"id": novel_id, "title": new_novel["title"]}), 201 # 201 Created status
     else:
@@ -436,6 +4458,8 @@ def create_novel():
         return jsonify({"id": novel_id, "title": new_novel["title"], "warning": "Failed to save novel to file"}), 201 # Still return 201 but add a warning
 
 @app.route('/api/novels/<novel_id>', methods=['GET'])
+@with_novel_lock
+@with_etag(novel_etag)
 def get_novel(novel_id):
     """API endpoint to get details of a specific novel."""
     novel = novels_db.get(novel_id)
@@ -444,6 +4468,7 @@ def get_novel(novel_id):
             "id": novel_id,
             "title": novel.get("title", "Untitled"),
             "content": novel.get("content", ""),
+            "revision": novel.get("revision", 0),
             "characters": novel.get("characters", ""), # Return text field
             "knowledge": novel.get("knowledge", ""),
             "style_prompt": novel.get("style_prompt", ""), # Return text field
@@ -456,6 +4481,7 @@ def get_novel(novel_id):
         return jsonify({"message": "Novel not found"}), 404
 
 @app.route('/api/novels/<novel_id>', methods=['PUT', 'PATCH'])
+@with_novel_lock
 def update_novel(novel_id):
     """API endpoint to update a novel's content (or other fields)."""
     if novel_id not in novels_db:
@@ -464,6 +4490,9 @@ def update_novel(novel_id):
     data = request.get_json()
     if not data:
         return jsonify({"message": "No update data provided"}), 400
+    conflict = revision_conflict(novels_db[novel_id], data)
+    if conflict:
+        return conflict
 
     # Update fields provided in the request
     if 'title' in data:
@@ -484,25 +4513,53 @@ def update_novel(novel_id):
         novels_db[novel_id]['glossary_tags'] = data['glossary_tags']
     if 'style_tags' in data:
         novels_db[novel_id]['style_tags'] = data['style_tags']
+    if any(field in data for field in ('title', 'content', 'characters', 'knowledge', 'style_prompt',
+                                       'character_tags', 'glossary_tags', 'style_tags')):
+        bump_revision(novels_db[novel_id])
 
     print(f"Updated novel: {novel_id}")
-    save_novels()  # 保存小说数据
-    return jsonify({"message": "Novel updated successfully", "id": novel_id})
+    save_novel(novel_id, content='content' in data)  # 保存小说数据
+    return jsonify({"message": "Novel updated successfully", "id": novel_id,
+                    "revision": novels_db[novel_id].get('revision', 0)})
+
+@app.route('/api/novels/<novel_id>/content', methods=['PATCH'])
+@with_novel_lock
+def patch_novel_content(novel_id):
+    """Apply a text patch (ops or unified diff) to a novel's content against a base revision."""
+    novel = novels_db.get(novel_id)
+    if novel is None:
+        return jsonify({"error": "Novel not found"}), 404
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "No patch data provided"}), 400
+
+    body, status, content = patch_content(novel, data, novel.get("content", ""))
+    if status == 200:
+        novel["content"] = content
+        save_novel(novel_id, content=True)
+        body["id"] = novel_id
+    return jsonify(body), status
 
 @app.route('/api/novels/<novel_id>', methods=['DELETE'])
+@with_novel_lock
 def delete_novel(novel_id):
     """API endpoint to delete a specific novel."""
     if novel_id in novels_db:
+        conflict = revision_conflict(novels_db[novel_id], request.get_json(silent=True))
+        if conflict:
+            return conflict
         deleted_title = novels_db[novel_id].get('title', 'Untitled')
         del novels_db[novel_id]
+        chapter_history.forget(novel_id)
         print(f"Deleted novel: {novel_id} - {deleted_title}")
-        save_novels()  # 保存小说数据
+        save_novel(novel_id)  # 删除小说分片
         return jsonify({"message": f"Novel '{deleted_title}' deleted successfully"})
     else:
         print(f"Attempted to delete non-existent novel: {novel_id}")
         return jsonify({"message": "Novel not found"}), 404
 
 @app.route('/api/set-api-key', methods=['POST'])
+@with_store_lock("api_key")
 def set_api_key():
     """API endpoint to set and validate the OpenRouter API key."""
     global OPENROUTER_API_KEY
@@ -523,6 +4580,7 @@ def set_api_key():
     
     # 保存API密钥到文件
     save_api_key()
+    warm_upstreams([OPENROUTER_API_BASE])
     
     return jsonify({"message": "API密钥已成功设置并保存"})
 
@@ -540,23 +4598,449 @@ def get_api_key_status():
         "key_preview": key_preview
     })
 
-@app.route('/api/generate', methods=['POST'])
-def generate_text():
-    """API endpoint to generate text using OpenRouter or custom APIs."""
-    data = request.get_json()
+def prepend_event(event, stream):
+    """Send an extra SSE event (e.g. the context accounting) before the generated tokens."""
+    if event:
+        yield event
+    yield from stream
+
+@app.route('/api/context', methods=['POST'])
+def preview_context():
+    """Preview the prompt /api/generate would assemble for the same "prompt" and "context" fields."""
+    data = request.get_json(silent=True) or {}
+    prompt, accounting, error = context_request(data)
+    if error is not None:
+        return error
+    return jsonify({"prompt": prompt, "accounting": accounting})
+
+def sse_event(data):
+    return f"data: {json_dumps(data)}\n\n"
+
+# Fast models stream thousands of tiny deltas per response. Deltas arriving within SSE_COALESCE_INTERVAL of the
+# last frame are merged into the next one (sent once the interval has passed or SSE_COALESCE_CHARS are buffered),
+# cutting json encoding, bytes on the wire and client reflows; a slow stream still gets every delta at once.
+# If the upstream pauses, the async gateway sends buffered deltas when they are due, while the threaded path
+# sends them with the next line. BMXH_SSE_COALESCE_MS=0 sends one frame per delta
+SSE_COALESCE_INTERVAL = float(os.environ.get('BMXH_SSE_COALESCE_MS', '30')) / 1000
+SSE_COALESCE_CHARS = int(os.environ.get('BMXH_SSE_COALESCE_CHARS', '512'))
+
+class FrameCoalescer:
+    """Buffers reasoning/token deltas and turns them into SSE frames, one frame per run of the same kind."""
+
+    def __init__(self):
+        self.runs = []  # [kind, [text, ...]] in arrival order
+        self.size = 0
+        self.sent = None  # time.perf_counter() of the last frame
+
+    def add(self, kind, text):
+        if self.runs and self.runs[-1][0] == kind:
+            self.runs[-1][1].append(text)
+        else:
+            self.runs.append([kind, [text]])
+        self.size += len(text)
+
+    def wait_time(self):
+        """Seconds until the buffered deltas are due; None when nothing is buffered."""
+        if not self.runs:
+            return None
+        if self.sent is None:
+            return 0.0
+        return max(0.0, self.sent + SSE_COALESCE_INTERVAL - time.perf_counter())
+
+    def take(self, force=False):
+        """SSE frames for the buffered deltas if they are due (or force); otherwise keep buffering."""
+        if not self.runs or not (force or self.size >= SSE_COALESCE_CHARS or self.wait_time() <= 0):
+            return []
+        events = [sse_event({kind: "".join(texts)}) for kind, texts in self.runs]
+        self.runs, self.size, self.sent = [], 0, time.perf_counter()
+        return events
+
+class GenerationJob:
+    """One upstream generation request, plus the state for turning its streamed lines into SSE events.
+    Shared by the threaded Flask route and the async gateway."""
+
+    def __init__(self, provider, model, api_url, headers, payload, context_event, prompt_tokens, prompt_truncated):
+        self.provider, self.model = provider, model
+        self.api_url, self.headers, self.payload = api_url, headers, payload
+        self.context_event = context_event
+        self.prompt_tokens, self.prompt_truncated = prompt_tokens, prompt_truncated
+        self.parts, self.upstream_usage = [], None  # parts: [("reasoning" | "token", text)]
+        self.frames = FrameCoalescer()
+        # Identifies identical requests, for the generation cache and for coalescing concurrent streams
+        self.key = generation_cache_key('generate', api_url, payload)
+        self.cache_key = self.cached = None
+        self.ttft = self.response = self.route = None
+        self.cancelled = False  # a hedged attempt that lost to another routing group member
+        # Request slot with the upstream scheduler: 429/5xx responses are retried before any output
+        self.provider_key, self.priority = provider_key(model), PRIORITY_INTERACTIVE
+        self.retries, self.ticket = UPSTREAM_RETRIES, None
+
+    def use_cache(self):
+        """Look the request up in the generation cache; a hit is replayed instead of calling the upstream."""
+        self.cache_key = self.key
+        self.cached = generation_cache.get(self.key)
+
+    def feed(self, line):
+        """Parse one upstream line; returns (SSE events to send, whether the stream has finished).
+        Deltas are buffered by self.frames, so a line may return no events and a later one several."""
+        if line.startswith('data: '):
+            data_content = line[len('data: '):]
+            if data_content.strip() == '[DONE]':
+                logging.debug("Stream finished.")
+                return self.frames.take(force=True), True
+            try:
+                chunk = json_loads(data_content)
+            except ValueError:
+                logging.warning(f"Error decoding stream JSON chunk: {data_content}")
+                return self.frames.take(), False
+            self.upstream_usage = chunk.get('usage') or self.upstream_usage
+            # Typically: chunk['choices'][0]['delta']['content']
+            if 'choices' in chunk and len(chunk['choices']) > 0:
+                delta = chunk['choices'][0].get('delta', {})
+                # 兼容 ModelScope reasoning_content
+                reasoning = delta.get('reasoning_content')
+                token = delta.get('content')
+                if reasoning:
+                    self.parts.append(('reasoning', reasoning))
+                    self.frames.add('reasoning', reasoning)
+                if token:
+                    self.parts.append(('token', token))
+                    self.frames.add('token', token)
+
+                finish_reason = chunk['choices'][0].get('finish_reason')
+                if finish_reason:
+                    logging.debug(f"Stream finished with reason: {finish_reason}")
+                    return self.frames.take(force=True), True
+        elif line.strip():  # Log other non-empty lines for debugging
+            logging.debug(f"Received non-data line: {line}")
+        return self.frames.take(), False
+
+    def flush(self):
+        """Threaded path: ("output", event) for the deltas still buffered when the stream ends or fails."""
+        for event in self.frames.take(force=True):
+            yield 'output', event
+
+    def usage_event(self, cached=False):
+        usage = usage_report(self.model, self.prompt_tokens, "".join(text for _, text in self.parts),
+                             self.upstream_usage, self.prompt_truncated)
+        if cached:
+            usage['cached'] = True
+        if self.route:
+            usage['route'] = self.route
+        return sse_event({'usage': usage})
+
+    def output_started(self, started):
+        """Record the time to first output (TTFT) of this request, once, for the provider router."""
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - started
+            provider_router.record_success(self.model, self.ttft)
+
+    def failed(self, error):
+        """Record a failed request for the provider router; returns the UpstreamError to raise."""
+        if not self.cancelled:
+            provider_router.record_failure(self.model, error)
+        return error
+
+    def queue_event(self, position):
+        return sse_event({'queue': {'position': position, 'provider': self.provider}})
+
+    def retry_event(self, retry, delay, status):
+        return sse_event({'queue': {'retry': retry, 'delay': round(delay, 1), 'status': status,
+                                    'provider': self.provider}})
+
+    def wait_turn(self, delay=0.0):
+        """Threaded path: queue for a request slot with the provider, yielding {"queue"} events while waiting."""
+        self.ticket = upstream_scheduler.request(self.provider_key, self.priority, delay)
+        for position in upstream_scheduler.wait(self.ticket):
+            yield self.queue_event(position)
+
+    def release(self):
+        """Give the request slot back (safe to call more than once)."""
+        if self.ticket is not None:
+            upstream_scheduler.release(self.ticket)
+
+    def cancel(self):
+        """Stop reading the upstream (the losing side of a hedged request). Closing the response from another
+        thread would block on the reading thread, so that thread closes it at its next line (or read timeout)."""
+        self.cancelled = True
+
+    def completed(self):
+        """The upstream stream ended normally: store the output when caching is on."""
+        if self.cache_key is not None and self.parts:
+            generation_cache.put(self.cache_key, {"parts": self.parts, "usage": self.upstream_usage})
+
+    def replay(self):
+        """SSE events of a cache hit: the stored output merged into one event per kind, then usage."""
+        self.parts = [tuple(part) for part in self.cached["parts"]]
+        self.upstream_usage = self.cached.get("usage")
+        for kind in ('reasoning', 'token'):
+            text = "".join(text for part_kind, text in self.parts if part_kind == kind)
+            if text:
+                yield sse_event({kind: text})
+        yield self.usage_event(cached=True)
+
+    def error_message(self, error, status=None, body=None):
+        """Error text for the client; uses the upstream's error.message when its response has one."""
+        error = str(error) or type(error).__name__
+        if status is None:
+            return f"Failed to generate text via {self.provider}. Request Error: {error}"
+        try:
+            error_detail = json.loads(body).get('error', {}).get('message', error)
+            return f"{self.provider} error (Status {status}): {error_detail}"
+        except Exception:
+            return f"Failed to generate text via {self.provider}. {error} Raw Response: {(body or '')[:200]}..."
+
+    def events(self):
+        """Threaded path: wait for a slot with the provider, then request the upstream through the connection pool.
+        Yields ("queue", event) while queued or waiting to retry a 429/5xx response, then ("output", event) for
+        each reasoning/token event. Raises UpstreamError if the request fails."""
+        try:
+            delay = 0.0
+            for retry in range(self.retries + 1):
+                for event in self.wait_turn(delay):
+                    yield 'queue', event
+                if self.cancelled:
+                    return
+                started = time.perf_counter()
+                self.response = upstream_post(self.api_url, headers=self.headers, json=self.payload, stream=True)
+                status = self.response.status_code
+                delay = upstream_scheduler.retry_delay(self.provider_key, status,
+                                                       retry_after_seconds(self.response.headers.get('Retry-After')),
+                                                       retry, self.retries)
+                if delay is None:
+                    break
+                self.response.close()
+                self.release()
+                yield 'queue', self.retry_event(retry + 1, delay, status)
+            self.response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+            for line in stream_lines(self.response):
+                if self.cancelled:
+                    self.response.close()  # before stream_lines would drain the rest of the stream
+                    return
+                if line:
+                    events, finished = self.feed(line.decode('utf-8'))
+                    if events:
+                        self.output_started(started)
+                    for event in events:
+                        yield 'output', event
+                    if finished:
+                        break
+            yield from self.flush()
+            self.output_started(started)
+        except requests.exceptions.RequestException as e:
+            # Handle connection errors, timeouts, etc.
+            logging.warning(f"Error connecting to {self.provider}: {e}")
+            yield from self.flush()
+            if e.response is not None:
+                raise self.failed(UpstreamError(self.error_message(e, e.response.status_code, e.response.text),
+                                                e.response.status_code,
+                                                retry_after_seconds(e.response.headers.get('Retry-After'))))
+            raise self.failed(UpstreamError(self.error_message(e)))
+        except Exception as e:
+            error_message = f"An unexpected error occurred during {self.provider} generation: {e}"
+            logging.warning(error_message)
+            yield from self.flush()
+            raise self.failed(UpstreamError(error_message))
+        finally:
+            # Return the connection to the pool (or close it) and the slot to the scheduler
+            if self.response is not None:
+                self.response.close()
+            self.release()
+
+    def stream(self):
+        """Threaded path: the SSE events of this request, ending with usage (or an error event)."""
+        try:
+            for _, event in self.events():
+                yield event
+            self.completed()
+            yield self.usage_event()
+        except UpstreamError as e:
+            yield sse_event({'error': str(e)})
+        finally:
+            logging.debug("Closing stream generator.")
+
+class RoutedJob:
+    """A /api/generate request to a routing group: one GenerationJob per member, tried in provider router order.
+    A member that fails before its first output fails over to the next one; a slow first output is hedged by
+    starting the next member as well, and the first to produce output wins. Used like a GenerationJob by the
+    threaded route (stream) and the async gateway (which runs the attempts as tasks through handle)."""
+
+    def __init__(self, group, jobs, context_event, key):
+        self.group, self.jobs = group, jobs
+        self.context_event = context_event
+        self.key = key
+        self.cache_key = self.cached = None
+        self.hedge = ROUTE_HEDGE and group.get('hedge', True)
+        self.started = 0
+        self.running = set()   # indexes of attempts still reading their upstream
+        self.launched = {}     # index -> perf_counter() when the attempt started
+        self.hedged = set()    # attempts started by hedging rather than failover
+        self.errors = []
+        self.winner = None
+        self.succeeded = False
+
+    def use_cache(self):
+        """Same as GenerationJob.use_cache; the winning member stores its output under the group's key."""
+        self.cache_key = self.key
+        self.cached = generation_cache.get(self.key)
+        for job in self.jobs:
+            job.cache_key = self.key
+
+    def replay(self):
+        job = self.jobs[0]
+        job.cached = self.cached
+        return job.replay()
+
+    def launch(self, hedge=False):
+        """Start bookkeeping for the next member; returns its index, or None when every member was tried."""
+        if self.started >= len(self.jobs):
+            return None
+        index = self.started
+        self.started += 1
+        self.running.add(index)
+        self.launched[index] = time.perf_counter()
+        if hedge:
+            self.hedged.add(index)
+            provider_router.count('hedges')
+            logging.info(f"[模型路由] {self.jobs[index - 1].model} 迟迟没有输出，同时请求 {self.jobs[index].model}")
+        return index
+
+    def hedge_timeout(self):
+        """Seconds until the next member should be started alongside the running ones; None when it never should."""
+        if not self.hedge or self.winner is not None or not self.running or self.started >= len(self.jobs):
+            return None
+        latest = self.started - 1
+        delay = provider_router.hedge_delay(self.jobs[latest].model)
+        return max(0.0, self.launched[latest] + delay - time.perf_counter())
+
+    def handle(self, index, kind, value, start, cancel):
+        """Apply one result of attempt `index`: kind "output" (value: an SSE event), "end" or "error"
+        (value: UpstreamError), or "queue" (value: an SSE event). start(index) / cancel(index) start or stop an attempt.
+        Returns (SSE events to send, whether the request is over)."""
+        if kind == 'queue':
+            # Queue position / retry progress, only while no member has produced output
+            return ([value] if self.winner is None else []), False
+        if kind == 'output' or (kind == 'end' and self.winner is None):
+            if self.winner is None:
+                self.winner = index
+                if index in self.hedged:
+                    provider_router.count('hedge_wins')
+                for other in self.running - {index}:
+                    self.running.discard(other)
+                    cancel(other)
+            if kind == 'output':
+                return ([value] if index == self.winner else []), False
+        self.running.discard(index)
+        if kind == 'end':
+            self.succeeded = index == self.winner
+            return [], self.succeeded
+        if index == self.winner:
+            # Output was already sent, so the request can no longer move to another member
+            return [sse_event({'error': str(value)})], True
+        if self.winner is not None:
+            return [], False
+        self.errors.append(f"{self.jobs[index].model}: {value}")
+        if self.running:
+            return [], False
+        following = self.launch()
+        if following is None:
+            return [sse_event({'error': f"路由组 {self.group['name']} 中的模型都请求失败。" + "；".join(self.errors)})], True
+        provider_router.count('failovers')
+        logging.info(f"[模型路由] {self.jobs[index].model} 请求失败，改用 {self.jobs[following].model}")
+        start(following)
+        return [], False
+
+    def usage_event(self):
+        job = self.jobs[self.winner]
+        job.route = {"group": self.group['id'], "model": job.model, "attempts": self.started,
+                     "failovers": len(self.errors), "hedged": bool(self.hedged)}
+        return job.usage_event()
+
+    def run_attempt(self, index, results):
+        """Threaded path: read one member's upstream in its own thread, posting (index, kind, value) to results."""
+        events = self.jobs[index].events()
+        try:
+            for kind, event in events:
+                results.put((index, kind, event))
+        except UpstreamError as e:
+            results.put((index, 'error', e))
+        else:
+            results.put((index, 'end', None))
+        finally:
+            events.close()
+
+    def stream(self):
+        """Threaded path: SSE events of the winning member, ending with usage (or an error event)."""
+        results = queue.Queue()
+
+        def start(index):
+            threading.Thread(target=self.run_attempt, args=(index, results), name="route-attempt", daemon=True).start()
+
+        def cancel(index):
+            self.jobs[index].cancel()
+
+        start(self.launch())
+        try:
+            while True:
+                try:
+                    index, kind, value = results.get(timeout=self.hedge_timeout())
+                except queue.Empty:
+                    start(self.launch(hedge=True))
+                    continue
+                events, over = self.handle(index, kind, value, start, cancel)
+                yield from events
+                if over:
+                    break
+            if self.succeeded:
+                self.jobs[self.winner].completed()
+                yield self.usage_event()
+        finally:
+            # The client disconnected or the request is over: stop attempts still running
+            for index in list(self.running):
+                cancel(index)
+            logging.debug("Closing stream generator.")
+
+def prepare_generation(data):
+    """Validate a /api/generate body and build the upstream request: (GenerationJob, None) or (None, error response)."""
     if not data or 'model' not in data or 'prompt' not in data:
-        return jsonify({"error": "Missing required fields: model and prompt"}), 400
+        return None, (jsonify({"error": "Missing required fields: model and prompt"}), 400)
 
     model = data['model']
     prompt = data['prompt']
     temperature = data.get('temperature', 0.7)  # Default temperature to 0.7
 
+    # With "context", prompt is only the task instruction; the server assembles the rest under a token budget
+    context_event = None
+    if 'context' in data:
+        prompt, accounting, error = context_request(data)
+        if error is not None:
+            return None, error
+        context_event = sse_event({'context': accounting})
+
+    if model.startswith('route-'):
+        job, error = routed_generation_job(model, prompt, temperature, context_event)
+    else:
+        job, error = generation_job(model, prompt, temperature, context_event)
+    if error is not None:
+        return None, error
+
+    # Deterministic (temperature 0) generations are served from the cache unless the body sets "cache": false
+    if use_generation_cache(data, float(temperature) == 0):
+        job.use_cache()
+    return job, None
+
+def generation_job(model, prompt, temperature, context_event):
+    """Build the upstream request for one model: (GenerationJob, None) or (None, error response)."""
+    # Trim the prompt to the model's context window (keeping its end: recent text and the instruction);
+    # the token usage is reported in a final {"usage": ...} event
+    prompt, prompt_tokens, prompt_truncated = fit_prompt(model, prompt, keep_end=True)
+
     # Check if this is a custom API model
     if model.startswith('custom-'):
         api_id = model.replace('custom-', '', 1)
         if api_id not in CUSTOM_API_CONFIGS:
-            return jsonify({"error": "Custom API configuration not found"}), 404
-        
+            return None, (jsonify({"error": "Custom API configuration not found"}), 404)
+
         # Get the API configuration
         api_config = CUSTOM_API_CONFIGS[api_id]
         base_url = api_config['baseUrl']
@@ -571,7 +5055,7 @@ def generate_text():
         # --- END NEW LOGIC ---
         secret = api_config['secret']
         model_name = api_config['modelName']
-        
+
         # Prepare headers based on configuration
         headers = {
             "Content-Type": "application/json"
@@ -588,84 +5072,16 @@ def generate_text():
             "temperature": float(temperature),
             "stream": True
         }
-        
-        # 调试用，打印请求信息
-        print('请求URL:', api_url)
-        print('请求Headers:', headers)
-        print('请求Body:', json.dumps(custom_payload, ensure_ascii=False))
-        
-        try:
-            # Create streaming response
-            def event_stream():
-                try:
-                    response = requests.post(
-                        api_url, 
-                        headers=headers, 
-                        json=custom_payload, 
-                        stream=True
-                    )
-                    response.raise_for_status()
-                    
-                    # Stream the response
-                    for line in response.iter_lines():
-                        if line:
-                            decoded_line = line.decode('utf-8')
-                            if decoded_line.startswith('data: '):
-                                data_content = decoded_line[len('data: '):]
-                                if data_content.strip() == '[DONE]':
-                                    print("Stream finished.")
-                                    break
-                                try:
-                                    chunk = json.loads(data_content)
-                                    # Extract token from response format
-                                    if 'choices' in chunk and len(chunk['choices']) > 0:
-                                        delta = chunk['choices'][0].get('delta', {})
-                                        # 兼容 ModelScope reasoning_content
-                                        reasoning = delta.get('reasoning_content')
-                                        token = delta.get('content')
-                                        if reasoning:
-                                            yield f"data: {json.dumps({'reasoning': reasoning})}\n\n"
-                                        if token:
-                                            yield f"data: {json.dumps({'token': token})}\n\n"
-                                        
-                                        finish_reason = chunk['choices'][0].get('finish_reason')
-                                        if finish_reason:
-                                            print(f"--> Stream finished with reason: {finish_reason}")
-                                            break
-                                except json.JSONDecodeError:
-                                    print(f"Error decoding stream JSON chunk: {data_content}")
-                            elif decoded_line.strip():
-                                print(f"Received non-data line: {decoded_line}")
-                except requests.exceptions.RequestException as e:
-                    error_message = f"Error connecting to custom API: {e}"
-                    print(error_message)
-                    try:
-                        if e.response is not None:
-                            error_detail = e.response.json().get('error', {}).get('message', str(e))
-                            error_message = f"Custom API error (Status {e.response.status_code}): {error_detail}"
-                        else:
-                            error_message = f"Failed to generate text via custom API. Request Error: {str(e)}"
-                    except Exception:
-                        error_message = f"Failed to generate text via custom API. {str(e)}"
-                        if e.response is not None:
-                            error_message += f" Raw Response: {e.response.text[:200]}..."
-                    
-                    yield f"data: {json.dumps({'error': error_message})}\n\n"
-                except Exception as e:
-                    error_message = f"An unexpected error occurred during custom API generation: {e}"
-                    print(error_message)
-                    yield f"data: {json.dumps({'error': error_message})}\n\n"
-                finally:
-                    print("Closing stream generator.")
-            
-            return Response(stream_with_context(event_stream()), mimetype='text/event-stream')
-        except Exception as e:
-            print(f"Error setting up custom API request: {e}")
-            return jsonify({"error": f"Failed to generate text via custom API: {str(e)}"}), 500
-    
+
+        # 调试用，记录请求信息（请求头含密钥，不记录）
+        logging.debug(f"请求URL: {api_url}")
+        logging.debug(f"请求Body: {json_dumps(custom_payload)}")
+        return GenerationJob("Custom API", model, api_url, headers, custom_payload, context_event,
+                             prompt_tokens, prompt_truncated), None
+
     # If not a custom API, use OpenRouter (existing logic)
     if not OPENROUTER_API_KEY:
-        return jsonify({"error": "请先设置OpenRouter API密钥。您可以在页面顶部的设置区域中输入并保存API密钥。"}), 401
+        return None, (jsonify({"error": "请先设置OpenRouter API密钥。您可以在页面顶部的设置区域中输入并保存API密钥。"}), 401)
 
     # --- OpenRouter API Request Logic ---
     openrouter_payload = {
@@ -687,112 +5103,45 @@ def generate_text():
         # "HTTP-Referer": $YOUR_SITE_URL, # Optional
         # "X-Title": $YOUR_SITE_NAME # Optional
     }
+    # Use the OpenRouter chat completions endpoint with streaming enabled
+    return GenerationJob("OpenRouter API", model, f"{OPENROUTER_API_BASE}/chat/completions", headers,
+                         openrouter_payload, context_event, prompt_tokens, prompt_truncated), None
+
+def routed_generation_job(model, prompt, temperature, context_event):
+    """Build a RoutedJob for a route-<group ID> model: one GenerationJob per usable member, in router order."""
+    group = ROUTE_GROUPS.get(model.replace('route-', '', 1))
+    if group is None:
+        return None, (jsonify({"error": "Routing group not found"}), 404)
+    jobs = []
+    for member in provider_router.order(group['members']):
+        job, error = generation_job(member, prompt, temperature, None)
+        if error is None:
+            jobs.append(job)
+    if len(jobs) > 1:
+        # Fail over to the next member instead of waiting to retry a 429/5xx response
+        for job in jobs:
+            job.retries = 0
+    if not jobs:
+        return None, (jsonify({"error": f"路由组 {group['name']} 中没有可用的模型（自定义API已删除或未设置OpenRouter API密钥）"}), 503)
+    # Members differ in model and URL; the cache and request coalescing key on the group instead
+    key = generation_cache_key('generate', model, {"messages": [{"role": "user", "content": prompt}],
+                                                   "temperature": float(temperature)})
+    return RoutedJob(group, jobs, context_event, key), None
 
-    try:
-        # --- Streaming Response Handling ---
-        def event_stream():
-            try:
-                # Use the OpenRouter chat completions endpoint with streaming enabled
-                response = requests.post(
-                    f"{OPENROUTER_API_BASE}/chat/completions", 
-                    headers=headers, 
-                    json=openrouter_payload, 
-                    stream=True # Enable streaming in requests
-                )
-                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-                # Iterate over the response lines
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith('data: '):
-                            data_content = decoded_line[len('data: '):]
-                            if data_content.strip() == '[DONE]': # Check for OpenRouter stream end signal
-                                print("Stream finished.")
-                                break
-                            try:
-                                chunk = json.loads(data_content)
-                                # Extract token from OpenRouter's streaming format
-                                # Typically: chunk['choices'][0]['delta']['content']
-                                if 'choices' in chunk and len(chunk['choices']) > 0:
-                                    delta = chunk['choices'][0].get('delta', {})
-                                    # 兼容 ModelScope reasoning_content
-                                    reasoning = delta.get('reasoning_content')
-                                    token = delta.get('content')
-                                    if reasoning:
-                                        yield f"data: {json.dumps({'reasoning': reasoning})}\n\n"
-                                    if token:
-                                        yield f"data: {json.dumps({'token': token})}\n\n"
-                                    
-                                    finish_reason = chunk['choices'][0].get('finish_reason')
-                                    if finish_reason:
-                                        print(f"--> Stream finished with reason: {finish_reason}") # Enhanced logging
-                                        # Optionally send a final signal
-                                        # yield f"data: {json.dumps({'event': 'finish', 'reason': finish_reason})}\n\n"
-                                        break # Stop sending after finish reason
-
-                            except json.JSONDecodeError:
-                                print(f"Error decoding stream JSON chunk: {data_content}")
-                                # yield f"data: {json.dumps({'error': 'Invalid JSON chunk'})}\n\n"
-                                # Continue to next line
-                        elif decoded_line.strip(): # Log other non-empty lines for debugging
-                             print(f"Received non-data line: {decoded_line}")
-
-            except requests.exceptions.RequestException as e:
-                # Handle connection errors, timeouts, etc.
-                error_message = f"Error connecting to OpenRouter: {e}"
-                print(error_message)
-                # Try to get more specific error from response if available and it's a JSON response
-                try:
-                    if e.response is not None:
-                        error_detail = e.response.json().get('error', {}).get('message', str(e))
-                        error_message = f"OpenRouter API error (Status {e.response.status_code}): {error_detail}"
-                    else:
-                        error_message = f"Failed to generate text via OpenRouter. Request Error: {str(e)}"
-                except Exception:
-                    error_message = f"Failed to generate text via OpenRouter. {str(e)}"
-                    if e.response is not None:
-                        error_message += f" Raw Response: {e.response.text[:200]}..."
-                
-                # Send error back via SSE
-                yield f"data: {json.dumps({'error': error_message})}\n\n"
-            except Exception as e:
-                error_message = f"An unexpected error occurred during OpenRouter generation: {e}"
-                print(error_message)
-                yield f"data: {json.dumps({'error': error_message})}\n\n"
-            finally:
-                # Ensure a final signal is sent if needed, or just close
-                print("Closing stream generator.")
-                # yield f"data: [DONE]\n\n" # Optionally send a custom end signal
-
-        # Return the streaming response
-        return Response(stream_with_context(event_stream()), mimetype='text/event-stream')
-
-    except requests.exceptions.RequestException as e:
-        # Handle connection errors, timeouts, etc.
-        error_message = f"Error connecting to OpenRouter: {e}"
-        print(error_message)
-            # Try to get more specific error from response if available and it's a JSON response
-        # --- This error handling is for the initial request, not the stream itself ---
-        # --- Stream errors are handled within event_stream --- 
-        try:
-            if e.response is not None:
-                error_detail = e.response.json().get('error', {}).get('message', str(e))
-                error_message = f"OpenRouter API error (Status {e.response.status_code}): {error_detail}"
-            else:
-                error_message = f"Failed to generate text via OpenRouter. Request Error: {str(e)}"
-        except Exception:
-            error_message = f"Failed to generate text via OpenRouter. {str(e)}"
-            if e.response is not None:
-                error_message += f" Raw Response: {e.response.text[:200]}..."
-
-        return jsonify({"error": error_message}), 500
-    except json.JSONDecodeError:
-            print(f"Error decoding JSON response from OpenRouter generation: {response.text}")
-            return jsonify({"error": "Invalid response format from OpenRouter generation."}), 500
-    except Exception as e:
-        print(f"An unexpected error occurred during OpenRouter generation: {e}")
-        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+@app.route('/api/generate', methods=['POST'])
+def generate_text():
+    """API endpoint to generate text using OpenRouter or custom APIs.
+    Streams SSE events: {"context"} when the server assembled the prompt, then {"reasoning"}/{"token"},
+    then {"usage"}; {"error"} if the upstream request fails."""
+    job, error = prepare_generation(request.get_json())
+    if error is not None:
+        return error
+    if job.cached is not None:
+        events = job.replay()
+    else:
+        # Identical concurrent requests share one upstream stream
+        events = single_flight.join_stream(job.key, job.stream)
+    return Response(stream_with_context(prepend_event(job.context_event, events)), mimetype='text/event-stream')
 
 # --- Export Endpoints (Server-Side) ---
 
@@ -805,6 +5154,7 @@ def generate_export_filename(title, extension):
     return f"{sanitized_title}_{timestamp}.{extension}"
 
 @app.route('/api/novels/<novel_id>/export/<file_format>', methods=['POST'])
+@with_novel_lock
 def export_novel_serverside(novel_id, file_format):
     """API endpoint to export a novel to a file on the server."""
     if novel_id not in novels_db:
@@ -894,6 +5244,7 @@ def export_novel_serverside(novel_id, file_format):
         return jsonify({"error": f"导出文件时发生错误: {str(e)}"}), 500
 
 @app.route('/api/novels/<novel_id>/export-notes', methods=['POST'])
+@with_novel_lock
 def export_novel_notes(novel_id):
     """API endpoint to export novel notes to a file in the exports folder."""
     data = request.get_json()
@@ -1100,7 +5451,7 @@ def import_novel():
         novel_id = str(uuid.uuid4())
         novels_db[novel_id] = novel_data
         print(f"Imported novel: {novel_id} - {novel_data['title']}")
-        save_novels()  # 保存小说数据
+        save_novel(novel_id, content=True)  # 保存小说数据
 
         # Return the details of the imported novel
         return jsonify({
@@ -1126,13 +5477,11 @@ def import_novel():
 
 @app.route('/api/characters', methods=['GET'])
 def get_characters():
-    """API endpoint to list all characters in the library."""
-    # Return a list of characters with id and name
-    character_list = [{"id": char_id, "name": data.get("name", "未命名"), "description": data.get("description", "")[:50] + "..." if len(data.get("description", "")) > 50 else data.get("description", "")} 
-                     for char_id, data in characters_db.items()]
-    return jsonify(character_list)
+    """API endpoint to list characters in the library (paginated, see list_library)."""
+    return list_library("characters")
 
 @app.route('/api/characters', methods=['POST'])
+@with_store_lock("characters")
 def create_character():
     """API endpoint to create a new character."""
     data = request.get_json()
@@ -1147,7 +5496,7 @@ def create_character():
     }
     characters_db[character_id] = new_character
     print(f"Created character: {character_id} - {data['name']}")
-    save_characters()  # 保存角色数据
+    save_characters(character_id)  # 保存角色数据
     
     return jsonify({
         "id": character_id, 
@@ -1157,6 +5506,8 @@ def create_character():
     }), 201 # 201 Created status
 
 @app.route('/api/characters/<character_id>', methods=['GET'])
+@with_store_lock("characters")
+@with_etag(store_etag("characters"))
 def get_character(character_id):
     """API endpoint to get details of a specific character."""
     character = characters_db.get(character_id)
@@ -1171,6 +5522,7 @@ def get_character(character_id):
         return jsonify({"error": "角色不存在"}), 404
 
 @app.route('/api/characters/<character_id>', methods=['PUT', 'PATCH'])
+@with_store_lock("characters")
 def update_character(character_id):
     """API endpoint to update a character's information."""
     if character_id not in characters_db:
@@ -1188,20 +5540,21 @@ def update_character(character_id):
     if 'details' in data:
         characters_db[character_id]['details'] = data['details']
         
-    save_characters()  # 保存角色数据
+    save_characters(character_id)  # 保存角色数据
     return jsonify({
         "message": "角色已更新", 
         "id": character_id
     })
 
 @app.route('/api/characters/<character_id>', methods=['DELETE'])
+@with_store_lock("characters")
 def delete_character(character_id):
     """API endpoint to delete a specific character."""
     if character_id in characters_db:
         deleted_name = characters_db[character_id].get('name', '未命名')
         del characters_db[character_id]
         print(f"Deleted character: {character_id} - {deleted_name}")
-        save_characters()  # 保存角色数据
+        save_characters(character_id)  # 保存角色数据
         return jsonify({"message": f"角色 '{deleted_name}' 已成功删除"})
     else:
         return jsonify({"error": "角色不存在"}), 404
@@ -1210,16 +5563,11 @@ def delete_character(character_id):
 
 @app.route('/api/glossary', methods=['GET'])
 def get_glossary_entries():
-    """API endpoint to list all glossary entries."""
-    # Return a list of glossary entries with id, term and brief description
-    glossary_list = [{"id": entry_id, 
-                     "term": data.get("term", "未命名词条"), 
-                     "category": data.get("category", ""),
-                     "description": data.get("description", "")[:50] + "..." if len(data.get("description", "")) > 50 else data.get("description", "")} 
-                    for entry_id, data in glossary_db.items()]
-    return jsonify(glossary_list)
+    """API endpoint to list glossary entries (paginated, see list_library)."""
+    return list_library("glossary")
 
 @app.route('/api/glossary', methods=['POST'])
+@with_store_lock("glossary")
 def create_glossary_entry():
     """API endpoint to create a new glossary entry."""
     data = request.get_json()
@@ -1235,7 +5583,7 @@ def create_glossary_entry():
     }
     glossary_db[entry_id] = new_entry
     print(f"Created glossary entry: {entry_id} - {data['term']}")
-    save_glossary()  # 保存词条数据
+    save_glossary(entry_id)  # 保存词条数据
     
     return jsonify({
         "id": entry_id, 
@@ -1246,6 +5594,8 @@ def create_glossary_entry():
     }), 201 # 201 Created status
 
 @app.route('/api/glossary/<entry_id>', methods=['GET'])
+@with_store_lock("glossary")
+@with_etag(store_etag("glossary"))
 def get_glossary_entry(entry_id):
     """API endpoint to get details of a specific glossary entry."""
     entry = glossary_db.get(entry_id)
@@ -1261,6 +5611,7 @@ def get_glossary_entry(entry_id):
         return jsonify({"error": "词条不存在"}), 404
 
 @app.route('/api/glossary/<entry_id>', methods=['PUT', 'PATCH'])
+@with_store_lock("glossary")
 def update_glossary_entry(entry_id):
     """API endpoint to update a glossary entry."""
     if entry_id not in glossary_db:
@@ -1280,20 +5631,21 @@ def update_glossary_entry(entry_id):
     if 'details' in data:
         glossary_db[entry_id]['details'] = data['details']
 
-    save_glossary()  # 保存词条数据
+    save_glossary(entry_id)  # 保存词条数据
     return jsonify({
         "message": "词条已更新", 
         "id": entry_id
     })
 
 @app.route('/api/glossary/<entry_id>', methods=['DELETE'])
+@with_store_lock("glossary")
 def delete_glossary_entry(entry_id):
     """API endpoint to delete a specific glossary entry."""
     if entry_id in glossary_db:
         deleted_term = glossary_db[entry_id].get('term', '未命名词条')
         del glossary_db[entry_id]
         print(f"Deleted glossary entry: {entry_id} - {deleted_term}")
-        save_glossary()  # 保存词条数据
+        save_glossary(entry_id)  # 保存词条数据
         return jsonify({"message": f"词条 '{deleted_term}' 已成功删除"})
     else:
         return jsonify({"error": "词条不存在"}), 404
@@ -1301,27 +5653,17 @@ def delete_glossary_entry(entry_id):
 @app.route('/api/novels/<novel_id>/glossary', methods=['GET'])
 def get_novel_glossary(novel_id):
     """API endpoint to get glossary entries associated with a specific novel."""
-    if novel_id not in novels_db:
-        return jsonify({"error": "小说不存在"}), 404
-        
-    # In a more advanced implementation, we might have a relationship table
-    # For now, we'll return all glossary entries (could be filtered by novel later)
-    return get_glossary_entries()
+    return list_library("glossary", novel_id)
 
 # --- Style Library Endpoints ---
 
 @app.route('/api/styles', methods=['GET'])
 def get_styles():
-    """API endpoint to list all style entries."""
-    # Return a list of style entries with id, name and brief description
-    style_list = [{"id": style_id, 
-                  "name": data.get("name", "未命名风格"), 
-                  "category": data.get("category", ""),
-                  "content": data.get("content", "")[:50] + "..." if len(data.get("content", "")) > 50 else data.get("content", "")} 
-                 for style_id, data in styles_db.items()]
-    return jsonify(style_list)
+    """API endpoint to list style entries (paginated, see list_library)."""
+    return list_library("styles")
 
 @app.route('/api/styles', methods=['POST'])
+@with_store_lock("styles")
 def create_style():
     """API endpoint to create a new style entry."""
     data = request.get_json()
@@ -1337,7 +5679,7 @@ def create_style():
     }
     styles_db[style_id] = new_style
     print(f"Created style entry: {style_id} - {data['name']}")
-    save_styles()  # 保存风格数据
+    save_styles(style_id)  # 保存风格数据
     
     return jsonify({
         "id": style_id, 
@@ -1348,6 +5690,7 @@ def create_style():
     }), 201 # 201 Created status
 
 @app.route('/api/styles/import-md', methods=['POST'])
+@with_store_lock("styles")
 def import_md_as_style():
     """API endpoint to import a markdown file from the prompt folder as a style entry."""
     data = request.get_json()
@@ -1393,7 +5736,7 @@ def import_md_as_style():
         
         styles_db[style_id] = new_style
         print(f"Imported style from MD file: {style_id} - {name}")
-        save_styles()  # 保存风格数据
+        save_styles(style_id)  # 保存风格数据
         
         return jsonify({
             "id": style_id, 
@@ -1423,6 +5766,8 @@ def list_md_files():
         return jsonify({"error": f"列出提示词文件时出错: {str(e)}"}), 500
 
 @app.route('/api/styles/<style_id>', methods=['GET'])
+@with_store_lock("styles")
+@with_etag(store_etag("styles"))
 def get_style(style_id):
     """API endpoint to get details of a specific style entry."""
     style = styles_db.get(style_id)
@@ -1438,6 +5783,7 @@ def get_style(style_id):
         return jsonify({"error": "风格不存在"}), 404
 
 @app.route('/api/styles/<style_id>', methods=['PUT', 'PATCH'])
+@with_store_lock("styles")
 def update_style(style_id):
     """API endpoint to update a style entry."""
     if style_id not in styles_db:
@@ -1457,20 +5803,21 @@ def update_style(style_id):
     if 'details' in data:
         styles_db[style_id]['details'] = data['details']
 
-    save_styles()  # 保存风格数据
+    save_styles(style_id)  # 保存风格数据
     return jsonify({
         "message": "风格已更新", 
         "id": style_id
     })
 
 @app.route('/api/styles/<style_id>', methods=['DELETE'])
+@with_store_lock("styles")
 def delete_style(style_id):
     """API endpoint to delete a specific style entry."""
     if style_id in styles_db:
         deleted_name = styles_db[style_id].get('name', '未命名风格')
         del styles_db[style_id]
         print(f"Deleted style entry: {style_id} - {deleted_name}")
-        save_styles()  # 保存风格数据
+        save_styles(style_id)  # 保存风格数据
         return jsonify({"message": f"风格 '{deleted_name}' 已成功删除"})
     else:
         return jsonify({"error": "风格不存在"}), 404
@@ -1478,20 +5825,18 @@ def delete_style(style_id):
 @app.route('/api/novels/<novel_id>/styles', methods=['GET'])
 def get_novel_styles(novel_id):
     """API endpoint to get style entries associated with a specific novel."""
-    if novel_id not in novels_db:
-        return jsonify({"error": "小说不存在"}), 404
-        
-    # In a more advanced implementation, we might have a relationship table
-    # For now, we'll return all style entries (could be filtered by novel later)
-    return get_styles()
+    return list_library("styles", novel_id)
 
 @app.route('/api/games', methods=['GET'])
+@with_store_lock("games")
+@with_etag(store_etag("games"))
 def get_games():
     """API endpoint to list all games."""
     game_list = [{"id": game_id, "title": data.get("title", "Untitled Game")} for game_id, data in games_db.items()]
     return jsonify(game_list)
 
 @app.route('/api/games', methods=['POST'])
+@with_store_lock("games")
 def create_game():
     """API endpoint to create a new game."""
     data = request.get_json()
@@ -1507,10 +5852,12 @@ def create_game():
     }
     games_db[game_id] = new_game
     print(f"Created game: {game_id} - {new_game['title']}")
-    save_games()  # 保存游戏数据
+    save_games(game_id)  # 保存游戏数据
     return jsonify({"id": game_id, "title": new_game["title"]}), 201 # 201 Created status
 
 @app.route('/api/games/<game_id>', methods=['GET'])
+@with_store_lock("games")
+@with_etag(store_etag("games"))
 def get_game(game_id):
     """API endpoint to get details of a specific game."""
     game = games_db.get(game_id)
@@ -1528,6 +5875,7 @@ def get_game(game_id):
         return jsonify({"message": "Game not found"}), 404
 
 @app.route('/api/games/<game_id>', methods=['PUT', 'PATCH'])
+@with_store_lock("games")
 def update_game(game_id):
     """API endpoint to update a game's settings and history."""
     if game_id not in games_db:
@@ -1549,10 +5897,11 @@ def update_game(game_id):
     if 'chat_history' in data:
         games_db[game_id]['chat_history'] = data['chat_history']
     
-    save_games()  # 保存游戏数据
+    save_games(game_id)  # 保存游戏数据
     return jsonify({"message": "Game updated successfully"})
 
 @app.route('/api/games/<game_id>', methods=['DELETE'])
+@with_store_lock("games")
 def delete_game(game_id):
     """API endpoint to delete a game."""
     if game_id not in games_db:
@@ -1560,7 +5909,7 @@ def delete_game(game_id):
     
     deleted_title = games_db[game_id].get('title', 'Unknown')
     del games_db[game_id]
-    save_games()  # 保存游戏数据
+    save_games(game_id)  # 保存游戏数据
     
     return jsonify({"message": f"Game '{deleted_title}' deleted successfully"})
 
@@ -1640,6 +5989,7 @@ def import_chat_history():
         return jsonify({"error": f"导入聊天记录时发生错误: {str(e)}"}), 500
 
 @app.route('/api/custom-apis', methods=['GET'])
+@with_store_lock("api_configs")
 def get_custom_apis():
     """API endpoint to get the list of saved custom APIs."""
     try:
@@ -1649,11 +5999,17 @@ def get_custom_apis():
         return jsonify({"error": "Could not retrieve custom API list."}), 500
 
 @app.route('/api/custom-apis', methods=['POST'])
+@with_store_lock("api_configs")
 def add_custom_api():
     """API endpoint to add a new custom API configuration."""
     data = request.get_json()
     if not data or 'name' not in data or 'baseUrl' not in data or 'modelName' not in data:
         return jsonify({"error": "Missing required fields"}), 400
+    if not valid_context_window(data.get('contextWindow')):
+        return jsonify({"error": "contextWindow 必须是正整数"}), 400
+    limits_error = upstream_limits_error(data)
+    if limits_error:
+        return jsonify({"error": limits_error}), 400
     
     api_id = str(uuid.uuid4())
     new_api = {
@@ -1664,16 +6020,23 @@ def add_custom_api():
         "secret": data.get('secret', ''),
         "modelName": data['modelName']
     }
+    if data.get('contextWindow'):
+        new_api["contextWindow"] = data['contextWindow']
+    for field in ('requestsPerMinute', 'maxConcurrency'):
+        if data.get(field):
+            new_api[field] = data[field]
     
     CUSTOM_API_CONFIGS[api_id] = new_api
     print(f"Added custom API: {api_id} - {data['name']} - {data['baseUrl']}")
     
     # 保存到文件
-    save_api_configs()
+    save_api_configs(api_id)
+    warm_upstreams([new_api['baseUrl']])
     
     return jsonify(new_api), 201
 
 @app.route('/api/custom-apis/<api_id>', methods=['PUT'])
+@with_store_lock("api_configs")
 def update_custom_api(api_id):
     """API endpoint to update an existing custom API configuration."""
     if api_id not in CUSTOM_API_CONFIGS:
@@ -1682,6 +6045,11 @@ def update_custom_api(api_id):
     data = request.get_json()
     if not data:
         return jsonify({"error": "No update data provided"}), 400
+    if not valid_context_window(data.get('contextWindow')):
+        return jsonify({"error": "contextWindow 必须是正整数"}), 400
+    limits_error = upstream_limits_error(data)
+    if limits_error:
+        return jsonify({"error": limits_error}), 400
     
     # Update fields
     CUSTOM_API_CONFIGS[api_id].update({
@@ -1691,15 +6059,30 @@ def update_custom_api(api_id):
         "secret": data.get('secret', CUSTOM_API_CONFIGS[api_id]['secret']),
         "modelName": data.get('modelName', CUSTOM_API_CONFIGS[api_id]['modelName'])
     })
+    if 'contextWindow' in data:
+        # null 或 0 表示恢复按模型名推断
+        if data['contextWindow']:
+            CUSTOM_API_CONFIGS[api_id]['contextWindow'] = data['contextWindow']
+        else:
+            CUSTOM_API_CONFIGS[api_id].pop('contextWindow', None)
+    for field in ('requestsPerMinute', 'maxConcurrency'):
+        # null 或 0 表示恢复默认的限速与并发上限
+        if data.get(field):
+            CUSTOM_API_CONFIGS[api_id][field] = data[field]
+        elif field in data:
+            CUSTOM_API_CONFIGS[api_id].pop(field, None)
     
     print(f"Updated custom API: {api_id}")
     
     # 保存到文件
-    save_api_configs()
+    save_api_configs(api_id)
+    if 'baseUrl' in data:
+        warm_upstreams([CUSTOM_API_CONFIGS[api_id]['baseUrl']])
     
     return jsonify(CUSTOM_API_CONFIGS[api_id])
 
 @app.route('/api/custom-apis/<api_id>', methods=['DELETE'])
+@with_store_lock("api_configs")
 def delete_custom_api(api_id):
     """API endpoint to delete a custom API configuration."""
     if api_id not in CUSTOM_API_CONFIGS:
@@ -1710,10 +6093,88 @@ def delete_custom_api(api_id):
     print(f"Deleted custom API: {api_id} - {deleted_name}")
     
     # 保存到文件
-    save_api_configs()
+    save_api_configs(api_id)
     
     return jsonify({"message": f"Custom API '{deleted_name}' deleted successfully"})
 
+def route_members_error(members):
+    """Validate a routing group's member list; returns an error message or None."""
+    if not isinstance(members, list) or not 1 <= len(members) <= ROUTE_MAX_MEMBERS:
+        return f"members 必须是包含 1 到 {ROUTE_MAX_MEMBERS} 个模型ID的列表"
+    if not all(isinstance(member, str) and member for member in members):
+        return "members 中的模型ID必须是非空字符串"
+    if len(set(members)) != len(members):
+        return "members 中有重复的模型"
+    for member in members:
+        if member.startswith('route-'):
+            return "路由组不能包含其它路由组"
+        if member.startswith('custom-') and member.replace('custom-', '', 1) not in CUSTOM_API_CONFIGS:
+            return f"自定义API不存在: {member}"
+    return None
+
+@app.route('/api/routes', methods=['GET'])
+@with_store_lock("routes")
+def get_route_groups():
+    """API endpoint to list routing groups, with the recent latency and error stats of their members."""
+    return jsonify([dict(group, health=provider_router.health_stats(group['members']))
+                    for group in ROUTE_GROUPS.values()])
+
+@app.route('/api/routes', methods=['POST'])
+@with_store_lock("routes")
+def add_route_group():
+    """API endpoint to add a routing group: {"name", "members": [model IDs], "hedge": true}."""
+    data = request.get_json(silent=True)
+    if not data or not data.get('name') or 'members' not in data:
+        return jsonify({"error": "Missing required fields: name and members"}), 400
+    error = route_members_error(data['members'])
+    if error:
+        return jsonify({"error": error}), 400
+
+    group_id = str(uuid.uuid4())
+    ROUTE_GROUPS[group_id] = {
+        "id": group_id,
+        "name": data['name'],
+        "members": data['members'],
+        "hedge": bool(data.get('hedge', True))
+    }
+    logging.info(f"添加模型路由组: {group_id} - {data['name']}")
+    save_routes(group_id)
+    return jsonify(ROUTE_GROUPS[group_id]), 201
+
+@app.route('/api/routes/<group_id>', methods=['PUT'])
+@with_store_lock("routes")
+def update_route_group(group_id):
+    """API endpoint to update a routing group's name, members or hedge setting."""
+    if group_id not in ROUTE_GROUPS:
+        return jsonify({"error": "Routing group not found"}), 404
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "No update data provided"}), 400
+    if 'members' in data:
+        error = route_members_error(data['members'])
+        if error:
+            return jsonify({"error": error}), 400
+
+    group = ROUTE_GROUPS[group_id]
+    group.update({
+        "name": data.get('name') or group['name'],
+        "members": data.get('members', group['members']),
+        "hedge": bool(data.get('hedge', group.get('hedge', True)))
+    })
+    save_routes(group_id)
+    return jsonify(group)
+
+@app.route('/api/routes/<group_id>', methods=['DELETE'])
+@with_store_lock("routes")
+def delete_route_group(group_id):
+    """API endpoint to delete a routing group."""
+    if group_id not in ROUTE_GROUPS:
+        return jsonify({"error": "Routing group not found"}), 404
+    deleted_name = ROUTE_GROUPS.pop(group_id)['name']
+    logging.info(f"删除模型路由组: {group_id} - {deleted_name}")
+    save_routes(group_id)
+    return jsonify({"message": f"Routing group '{deleted_name}' deleted successfully"})
+
 @app.route('/api/novel-types', methods=['GET'])
 def get_novel_types():
     """API endpoint to get novel types and subtypes from the 小说类型.txt file."""
@@ -1846,35 +6307,267 @@ def export_prompt_template():
         print(error_message)
         return jsonify({"error": error_message}), 500
 
-# novels_db 示例 (Add the chapters field to the novel structure)
-novels_db = {
-    "novel_id_1": {
-        "title": "我的第一部小说",
-        "content": "...", # 可能废弃或作为默认/未分章节内容
-        "characters": "...",
-        "knowledge": "...",
-        "style_prompt": "...",
-        "character_tags": [],
-        "glossary_tags": [],
-        "style_tags": [],
-        "chapters": []  # Add empty chapters list to store chapter data
-    }
-}
+# --- Search Endpoint ---
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    """Full-text search across novels, chapters, characters, glossary and styles.
+    Query parameters: q (required), type (comma-separated kinds), novel_id, limit."""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "检索词不能为空"}), 400
+    kinds = [kind.strip() for kind in request.args.get('type', '').split(',') if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in SEARCH_KINDS]
+    if unknown:
+        return jsonify({"error": f"未知的检索类型: {', '.join(unknown)}"}), 400
+    limit = positive_int_arg('limit', 20)
+    if limit is None:
+        return jsonify({"error": "limit 必须是正整数"}), 400
+
+    started = time.perf_counter()
+    results, total = search_index.search(query, set(kinds), request.args.get('novel_id'),
+                                         min(limit, SEARCH_LIMIT_MAX))
+    if results is None:
+        return jsonify({"error": "检索词至少需要包含两个相连的汉字或一个英文单词"}), 400
+    return jsonify({
+        "query": query,
+        "total": total,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        "results": results
+    })
+
+# --- Similar Passages Endpoint ---
+
+@app.route('/api/similar', methods=['POST'])
+def similar_passages():
+    """Find passages, characters, glossary entries and styles similar to a text.
+    Body: {"text": ...}, {"novel_id", "chapter_id", optional "start"/"end"} or {"type", "id"} of a library entry,
+    plus optional "k", "types" (list of kinds) and "within_novel" (restrict to one novel's passages)."""
+    data = request.get_json(silent=True) or {}
+    exclude = []
+    if "text" in data:
+        text = data["text"]
+        if not isinstance(text, str):
+            return jsonify({"error": "text 必须是字符串"}), 400
+    elif data.get("novel_id") and data.get("chapter_id"):
+        novel_id = data["novel_id"]
+        with novel_lock(novel_id):
+            if novel_id not in novels_db:
+                return jsonify({"error": "小说不存在"}), 404
+            chapter = find_chapter(novel_id, data["chapter_id"])
+            if chapter is None:
+                return jsonify({"error": "章节不存在"}), 404
+            text = novels_db.chapters.get(novel_id, chapter)
+        start, end = data.get("start", 0), data.get("end", len(text))
+        if type(start) is not int or type(end) is not int:
+            return jsonify({"error": "start/end 必须是整数"}), 400
+        start = max(0, min(start, len(text)))
+        end = max(start, end)
+        text = text[start:end]
+        exclude.append((("chapter", novel_id, chapter["id"]), start, end))
+    elif data.get("type") in SEARCH_STORES and data.get("id"):
+        store = data["type"]
+        title_field, body_field = SEARCH_STORES[store]
+        with store_lock(store):
+            entry = library_dbs()[store].get(data["id"])
+            if entry is None:
+                return jsonify({"error": "条目不存在"}), 404
+            text = passage_text(store, str(entry.get(title_field, "")), str(entry.get(body_field, "")))
+        exclude.append(((store, data["id"]), None, None))
+    else:
+        return jsonify({"error": "需要提供 text、novel_id 与 chapter_id，或库条目的 type 与 id"}), 400
+    kinds = data.get("types") or []
+    if not isinstance(kinds, list) or any(kind not in SEARCH_KINDS for kind in kinds):
+        return jsonify({"error": f"types 只能包含: {', '.join(SEARCH_KINDS)}"}), 400
+    limit = data.get("k", 10)
+    if type(limit) is not int or limit <= 0:
+        return jsonify({"error": "k 必须是正整数"}), 400
+
+    started = time.perf_counter()
+    ranked = vector_index.query(text, min(limit, VECTOR_LIMIT_MAX), set(kinds), data.get("within_novel"), exclude)
+    took_ms = round((time.perf_counter() - started) * 1000, 2)
+    results = []
+    for score, key, start, end in ranked:
+        hit = vector_index.describe(key, start, end)
+        if hit is not None:
+            hit["score"] = score
+            results.append(hit)
+    return jsonify({"results": results, "took_ms": took_ms})
+
+# --- Entity Matching Endpoint ---
+
+@app.route('/api/entities/match', methods=['POST'])
+def match_entities():
+    """Find every character name and glossary term mentioned in a text.
+    Body: {"text": ...} or {"novel_id", "chapter_id", optional "start"/"end" character range};
+    offsets are relative to the chapter when a chapter is given."""
+    data = request.get_json(silent=True) or {}
+    base = 0
+    if "text" in data:
+        text = data["text"]
+        if not isinstance(text, str):
+            return jsonify({"error": "text 必须是字符串"}), 400
+    elif data.get("novel_id") and data.get("chapter_id"):
+        novel_id = data["novel_id"]
+        with novel_lock(novel_id):
+            if novel_id not in novels_db:
+                return jsonify({"error": "小说不存在"}), 404
+            chapter = find_chapter(novel_id, data["chapter_id"])
+            if chapter is None:
+                return jsonify({"error": "章节不存在"}), 404
+            text = novels_db.chapters.get(novel_id, chapter)
+        start, end = data.get("start", 0), data.get("end", len(text))
+        if type(start) is not int or type(end) is not int:
+            return jsonify({"error": "start/end 必须是整数"}), 400
+        base = max(0, min(start, len(text)))
+        text = text[base:max(base, end)]
+    else:
+        return jsonify({"error": "需要提供 text 或 novel_id 与 chapter_id"}), 400
+
+    started = time.perf_counter()
+    spans = entity_matcher.match(text)
+    entities, matches = {}, []
+    for start, end, owners in spans:
+        for store, entry_id in owners:
+            entity = entities.get((store, entry_id))
+            if entity is None:
+                entity = entities[(store, entry_id)] = {"type": store, "id": entry_id, "name": text[start:end],
+                                                        "count": 0, "offsets": []}
+            entity["count"] += 1
+            if len(entity["offsets"]) < MAX_HIT_OFFSETS:
+                entity["offsets"].append(base + start)
+        matches.append({"start": base + start, "end": base + end,
+                        "entities": [{"type": store, "id": entry_id} for store, entry_id in owners]})
+    return jsonify({
+        "entities": list(entities.values()),
+        "matches": matches,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2)
+    })
+
+# --- Token Estimation Endpoint ---
+
+@app.route('/api/tokens/estimate', methods=['POST'])
+def estimate_token_count():
+    """Estimate prompt tokens for a model before generating.
+    Body: {"text": ...}, {"texts": [...]} or {"messages": [{"role", "content"}]}, optional "model"
+    and "max_tokens" (tokens reserved for the output, defaults to COMPLETION_RESERVE)."""
+    data = request.get_json(silent=True) or {}
+    model = data.get("model") or ""
+    if not isinstance(model, str):
+        return jsonify({"error": "model 必须是字符串"}), 400
+    reserve = data.get("max_tokens", COMPLETION_RESERVE)
+    if type(reserve) is not int or reserve < 0:
+        return jsonify({"error": "max_tokens 必须是非负整数"}), 400
+
+    tokenizer = tokenizer_for(model)
+    result = {"model": model, "tokenizer": tokenizer.name, "exact": tokenizer.exact}
+    if "messages" in data:
+        messages = data["messages"]
+        if not isinstance(messages, list) or not all(isinstance(message, dict) for message in messages):
+            return jsonify({"error": "messages 必须是对象列表"}), 400
+        result["tokens"] = message_tokens(tokenizer, messages)
+    elif "texts" in data:
+        texts = data["texts"]
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return jsonify({"error": "texts 必须是字符串列表"}), 400
+        result["counts"] = [tokenizer.count(text) for text in texts]
+        result["tokens"] = sum(result["counts"])
+    elif isinstance(data.get("text"), str):
+        # 与 /api/generate 一致：text 作为一条用户消息
+        result["tokens"] = message_tokens(tokenizer, [{"content": data["text"]}])
+    else:
+        return jsonify({"error": "需要提供 text、texts 或 messages"}), 400
+
+    window = context_window(model)
+    result.update(context_window=window, available=window - reserve - result["tokens"],
+                  fits=result["tokens"] + reserve <= window)
+    return jsonify(result)
+
+# --- Data Export / Import (JSON layout) ---
+
+@app.route('/api/storage/export', methods=['POST'])
+def export_storage_data():
+    """API endpoint to export all novels and libraries to exports/ in the JSON data layout."""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+    target_dir = os.path.join(EXPORT_DIR, f"data_export_{timestamp}")
+    try:
+        export_storage(target_dir)
+        try:
+            relative_path = os.path.relpath(target_dir, os.path.dirname(__file__))
+        except ValueError:
+            relative_path = target_dir
+        logging.info(f"[数据导出] 成功: {target_dir} (存储后端: {storage.name})")
+        return jsonify({"message": f"数据已成功导出至服务器: {relative_path}", "filepath": relative_path})
+    except Exception as e:
+        logging.error(f"[数据导出] 出错: {e}")
+        return jsonify({"error": f"导出数据时发生错误: {str(e)}"}), 500
+
+@app.route('/api/storage/flush', methods=['POST'])
+def flush_storage():
+    """API endpoint to write all pending changes to storage immediately."""
+    pending = save_scheduler.pending_count()
+    if flush_saves():
+        return jsonify({"message": "数据已全部写入", "flushed": pending})
+    return jsonify({"error": "部分数据写入失败，将在稍后自动重试"}), 500
+
+@app.route('/api/storage/generation-cache', methods=['DELETE'])
+def clear_generation_cache():
+    """API endpoint to drop every cached generation (memory and disk)."""
+    generation_cache.clear()
+    return jsonify({"message": "生成结果缓存已清空"})
+
+@app.route('/api/storage/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """API endpoint to report novel/chapter-body cache usage (hits, misses, evictions) and search index size."""
+    return jsonify(dict(novels_db.stats(), search_index=search_index.stats(),
+                        vector_index=vector_index.stats(), entity_matcher=entity_matcher.stats(),
+                        upstream=upstream_stats(), generation_cache=generation_cache.stats(),
+                        single_flight=single_flight.stats(), routing=provider_router.stats(),
+                        scheduler=upstream_scheduler.stats(),
+                        async_gateway=asgi_app.stats() if asgi_app is not None and asgi_app.loop is not None else None))
+
+@app.route('/api/storage/import', methods=['POST'])
+def import_storage_data():
+    """API endpoint to import a JSON data export (a folder inside exports/), replacing entries with the same id."""
+    data = request.get_json()
+    if not data or 'name' not in data:
+        return jsonify({"error": "Missing export folder name"}), 400
+
+    source_dir = os.path.join(EXPORT_DIR, os.path.basename(data['name']))
+    if not os.path.isdir(source_dir):
+        return jsonify({"error": f"找不到导出目录: {data['name']}"}), 404
+
+    try:
+        source = JsonStorage(source_dir)
+        imported_novels = source.load_novels()
+        for novel_id, novel in imported_novels.items():
+            with novel_lock(novel_id):
+                novels_db[novel_id] = novel
+            save_novel(novel_id, content=True, chapters=None)
+        counts = {"novels": len(imported_novels)}
+        for store, entries in library_dbs().items():
+            imported_entries = source.load_library(store)
+            with store_lock(store):
+                entries.update(imported_entries)
+            schedule_store_save(store)
+            counts[store] = len(imported_entries)
+        logging.info(f"[数据导入] 成功: {source_dir} {counts}")
+        return jsonify({"message": "数据已成功导入", "counts": counts})
+    except Exception as e:
+        logging.error(f"[数据导入] 出错: {e}")
+        return jsonify({"error": f"导入数据时发生错误: {str(e)}"}), 500
 
 # Chapter Management API Endpoints
 @app.route('/api/novels/<novel_id>/chapters', methods=['GET'])
+@with_novel_lock
 def get_novel_chapters(novel_id):
     """Get all chapters for a specific novel"""
     if novel_id not in novels_db:
         return jsonify({"error": "Novel not found"}), 404
         
-    # If no chapters field exists yet, initialize it
-    if "chapters" not in novels_db[novel_id]:
-        novels_db[novel_id]["chapters"] = []
-        
-    # Return chapters without content to reduce payload size
+    # Return chapters without content to reduce payload size (no need to load the bodies)
     chapters = []
-    for chapter in novels_db[novel_id]["chapters"]:
+    for chapter in novels_db.meta(novel_id).get("chapters", []):
         chapter_copy = {
             "id": chapter["id"],
             "title": chapter["title"],
@@ -1886,164 +6579,292 @@ def get_novel_chapters(novel_id):
     return jsonify(chapters)
 
 @app.route('/api/novels/<novel_id>/chapters', methods=['POST'])
+@with_novel_lock
 def create_novel_chapter(novel_id):
-    """Create a new chapter for a specific novel"""
+    """Create a new chapter for a specific novel (appended, or inserted at "index")"""
     if novel_id not in novels_db:
         return jsonify({"error": "Novel not found"}), 404
         
     # Get request data
     data = request.json or {}
     title = data.get("title", "新章节")
-    
-    # Initialize chapters list if it doesn't exist
-    if "chapters" not in novels_db[novel_id]:
-        novels_db[novel_id]["chapters"] = []
+    index = data.get("index")
+    if index is not None and type(index) is not int:
+        return jsonify({"error": "index must be an integer"}), 400
         
     # Create a new chapter with UUID
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     new_chapter = {
         "id": str(uuid.uuid4()),
         "title": title,
-        "content": "",
-        "order": len(novels_db[novel_id]["chapters"]),  # Add at the end
         "created_at": now
     }
     
-    # Add the new chapter to the novel's chapters
-    novels_db[novel_id]["chapters"].append(new_chapter)
+    # Insert the chapter; only its own order key is assigned (unless keys run out of room)
+    insert_chapter(novel_id, new_chapter, index)
+    novels_db.chapters.put(novel_id, new_chapter, "")
     
     # Save to disk
-    save_novels()
+    save_novel(novel_id, chapters=[new_chapter["id"]])
     
     # Return the new chapter (without content)
     chapter_copy = {key: val for key, val in new_chapter.items() if key != "content"}
     return jsonify(chapter_copy), 201
 
 @app.route('/api/novels/<novel_id>/chapters/<chapter_id>', methods=['GET'])
+@with_novel_lock
+@with_etag(chapter_etag)
 def get_novel_chapter(novel_id, chapter_id):
     """Get a specific chapter with its content"""
     if novel_id not in novels_db:
         return jsonify({"error": "Novel not found"}), 404
         
-    # Check if chapters field exists
-    if "chapters" not in novels_db[novel_id]:
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
         return jsonify({"error": "Chapter not found"}), 404
-        
-    # Find the chapter by ID
-    for chapter in novels_db[novel_id]["chapters"]:
-        if chapter["id"] == chapter_id:
-            return jsonify(chapter)
-            
-    return jsonify({"error": "Chapter not found"}), 404
+    # The body may have been evicted from memory; it is reloaded from storage transparently
+    return jsonify(dict(chapter, content=novels_db.chapters.get(novel_id, chapter)))
 
 @app.route('/api/novels/<novel_id>/chapters/<chapter_id>', methods=['PUT'])
+@with_novel_lock
 def update_novel_chapter(novel_id, chapter_id):
-    """Update a specific chapter"""
+    """Update a specific chapter ("order" moves it to that position)"""
     if novel_id not in novels_db:
         return jsonify({"error": "Novel not found"}), 404
         
-    # Check if chapters field exists
-    if "chapters" not in novels_db[novel_id]:
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
         return jsonify({"error": "Chapter not found"}), 404
         
     # Get request data
     data = request.json or {}
+    if "order" in data and type(data["order"]) is not int:
+        return jsonify({"error": "order must be an integer"}), 400
+    conflict = revision_conflict(chapter, data)
+    if conflict:
+        return conflict
     
-    # Find and update the chapter
-    for i, chapter in enumerate(novels_db[novel_id]["chapters"]):
-        if chapter["id"] == chapter_id:
-            # Update fields that were provided
-            if "title" in data:
-                novels_db[novel_id]["chapters"][i]["title"] = data["title"]
-            if "content" in data:
-                novels_db[novel_id]["chapters"][i]["content"] = data["content"]
-            if "order" in data:
-                novels_db[novel_id]["chapters"][i]["order"] = data["order"]
-                
-            # Save changes
-            save_novels()
-            
-            # Return the updated chapter
-            return jsonify(novels_db[novel_id]["chapters"][i])
-            
-    return jsonify({"error": "Chapter not found"}), 404
+    # Update fields that were provided
+    if "title" in data or "content" in data:
+        bump_revision(chapter)
+    if "title" in data:
+        chapter["title"] = data["title"]
+    if "content" in data:
+        old_content = novels_db.chapters.get(novel_id, chapter)
+        novels_db.chapters.put(novel_id, chapter, data["content"])
+        chapter_history.record(novel_id, chapter_id, chapter["revision"], old_content, data["content"])
+    if "order" in data:
+        move_chapter(novel_id, chapter, data["order"])
+        
+    # Save changes (only rewrite the chapter body if it changed)
+    save_novel(novel_id, chapters=[chapter_id] if "content" in data else ())
+    
+    # Return the updated chapter
+    return jsonify(dict(chapter, content=novels_db.chapters.get(novel_id, chapter)))
+
+@app.route('/api/novels/<novel_id>/chapters/<chapter_id>/content', methods=['PATCH'])
+@with_novel_lock
+def patch_novel_chapter_content(novel_id, chapter_id):
+    """Apply a text patch (ops or unified diff) to a chapter's content against a base revision"""
+    if novel_id not in novels_db:
+        return jsonify({"error": "Novel not found"}), 404
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "No patch data provided"}), 400
+
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
+        return jsonify({"error": "Chapter not found"}), 404
+    old_content = novels_db.chapters.get(novel_id, chapter)
+    body, status, content = patch_content(chapter, data, old_content)
+    if status == 200:
+        novels_db.chapters.put(novel_id, chapter, content)
+        chapter_history.record(novel_id, chapter_id, chapter["revision"], old_content, content)
+        save_novel(novel_id, chapters=[chapter_id])
+        body["id"] = chapter_id
+    return jsonify(body), status
+
+@app.route('/api/novels/<novel_id>/chapters/<chapter_id>/revisions', methods=['GET'])
+@with_novel_lock
+def get_chapter_revisions(novel_id, chapter_id):
+    """List the saved revisions of a chapter (newest first, without content)"""
+    if novel_id not in novels_db:
+        return jsonify({"error": "Novel not found"}), 404
+
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
+        return jsonify({"error": "Chapter not found"}), 404
+    return jsonify({"id": chapter_id, "revision": chapter.get("revision", 0),
+                    "revisions": chapter_history.list(novel_id, chapter_id)})
+
+@app.route('/api/novels/<novel_id>/chapters/<chapter_id>/revisions/<int:revision>', methods=['GET'])
+@with_novel_lock
+def get_chapter_revision(novel_id, chapter_id, revision):
+    """Get a chapter's content as it was at a saved revision"""
+    if novel_id not in novels_db:
+        return jsonify({"error": "Novel not found"}), 404
+
+    if find_chapter(novel_id, chapter_id) is None:
+        return jsonify({"error": "Chapter not found"}), 404
+    try:
+        entry = chapter_history.get(novel_id, chapter_id, revision)
+    except Exception as e:
+        logging.error(f"读取章节历史版本出错 {novel_id}/{chapter_id}@{revision}: {e}")
+        return jsonify({"error": f"历史版本已损坏: {e}"}), 500
+    if entry is None:
+        return jsonify({"error": "Revision not found"}), 404
+    return jsonify(dict(entry, id=chapter_id))
+
+@app.route('/api/novels/<novel_id>/chapters/<chapter_id>/revisions/<int:revision>/restore', methods=['POST'])
+@with_novel_lock
+def restore_chapter_revision(novel_id, chapter_id, revision):
+    """Restore a chapter's content to a saved revision (recorded as a new revision)"""
+    if novel_id not in novels_db:
+        return jsonify({"error": "Novel not found"}), 404
+
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
+        return jsonify({"error": "Chapter not found"}), 404
+    conflict = revision_conflict(chapter, request.get_json(silent=True))
+    if conflict:
+        return conflict
+    try:
+        entry = chapter_history.get(novel_id, chapter_id, revision)
+    except Exception as e:
+        logging.error(f"读取章节历史版本出错 {novel_id}/{chapter_id}@{revision}: {e}")
+        return jsonify({"error": f"历史版本已损坏: {e}"}), 500
+    if entry is None:
+        return jsonify({"error": "Revision not found"}), 404
+
+    old_content = novels_db.chapters.get(novel_id, chapter)
+    novels_db.chapters.put(novel_id, chapter, entry["content"])
+    bump_revision(chapter)
+    chapter_history.record(novel_id, chapter_id, chapter["revision"], old_content, entry["content"])
+    save_novel(novel_id, chapters=[chapter_id])
+    return jsonify({"id": chapter_id, "revision": chapter["revision"], "restored_from": revision,
+                    "length": len(entry["content"])})
 
 @app.route('/api/novels/<novel_id>/chapters/<chapter_id>', methods=['DELETE'])
+@with_novel_lock
 def delete_novel_chapter(novel_id, chapter_id):
     """Delete a specific chapter"""
     if novel_id not in novels_db:
         return jsonify({"error": "Novel not found"}), 404
         
-    # Check if chapters field exists
-    if "chapters" not in novels_db[novel_id]:
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
         return jsonify({"error": "Chapter not found"}), 404
+    conflict = revision_conflict(chapter, request.get_json(silent=True))
+    if conflict:
+        return conflict
         
-    # Find and remove the chapter
-    for i, chapter in enumerate(novels_db[novel_id]["chapters"]):
-        if chapter["id"] == chapter_id:
-            # Remove the chapter
-            removed_chapter = novels_db[novel_id]["chapters"].pop(i)
-            
-            # Reorder remaining chapters if needed
-            for j, ch in enumerate(novels_db[novel_id]["chapters"]):
-                ch["order"] = j
-                
-            # Save changes
-            save_novels()
-            
-            return jsonify({"message": f"Chapter '{removed_chapter['title']}' deleted successfully"})
-            
-    return jsonify({"error": "Chapter not found"}), 404
+    # Remove the chapter (and its revision history); the remaining chapters keep their order keys
+    remove_chapter(novel_id, chapter)
+    chapter_history.forget(novel_id, chapter_id)
+    
+    # Save changes (the removed chapter's file is deleted)
+    save_novel(novel_id, chapters=[chapter_id])
+    
+    return jsonify({"message": f"Chapter '{chapter['title']}' deleted successfully"})
+
+@app.route('/api/novels/<novel_id>/chapters/<chapter_id>/move', methods=['PUT'])
+@with_novel_lock
+def move_novel_chapter(novel_id, chapter_id):
+    """Move one chapter to a new position ({"index": n}); only the moved chapter's order changes"""
+    if novel_id not in novels_db:
+        return jsonify({"error": "Novel not found"}), 404
+        
+    chapter = find_chapter(novel_id, chapter_id)
+    if chapter is None:
+        return jsonify({"error": "Chapter not found"}), 404
+        
+    data = request.json or {}
+    index = data.get("index")
+    if type(index) is not int:
+        return jsonify({"error": "index must be an integer"}), 400
+        
+    changed = move_chapter(novel_id, chapter, index)
+    save_novel(novel_id)
+    
+    # Order keys that changed (all of them only when the keys had to be renumbered)
+    return jsonify({"message": "Chapter moved successfully",
+                    "orders": {ch["id"]: ch["order"] for ch in changed}})
 
 @app.route('/api/novels/<novel_id>/chapters/reorder', methods=['PUT'])
+@with_novel_lock
 def reorder_novel_chapters(novel_id):
     """Reorder chapters for a specific novel"""
     if novel_id not in novels_db:
         return jsonify({"error": "Novel not found"}), 404
         
-    # Check if chapters field exists
-    if "chapters" not in novels_db[novel_id]:
-        novels_db[novel_id]["chapters"] = []
-        return jsonify({"message": "No chapters to reorder"}), 200
-        
     # Get request data - expecting an array of chapter IDs in the new order
     data = request.json or []
     
     if not isinstance(data, list):
         return jsonify({"error": "Invalid data format. Expected array of chapter IDs with order"}), 400
         
-    # Create a map of chapter IDs to their current objects
-    chapter_map = {chapter["id"]: chapter for chapter in novels_db[novel_id]["chapters"]}
+    index = chapter_index(novel_id)
     
-    # Create a new ordered list of chapters
+    # Chapters in the requested order, then any chapters the request missed
     new_chapters = []
+    seen = set()
+    for item in data:
+        if isinstance(item, dict) and item.get("id") in index and item["id"] not in seen:
+            seen.add(item["id"])
+            new_chapters.append(index[item["id"]])
+    new_chapters.extend(chapter for chapter in novels_db[novel_id]["chapters"] if chapter["id"] not in seen)
     
-    # Process each item in the request
-    for i, item in enumerate(data):
-        if isinstance(item, dict) and "id" in item:
-            chapter_id = item["id"]
-            if chapter_id in chapter_map:
-                # Get the original chapter and update its order
-                chapter = chapter_map[chapter_id].copy()
-                chapter["order"] = i
-                new_chapters.append(chapter)
-                
-    # If any chapters were missed in the request, append them at the end
-    missed_chapters = [chapter for chapter_id, chapter in chapter_map.items() 
-                      if chapter_id not in [item["id"] for item in data if isinstance(item, dict) and "id" in item]]
-    
-    for i, chapter in enumerate(missed_chapters):
-        chapter["order"] = len(new_chapters) + i
-        new_chapters.append(chapter)
-        
-    # Replace the chapters list
+    # Replace the chapters list (the index is rebuilt for the new list)
+    renumber_chapters(new_chapters)
     novels_db[novel_id]["chapters"] = new_chapters
     
-    # Save changes
-    save_novels()
+    # Save changes (chapter bodies are unchanged)
+    save_novel(novel_id)
     
     return jsonify({"message": "Chapters reordered successfully"})
 
+GRAPH_MAX_TOKENS = 2000  # 图谱接口的输出上限
+GRAPH_READ_TIMEOUT = 60  # 图谱接口不是流式的，等待完整响应的时间
+
+GRAPH_TEMPERATURE = 0.3  # 降低随机性
+
+def graph_cache_key(kind, model, prompt):
+    """图谱抽取的缓存键，与请求上游时的地址和请求体对应"""
+    name, api_config = resolve_model(model)
+    api_url = f"{api_config['baseUrl']}|{api_config.get('path', '')}" if api_config is not None else OPENROUTER_API_BASE
+    return generation_cache_key(kind, api_url, {"model": name, "max_tokens": GRAPH_MAX_TOKENS, "temperature": GRAPH_TEMPERATURE,
+                                                "messages": [{"role": "user", "content": prompt}]})
+
+def graph_response(data, model, prompt_tokens, result, truncated, cache_key=None, cached=False):
+    """图谱接口的成功响应；token 统计放在响应头中，因为响应体会被前端原样保存为图谱文件。
+    cache_key 不为空且不是缓存命中时保存结果"""
+    if cache_key is not None and not cached:
+        generation_cache.put(cache_key, {"data": data, "result": result})
+    try:
+        completion = result['choices'][0]['message']['content'] or ""
+    except (KeyError, IndexError, TypeError):
+        completion = json_dumps(result)
+    usage = usage_report(model, prompt_tokens, completion, result.get('usage') if isinstance(result, dict) else None,
+                         truncated)
+    response = jsonify(data)
+    response.headers['X-Prompt-Tokens'] = str(usage['prompt_tokens'])
+    response.headers['X-Completion-Tokens'] = str(usage['completion_tokens'])
+    if truncated:
+        response.headers['X-Prompt-Truncated'] = '1'
+    if cache_key is not None:
+        response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+    return response
+
+def graph_incomplete_error(result):
+    """返回的 JSON 不完整时的错误信息：区分输出达到 max_tokens 上限与其它原因"""
+    try:
+        finish_reason = result['choices'][0].get('finish_reason')
+    except (KeyError, IndexError, TypeError, AttributeError):
+        finish_reason = None
+    if finish_reason == 'length':
+        return f'模型输出达到 {GRAPH_MAX_TOKENS} tokens 上限被截断，请尝试减少文本内容或使用其他模型'
+    return 'API返回的数据不完整，请尝试减少文本内容或使用其他模型'
+
 @app.route('/api/character-relationship-graph', methods=['POST'])
 def generate_character_relationship_graph():
     """生成角色关系图谱，支持自定义API模型"""
@@ -2057,7 +6878,7 @@ def generate_character_relationship_graph():
             return jsonify({'error': '未选择模型'}), 400
 
         # 优化后的prompt，更简洁且强制输出格式
-        prompt = (
+        instruction = (
             "分析文本中的人物关系，输出JSON格式：\n"
             "{\"nodes\":[{\"id\":\"人物名\",\"name\":\"人物名\"}],\"links\":[{\"source\":\"人物1\",\"target\":\"人物2\",\"relation\":\"关系\"}]}\n"
             "要求：\n"
@@ -2065,8 +6886,18 @@ def generate_character_relationship_graph():
             "2. links包含所有关系，必须有relation字段\n"
             "3. relation必须是简短中文词语\n"
             "4. 只输出JSON，不要其他内容\n"
-            f"文本：{content}"
+            "文本："
         )
+        # 文本超出模型上下文长度时只分析开头部分，避免上游截断后才报错
+        content, prompt_tokens, truncated = fit_prompt(model, content, GRAPH_MAX_TOKENS, fixed=instruction)
+        prompt = instruction + content
+
+        # 同样的文本与模型再次抽取时直接返回上次的结果（请求体中 "cache": false 时重新抽取）
+        flight_key = graph_cache_key('relationship-graph', model, prompt)
+        cache_key = flight_key if use_generation_cache(req, True) else None
+        cached = generation_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return graph_response(cached['data'], model, prompt_tokens, cached['result'], truncated, cache_key, True)
 
         # 自定义API模型
         if model.startswith('custom-'):
@@ -2091,8 +6922,8 @@ def generate_character_relationship_graph():
             payload = {
                 "model": model_name,
                 "messages": [{"role": "user", "content": prompt}],
-                "max_tokens": 2000,  # 增加token限制
-                "temperature": 0.3    # 降低随机性
+                "max_tokens": GRAPH_MAX_TOKENS,
+                "temperature": GRAPH_TEMPERATURE
             }
 
             try:
@@ -2101,7 +6932,9 @@ def generate_character_relationship_graph():
                 logging.info(f"请求头: {headers}")
                 logging.info(f"请求体: {json.dumps(payload, ensure_ascii=False)}")
 
-                resp = requests.post(api_url, headers=headers, json=payload, timeout=60)
+                # 同时进行的相同抽取共用一次上游调用；排队时排在交互的生成请求之后
+                resp = single_flight.run(flight_key, lambda: scheduled_post(
+                    model, PRIORITY_BATCH, api_url, headers=headers, json=payload, timeout=(UPSTREAM_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)))
                 
                 # 记录响应信息
                 logging.info(f"API响应状态码: {resp.status_code}")
@@ -2135,7 +6968,7 @@ def generate_character_relationship_graph():
                         # 检查JSON是否完整
                         if not content.strip().endswith('}'):
                             logging.error(f"API返回的JSON不完整: {content}")
-                            return jsonify({'error': 'API返回的数据不完整，请尝试减少文本内容或使用其他模型'}), 500
+                            return jsonify({'error': graph_incomplete_error(result)}), 500
                             
                         try:
                             relationship_data = json.loads(content)
@@ -2157,7 +6990,7 @@ def generate_character_relationship_graph():
                     if not isinstance(relationship_data['links'], list):
                         raise ValueError("links字段不是数组格式")
 
-                    return jsonify(relationship_data)
+                    return graph_response(relationship_data, model, prompt_tokens, result, truncated, cache_key)
 
                 except json.JSONDecodeError as e:
                     logging.error(f"JSON解析错误: {str(e)}, 原始内容: {resp.text[:1000]}...")
@@ -2179,8 +7012,9 @@ def generate_character_relationship_graph():
                 return jsonify({'error': '请先设置OpenRouter API密钥'}), 401
 
             try:
-                response = requests.post(
-                    f"{OPENROUTER_API_BASE}/chat/completions",
+                response = single_flight.run(flight_key, lambda: scheduled_post(
+                    model, PRIORITY_BATCH, f"{OPENROUTER_API_BASE}/chat/completions",
+                    timeout=(UPSTREAM_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT),
                     headers={
                         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
                         "Content-Type": "application/json"
@@ -2188,10 +7022,10 @@ def generate_character_relationship_graph():
                     json={
                         "model": model,
                         "messages": [{"role": "user", "content": prompt}],
-                        "max_tokens": 2000,  # 增加token限制
-                        "temperature": 0.3    # 降低随机性
+                        "max_tokens": GRAPH_MAX_TOKENS,
+                        "temperature": GRAPH_TEMPERATURE
                     }
-                )
+                ))
 
                 # 记录响应信息
                 logging.info(f"OpenRouter响应状态码: {response.status_code}")
@@ -2220,7 +7054,7 @@ def generate_character_relationship_graph():
                     # 检查JSON是否完整
                     if not content.strip().endswith('}'):
                         logging.error(f"API返回的JSON不完整: {content}")
-                        return jsonify({'error': 'API返回的数据不完整，请尝试减少文本内容或使用其他模型'}), 500
+                        return jsonify({'error': graph_incomplete_error(result)}), 500
                         
                     relationship_data = json.loads(content)
                     
@@ -2236,7 +7070,7 @@ def generate_character_relationship_graph():
                     if not isinstance(relationship_data['links'], list):
                         raise ValueError("links字段不是数组格式")
                         
-                    return jsonify(relationship_data)
+                    return graph_response(relationship_data, model, prompt_tokens, result, truncated, cache_key)
 
                 except json.JSONDecodeError as e:
                     logging.error(f"JSON解析错误: {str(e)}, 原始内容: {content}")
@@ -2281,7 +7115,7 @@ def generate_knowledge_graph():
             return jsonify({'error': '未选择模型'}), 400
 
         # 优化后的prompt，更简洁且强制输出格式
-        prompt = (
+        instruction = (
             "分析文本中的知识点和关系，输出JSON格式：\n"
             "{\"nodes\":[{\"id\":\"知识点ID\",\"name\":\"知识点名称\",\"category\":\"分类\",\"tags\":[\"标签1\",\"标签2\"]}],"
             "\"links\":[{\"source\":\"知识点1\",\"target\":\"知识点2\",\"relation\":\"关系\",\"type\":\"关系类型\"}]}\n"
@@ -2293,8 +7127,17 @@ def generate_knowledge_graph():
             "5. type必须是以下之一：包含、属于、导致、影响、引用\n"
             "6. relation必须是简短中文词语\n"
             "7. 只输出JSON，不要其他内容\n"
-            f"文本：{content}"
+            "文本："
         )
+        content, prompt_tokens, truncated = fit_prompt(model, content, GRAPH_MAX_TOKENS, fixed=instruction)
+        prompt = instruction + content
+
+        # 同样的文本与模型再次抽取时直接返回上次的结果
+        flight_key = graph_cache_key('knowledge-graph', model, prompt)
+        cache_key = flight_key if use_generation_cache(req, True) else None
+        cached = generation_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return graph_response(cached['data'], model, prompt_tokens, cached['result'], truncated, cache_key, True)
 
         # 自定义API模型
         if model.startswith('custom-'):
@@ -2319,12 +7162,14 @@ def generate_knowledge_graph():
             payload = {
                 "model": model_name,
                 "messages": [{"role": "user", "content": prompt}],
-                "max_tokens": 2000,
-                "temperature": 0.3
+                "max_tokens": GRAPH_MAX_TOKENS,
+                "temperature": GRAPH_TEMPERATURE
             }
 
             try:
-                resp = requests.post(api_url, headers=headers, json=payload, timeout=60)
+                # 同时进行的相同抽取共用一次上游调用；排队时排在交互的生成请求之后
+                resp = single_flight.run(flight_key, lambda: scheduled_post(
+                    model, PRIORITY_BATCH, api_url, headers=headers, json=payload, timeout=(UPSTREAM_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)))
                 
                 if resp.status_code != 200:
                     error_msg = f"自定义API分析失败，状态码: {resp.status_code}"
@@ -2345,7 +7190,7 @@ def generate_knowledge_graph():
                     content = strip_code_block(content)
                     
                     if not content.strip().endswith('}'):
-                        return jsonify({'error': 'API返回的数据不完整，请尝试减少文本内容或使用其他模型'}), 500
+                        return jsonify({'error': graph_incomplete_error(result)}), 500
                         
                     knowledge_data = json.loads(content)
                     
@@ -2361,7 +7206,7 @@ def generate_knowledge_graph():
                     if not isinstance(knowledge_data['links'], list):
                         raise ValueError("links字段不是数组格式")
                         
-                    return jsonify(knowledge_data)
+                    return graph_response(knowledge_data, model, prompt_tokens, result, truncated, cache_key)
 
                 except json.JSONDecodeError as e:
                     return jsonify({'error': f'返回的数据格式不正确: {str(e)}'}), 500
@@ -2379,8 +7224,9 @@ def generate_knowledge_graph():
                 return jsonify({'error': '请先设置OpenRouter API密钥'}), 401
 
             try:
-                response = requests.post(
-                    f"{OPENROUTER_API_BASE}/chat/completions",
+                response = single_flight.run(flight_key, lambda: scheduled_post(
+                    model, PRIORITY_BATCH, f"{OPENROUTER_API_BASE}/chat/completions",
+                    timeout=(UPSTREAM_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT),
                     headers={
                         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
                         "Content-Type": "application/json"
@@ -2388,10 +7234,10 @@ def generate_knowledge_graph():
                     json={
                         "model": model,
                         "messages": [{"role": "user", "content": prompt}],
-                        "max_tokens": 2000,
-                        "temperature": 0.3
+                        "max_tokens": GRAPH_MAX_TOKENS,
+                        "temperature": GRAPH_TEMPERATURE
                     }
-                )
+                ))
 
                 if response.status_code != 200:
                     error_msg = f"AI分析失败，状态码: {response.status_code}"
@@ -2411,7 +7257,7 @@ def generate_knowledge_graph():
                     content = strip_code_block(content)
                     
                     if not content.strip().endswith('}'):
-                        return jsonify({'error': 'API返回的数据不完整，请尝试减少文本内容或使用其他模型'}), 500
+                        return jsonify({'error': graph_incomplete_error(result)}), 500
                         
                     knowledge_data = json.loads(content)
                     
@@ -2427,7 +7273,7 @@ def generate_knowledge_graph():
                     if not isinstance(knowledge_data['links'], list):
                         raise ValueError("links字段不是数组格式")
                         
-                    return jsonify(knowledge_data)
+                    return graph_response(knowledge_data, model, prompt_tokens, result, truncated, cache_key)
 
                 except json.JSONDecodeError as e:
                     return jsonify({'error': f'返回的数据格式不正确: {str(e)}'}), 500
@@ -2442,6 +7288,377 @@ def generate_knowledge_graph():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# --- 异步生成网关 ---
+
+# 同步路径中每个 /api/generate 在整个流式生成期间占用一个线程。安装了 httpx、uvicorn 与 a2wsgi 时，python app.py
+# 改为以 uvicorn 运行下面的 ASGI 应用：POST /api/generate 在一个事件循环上用 httpx 异步读取上游的流，
+# 几百个并发生成只占用一个线程；其余请求仍由 Flask 在线程池中处理（a2wsgi；uvicorn 自带的 WSGI 适配已弃用）。
+# SSE 事件格式与同步路径相同。
+# BMXH_ASYNC_GATEWAY=0 时仍用 Flask 自带的服务器；也可用其它 ASGI 服务器运行 app:asgi_app
+try:
+    import httpx
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    httpx = uvicorn = WSGIMiddleware = None
+else:
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # 不逐条记录上游请求
+
+ASYNC_GATEWAY = os.environ.get('BMXH_ASYNC_GATEWAY', '1') != '0' and httpx is not None
+ASYNC_MAX_STREAMS = int(os.environ.get('BMXH_ASYNC_MAX_STREAMS', '1000'))  # 同时连接上游的流数上限
+WSGI_WORKERS = int(os.environ.get('BMXH_WSGI_WORKERS', '32'))  # 处理其余 Flask 请求的线程数
+SSE_HEADERS = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache')]
+
+def prepare_generation_response(data):
+    """在线程池中运行：组装生成请求，出错时把 Flask 的错误响应转换为 (状态码, 响应头, 响应体)"""
+    with app.app_context():
+        job, error = prepare_generation(data)
+        if error is None:
+            return job, None
+        response = app.make_response(error)
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.items()]
+        return None, (response.status_code, headers, response.get_data())
+
+async def paced_lines(lines, frames):
+    """逐行产出上游的流；frames 中合并的输出到期而下一行还没到时产出 None（提示调用方先发送）"""
+    pending = None
+    try:
+        while True:
+            timeout = frames.wait_time()
+            if pending is None and timeout is None:
+                # 没有待发送的输出时直接等待下一行，不必创建任务
+                try:
+                    line = await lines.__anext__()
+                except StopAsyncIteration:
+                    return
+                yield line
+                continue
+            if pending is None:
+                pending = asyncio.ensure_future(lines.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                line = task.result()
+            except StopAsyncIteration:
+                return
+            yield line
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+class AsyncStreamFlight:
+    """StreamFlight 的事件循环版本：只在网关的事件循环中使用"""
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self.changed.set()
+
+    def finish(self):
+        self.done = True
+        self.changed.set()
+
+    async def subscribe(self):
+        index = 0
+        try:
+            while True:
+                if index < len(self.events):
+                    batch = self.events[index:]
+                    index += len(batch)
+                    for event in batch:
+                        yield event
+                elif self.done:
+                    return
+                else:
+                    self.changed.clear()
+                    await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+
+class AsyncGateway:
+    """ASGI 应用：POST /api/generate 走异步路径，其余请求交给 Flask"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=WSGI_WORKERS)
+        self.client = None
+        self.loop = None
+        self.streams = 0
+        self.flights = {}  # 请求的键 -> AsyncStreamFlight
+        self.shared_streams = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == '/api/generate' and scope['method'] == 'POST':
+            await self.generate(receive, send)
+        elif scope['type'] == 'http':
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.http_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                    self.client = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def http_client(self):
+        if self.client is None:
+            self.loop = asyncio.get_running_loop()
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=ASYNC_MAX_STREAMS,
+                                    max_keepalive_connections=UPSTREAM_POOL_HOSTS * UPSTREAM_POOL_SIZE))
+            if UPSTREAM_WARMUP:
+                asyncio.ensure_future(self.warm(upstream_origins()))
+        return self.client
+
+    async def warm(self, origins):
+        """同 warm_upstreams，连接留在 httpx 的连接池中"""
+        for origin in origins:
+            started = time.perf_counter()
+            try:
+                await self.http_client().head(origin, timeout=httpx.Timeout(5, connect=UPSTREAM_CONNECT_TIMEOUT))
+                logging.info(f"[上游连接] 已预先连接 {origin}，用时 {time.perf_counter() - started:.2f} 秒")
+            except httpx.HTTPError as e:
+                logging.info(f"[上游连接] 预先连接 {origin} 失败: {e}")
+
+    async def generate(self, receive, send):
+        body, more_body = b"", True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b"")
+            more_body = message.get('more_body', False)
+        try:
+            data = json_loads(body) if body else None
+        except ValueError:
+            data = None
+        if data is not None and not isinstance(data, dict):
+            data = None
+
+        # 组装上下文会读取小说正文，放到线程池中进行
+        job, error = await asyncio.get_running_loop().run_in_executor(None, prepare_generation_response, data)
+        if error is not None:
+            status, headers, content = error
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': content})
+            return
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        # 客户端断开时取消上游请求
+        stream = asyncio.ensure_future(self.stream(job, send))
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+        done, pending = await asyncio.wait({stream, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if stream in done:
+            stream.result()
+            await send({'type': 'http.response.body', 'body': b""})
+
+    async def stream(self, job, send):
+        async def emit(event):
+            await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+
+        if job.context_event:
+            await emit(job.context_event)
+        if job.cached is not None:
+            for event in job.replay():
+                await emit(event)
+            return
+        if not COALESCE_REQUESTS:
+            async for event in self.upstream_events(job):
+                await emit(event)
+            return
+        # 相同的并发请求共用一个上游流
+        flight = self.flights.get(job.key)
+        if flight is None:
+            flight = self.flights[job.key] = AsyncStreamFlight()
+            asyncio.ensure_future(self.produce(job, flight))
+        else:
+            self.shared_streams += 1
+        flight.subscribers += 1
+        events = flight.subscribe()
+        try:
+            async for event in events:
+                await emit(event)
+        finally:
+            # 客户端断开（任务被取消）时立即减少订阅者计数
+            await events.aclose()
+
+    async def produce(self, job, flight):
+        events = self.upstream_events(job)
+        try:
+            async for event in events:
+                flight.publish(event)
+                if flight.subscribers <= 0:
+                    logging.info("[请求合并] 所有订阅者都已断开，停止读取上游")
+                    break
+        finally:
+            await events.aclose()
+            del self.flights[job.key]
+            flight.finish()
+
+    async def upstream_events(self, job):
+        """一次生成的 SSE 事件：单个上游流，或路由组的各次尝试"""
+        if isinstance(job, RoutedJob):
+            events = self.routed_events(job)
+        else:
+            events = self.single_events(job)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+            logging.debug("Closing stream generator.")
+
+    async def single_events(self, job):
+        events = self.attempt_events(job)
+        try:
+            async for _, event in events:
+                yield event
+            await asyncio.get_running_loop().run_in_executor(None, job.completed)  # 写缓存文件
+            yield job.usage_event()
+        except UpstreamError as e:
+            yield sse_event({'error': str(e)})
+        finally:
+            await events.aclose()
+
+    async def routed_events(self, routed):
+        """同 RoutedJob.stream：每个成员的请求是一个任务，取消对冲中落败的一方时取消它的任务"""
+        results = asyncio.Queue()
+        tasks = {}
+
+        def start(index):
+            tasks[index] = asyncio.ensure_future(self.run_attempt(routed, index, results))
+
+        def cancel(index):
+            routed.jobs[index].cancelled = True
+            tasks[index].cancel()
+
+        start(routed.launch())
+        try:
+            while True:
+                try:
+                    index, kind, value = await asyncio.wait_for(results.get(), routed.hedge_timeout())
+                except asyncio.TimeoutError:
+                    start(routed.launch(hedge=True))
+                    continue
+                events, over = routed.handle(index, kind, value, start, cancel)
+                for event in events:
+                    yield event
+                if over:
+                    break
+            if routed.succeeded:
+                await asyncio.get_running_loop().run_in_executor(None, routed.jobs[routed.winner].completed)
+                yield routed.usage_event()
+        finally:
+            for index in list(routed.running):
+                cancel(index)
+
+    async def run_attempt(self, routed, index, results):
+        events = self.attempt_events(routed.jobs[index])
+        try:
+            async for kind, event in events:
+                results.put_nowait((index, kind, event))
+        except UpstreamError as e:
+            results.put_nowait((index, 'error', e))
+        else:
+            results.put_nowait((index, 'end', None))
+        finally:
+            await events.aclose()
+
+    async def attempt_events(self, job):
+        """同 GenerationJob.events：等待该服务的名额后异步读取上游流，产出 (种类, SSE 事件)；请求失败时抛出 UpstreamError"""
+        self.streams += 1
+        response = None
+        try:
+            delay = 0.0
+            for retry in range(job.retries + 1):
+                job.ticket = upstream_scheduler.request(job.provider_key, job.priority, delay)
+                async for position in upstream_scheduler.async_wait(job.ticket):
+                    yield 'queue', job.queue_event(position)
+                started = time.perf_counter()
+                response = await self.http_client().send(
+                    self.client.build_request('POST', job.api_url, headers=job.headers, json=job.payload), stream=True)
+                delay = upstream_scheduler.retry_delay(job.provider_key, response.status_code,
+                                                       retry_after_seconds(response.headers.get('retry-after')),
+                                                       retry, job.retries)
+                if delay is None:
+                    break
+                await response.aclose()
+                job.release()
+                yield 'queue', job.retry_event(retry + 1, delay, response.status_code)
+            if response.status_code >= 400:
+                content = (await response.aread()).decode('utf-8', 'replace')
+                error = f"{response.status_code} {response.reason_phrase} for url: {job.api_url}"
+                logging.warning(f"Error connecting to {job.provider}: {error}")
+                raise job.failed(UpstreamError(job.error_message(error, response.status_code, content),
+                                               response.status_code,
+                                               retry_after_seconds(response.headers.get('retry-after'))))
+            finished, remaining = False, UPSTREAM_DRAIN_BYTES
+            async for line in paced_lines(response.aiter_lines(), job.frames):
+                if line is None:
+                    # 合并中的输出到期而下一行还没到：先发送
+                    for event in job.frames.take(force=True):
+                        yield 'output', event
+                elif finished:
+                    # 与 stream_lines 相同：读掉结束后剩余的少量数据，连接才能回到连接池
+                    remaining -= len(line) + 1
+                    if remaining <= 0:
+                        break
+                elif line:
+                    events, finished = job.feed(line)
+                    if events:
+                        job.output_started(started)
+                    for event in events:
+                        yield 'output', event
+            for event in job.frames.take(force=True):
+                yield 'output', event
+            job.output_started(started)
+        except UpstreamError:
+            raise
+        except httpx.HTTPError as e:
+            logging.warning(f"Error connecting to {job.provider}: {e}")
+            for event in job.frames.take(force=True):
+                yield 'output', event
+            raise job.failed(UpstreamError(job.error_message(e)))
+        except Exception as e:
+            error_message = f"An unexpected error occurred during {job.provider} generation: {e}"
+            logging.warning(error_message)
+            for event in job.frames.take(force=True):
+                yield 'output', event
+            raise job.failed(UpstreamError(error_message))
+        finally:
+            self.streams -= 1
+            if response is not None:
+                await response.aclose()
+            job.release()
+
+    def stats(self):
+        return {"streams": self.streams, "max_streams": ASYNC_MAX_STREAMS, "streams_in_flight": len(self.flights),
+                "shared_streams": self.shared_streams}
+
+asgi_app = AsyncGateway(app) if httpx is not None else None
+
 if __name__ == '__main__':
     # 确保静态文件夹配置正确
     import webbrowser
@@ -2471,7 +7688,13 @@ if __name__ == '__main__':
     Timer(1.5, open_browser).start()
     
     print("正在启动笔墨星河应用...")
-    # 在启动应用前加载数据
-    load_data()
-    # 启动Flask应用，禁用Flask的自动重载器，这可能导致浏览器被打开两次
-    app.run(debug=debug_mode, port=port, use_reloader=False)
\ No newline at end of file
+    # 数据已在导入模块时加载，这里不再重复加载
+    # 在后台预先连上已配置的模型服务，减少第一次生成的等待
+    warm_upstreams()
+    if ASYNC_GATEWAY:
+        # 生成请求在事件循环上异步处理，其余请求由 Flask 在线程池中处理
+        print("使用异步生成网关（uvicorn）")
+        uvicorn.run(asgi_app, host='127.0.0.1', port=port, log_level='warning')
+    else:
+        # 启动Flask应用，禁用Flask的自动重载器，这可能导致浏览器被打开两次
+        app.run(debug=debug_mode, port=port, use_reloader=False)
\ No newline at end of file
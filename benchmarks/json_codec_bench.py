@@ -0,0 +1,128 @@
+"""JSON 编解码基准：比较标准库 json 与 orjson / msgspec 在缩进与紧凑两种格式下读写合成数据库的用时。
+
+用法：python benchmarks/json_codec_bench.py [--size-mb 200] [--dir 临时目录] [--repeat 1]
+
+合成数据模仿 data/ 下的快照：词条库（glossary.json 的条目结构）与小说元数据（novel.json，含章节列表），
+大小按标准库 indent=2 格式（app.py 原有的写法）计算。保存 = 序列化 + 写入 + fsync，读取 = 读文件 + 解析。
+脚本不导入 app.py（导入会加载并迁移 data/ 中的真实数据），各编解码的参数与 app.py 的 json_dumps 一致。
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+CJK = "天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜金生丽水玉出昆冈，。！？"
+
+def random_text(rng, length):
+    return "".join(rng.choice(CJK) for _ in range(length))
+
+def build_library(size_mb, seed=0):
+    """生成约 size_mb（按 indent=2 计）的合成数据：{"glossary": {...}, "novels": {...}}"""
+    rng = random.Random(seed)
+    # 先生成一小批样本，之后复用它们的文本，避免生成数据本身耗时过长
+    samples = [random_text(rng, rng.randrange(200, 1200)) for _ in range(256)]
+    glossary, novels = {}, {}
+    target = size_mb * 1024 * 1024
+    size = 0
+    i = 0
+    while size < target:
+        if i % 50 == 0:
+            novel_id = f"novel-{i}"
+            novel = {
+                "id": novel_id, "title": samples[i % 256][:12], "type": "玄幻", "revision": i,
+                "created_at": "2025-01-01 00:00:00", "outline": samples[(i + 1) % 256],
+                "chapters": [{"id": f"{novel_id}-ch{j}", "title": samples[j % 256][:10], "order": j * 1024,
+                              "revision": j, "created_at": "2025-01-01 00:00:00"} for j in range(200)],
+            }
+            novels[novel_id] = novel
+            size += len(json.dumps(novel, ensure_ascii=False, indent=2).encode('utf-8'))
+        entry_id = f"entry-{i}"
+        entry = {
+            "id": entry_id, "term": samples[i % 256][:6], "category": rng.choice(["人物", "地点", "功法", "物品"]),
+            "description": samples[(i * 7) % 256], "aliases": [samples[(i * 3) % 256][:4] for _ in range(3)],
+            "novel_ids": [f"novel-{i - i % 50}"], "weight": rng.random(), "created_at": "2025-01-01 00:00:00",
+        }
+        glossary[entry_id] = entry
+        size += len(json.dumps(entry, ensure_ascii=False, indent=2).encode('utf-8'))
+        i += 1
+    return {"glossary": glossary, "novels": novels}
+
+def codecs():
+    """(名称, dumps -> bytes, loads)"""
+    result = [
+        ("json indent=2", lambda obj: json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8'), json.loads),
+        ("json compact", lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+         json.loads),
+    ]
+    if orjson is not None:
+        result += [
+            ("orjson indent=2", lambda obj: orjson.dumps(obj, option=orjson.OPT_INDENT_2), orjson.loads),
+            ("orjson compact", orjson.dumps, orjson.loads),
+        ]
+    if msgspec is not None:
+        encoder, decoder = msgspec.json.Encoder(), msgspec.json.Decoder()
+        result += [
+            ("msgspec indent=2", lambda obj: msgspec.json.format(encoder.encode(obj), indent=2), decoder.decode),
+            ("msgspec compact", encoder.encode, decoder.decode),
+        ]
+    return result
+
+def save(file_path, data):
+    with open(file_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def load(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=200, help="合成数据大小（MB，按 indent=2 计），默认 200")
+    parser.add_argument('--dir', default=None, help="写入测试文件的目录，默认使用系统临时目录")
+    parser.add_argument('--repeat', type=int, default=1, help="每种编解码重复次数，取最快的一次")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    library = build_library(args.size_mb)
+    print(f"合成数据: {len(library['glossary'])} 个词条, {len(library['novels'])} 部小说, "
+          f"生成用时 {time.perf_counter() - started:.1f} 秒")
+    if orjson is None:
+        print("未安装 orjson，只测试标准库 json（pip install orjson）")
+
+    work_dir = tempfile.mkdtemp(prefix="bmxh-json-bench-", dir=args.dir)
+    try:
+        print(f"{'编解码':<18}{'文件大小(MB)':>14}{'保存(秒)':>12}{'读取(秒)':>12}")
+        for name, dumps, loads in codecs():
+            file_path = os.path.join(work_dir, name.replace(' ', '_') + '.json')
+            save_time = load_time = float('inf')
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                save(file_path, dumps(library))
+                save_time = min(save_time, time.perf_counter() - t)
+                t = time.perf_counter()
+                loaded = loads(load(file_path))
+                load_time = min(load_time, time.perf_counter() - t)
+            assert loaded == library, f"{name} 读回的数据不一致"
+            del loaded
+            size = os.path.getsize(file_path) / 1024 / 1024
+            print(f"{name:<18}{size:>14.1f}{save_time:>12.2f}{load_time:>12.2f}")
+            os.remove(file_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
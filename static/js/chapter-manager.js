@@ -3,10 +3,15 @@
  * Provides functionality for managing novel chapters in the right sidebar
  */
 
+import { patchContent } from './text-patch.js';
+
 // Store current novel ID and chapters
 let currentNovelId = localStorage.getItem('currentNovelId') || null;
 let currentChapterId = null;
 let chapters = [];
+// Last saved body and revision of the current chapter, used as the patch base
+let chapterSavedContent = null;
+let chapterRevision = null;
 let novelContent = null;
 let saveNovelBtn = null;
 let isDragging = false;
@@ -117,6 +122,7 @@ export function initializeChapterManager(sidebar) {
             localStorage.setItem('currentNovelId', currentNovelId);
             console.log('Chapter manager updated novel ID:', currentNovelId);
             currentChapterId = null;
+            window.currentChapterId = null;
             loadChapters(currentNovelId);
             
             // Load notes for the selected novel
@@ -564,6 +570,9 @@ async function selectChapter(chapterId) {
         
         const chapter = await response.json();
         currentChapterId = chapterId;
+        window.currentChapterId = chapterId; // Lets script.js send the chapter with generate requests
+        chapterSavedContent = chapter.content || '';
+        chapterRevision = chapter.revision || 0;
         
         // Update the novel content textarea
         if (novelContent) {
@@ -621,18 +630,33 @@ async function saveCurrentContent() {
  */
 async function updateChapterContent(novelId, chapterId, content) {
     try {
-        const response = await fetch(`/api/novels/${novelId}/chapters/${chapterId}`, {
-            method: 'PUT',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                content: content
-            })
-        });
+        if (chapterId === currentChapterId && chapterSavedContent !== null) {
+            // Only send the changed range against the last saved revision
+            const result = await patchContent(`/api/novels/${novelId}/chapters/${chapterId}/content`,
+                chapterRevision, chapterSavedContent, content);
+            chapterRevision = result.revision;
+        } else {
+            const response = await fetch(`/api/novels/${novelId}/chapters/${chapterId}`, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    content: content
+                })
+            });
+            
+            if (!response.ok) {
+                throw new Error(`Failed to update chapter: ${response.statusText}`);
+            }
+            
+            if (chapterId === currentChapterId) {
+                chapterRevision = (await response.json()).revision || 0;
+            }
+        }
         
-        if (!response.ok) {
-            throw new Error(`Failed to update chapter: ${response.statusText}`);
+        if (chapterId === currentChapterId) {
+            chapterSavedContent = content;
         }
         
         if (novelContent) {
@@ -643,6 +667,9 @@ async function updateChapterContent(novelId, chapterId, content) {
         return true;
     } catch (error) {
         console.error('Error updating chapter content:', error);
+        if (error.status === 409) {
+            alert('章节内容已在其他地方被修改，请重新打开该章节后再保存');
+        }
         return false;
     }
 }
@@ -714,7 +741,9 @@ async function updateChapterTitle(chapterId, newTitle) {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                title: newTitle
+                title: newTitle,
+                // Only the open chapter has a known revision to check against
+                base_revision: chapterId === currentChapterId ? chapterRevision : undefined
             })
         });
         
@@ -722,6 +751,12 @@ async function updateChapterTitle(chapterId, newTitle) {
             throw new Error(`Failed to update chapter title: ${response.statusText}`);
         }
         
+        // Renaming bumps the chapter revision, keep the patch base in sync
+        const updated = await response.json();
+        if (chapterId === currentChapterId) {
+            chapterRevision = updated.revision || 0;
+        }
+        
         // Update local chapter data
         const chapter = chapters.find(ch => ch.id === chapterId);
         if (chapter) {
@@ -808,6 +843,7 @@ async function deleteChapter(chapterId) {
         // Clear content if the deleted chapter was selected
         if (chapterId === currentChapterId) {
             currentChapterId = null;
+            window.currentChapterId = null;
             if (novelContent) {
                 novelContent.value = '';
             }
@@ -927,8 +963,8 @@ function handleDrop(e) {
         // Re-render the list
         renderChapterList();
         
-        // Send the new order to the server
-        saveChaptersOrder();
+        // Send the move to the server
+        saveChapterMove(moved.id, dropPos);
     }
 }
 
@@ -946,32 +982,36 @@ function handleDragEnd() {
 }
 
 /**
- * Save the current chapter order to the server
+ * Move one chapter on the server; only the moved chapter's order key changes
+ * @param {string} chapterId - The ID of the moved chapter
+ * @param {number} index - The new position of the chapter
  */
-async function saveChaptersOrder() {
-    if (!currentNovelId || !chapters.length) return;
-    
-    // Prepare the data for reordering
-    const orderData = chapters.map((chapter, index) => ({
-        id: chapter.id,
-        order: index
-    }));
+async function saveChapterMove(chapterId, index) {
+    if (!currentNovelId) return;
     
     try {
-        const response = await fetch(`/api/novels/${currentNovelId}/chapters/reorder`, {
+        const response = await fetch(`/api/novels/${currentNovelId}/chapters/${chapterId}/move`, {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify(orderData)
+            body: JSON.stringify({ index })
         });
         
         if (!response.ok) {
-            throw new Error(`Failed to reorder chapters: ${response.statusText}`);
+            throw new Error(`Failed to move chapter: ${response.statusText}`);
         }
         
+        // Keep local order keys in sync with the server
+        const result = await response.json();
+        chapters.forEach(chapter => {
+            if (chapter.id in result.orders) {
+                chapter.order = result.orders[chapter.id];
+            }
+        });
+        
     } catch (error) {
-        console.error('Error saving chapter order:', error);
+        console.error('Error moving chapter:', error);
         alert('保存章节顺序失败');
         
         // Reload the chapters to restore the last known valid state
@@ -0,0 +1,32 @@
+/**
+ * Library Pages Module
+ * Reads the paginated library list endpoints (characters, glossary, styles)
+ */
+
+/**
+ * Fetch every page of a library list endpoint
+ * The server returns one page per request and the cursor of the next one in X-Next-Cursor
+ * @param {string} url - The list endpoint, optionally with filters (category, fields, novel_id)
+ * @returns {Promise<Response>} The first page's response, with the body replaced by all entries
+ */
+export async function fetchAllPages(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        return response;
+    }
+    const entries = await response.json();
+    let cursor = response.headers.get('X-Next-Cursor');
+    while (cursor) {
+        const separator = url.includes('?') ? '&' : '?';
+        const page = await fetch(`${url}${separator}cursor=${encodeURIComponent(cursor)}`);
+        if (!page.ok) {
+            return page;
+        }
+        entries.push(...await page.json());
+        cursor = page.headers.get('X-Next-Cursor');
+    }
+    return new Response(JSON.stringify(entries), {
+        status: response.status,
+        headers: { 'Content-Type': 'application/json' }
+    });
+}
@@ -1,5 +1,7 @@
 // Import API Key Management
 import { setApiKey, getApiKey } from './api-keys.js';
+import { patchContent } from './text-patch.js';
+import { fetchAllPages } from './library-pages.js';
 
 document.addEventListener('DOMContentLoaded', () => {
     // Initialize API key input
@@ -291,6 +293,8 @@ document.addEventListener('DOMContentLoaded', () => {
     // Global variables
     let currentNovelId = localStorage.getItem('currentNovelId') || null; // Try to get from localStorage first
     let currentChapterId = null; // Track current chapter ID
+    let novelSavedContent = null; // Last saved novel content, the base for content patches
+    let novelRevision = 0; // Revision of novelSavedContent on the server
     let characterTags = []; // Replace with character data structure
     let glossaryTags = []; // Replace with glossary data structure
     let styleTags = []; // Replace with style data structure
@@ -401,6 +405,14 @@ document.addEventListener('DOMContentLoaded', () => {
         if (isError) console.error(message);
     }
 
+    // 生成请求在服务端排队或等待重试时的 {"queue": ...} 事件
+    function queueStatus(queue) {
+        if (queue.retry) {
+            return `${queue.provider} 返回 ${queue.status}，${queue.delay} 秒后第 ${queue.retry} 次重试...`;
+        }
+        return `正在排队等待 ${queue.provider}（第 ${queue.position} 位）...`;
+    }
+
     // 保存用户选择的模型ID到localStorage
     function saveSelectedModel(modelId) {
         if (modelId) {
@@ -793,6 +805,8 @@ document.addEventListener('DOMContentLoaded', () => {
             // Set last saved content for change detection
             novelContent.dataset.lastSaved = novel.content || '';
             novelContent.dataset.hasChanges = 'false';
+            novelSavedContent = novel.content || '';
+            novelRevision = novel.revision || 0;
             
             // Dispatch novel selected event for chapter manager
             document.dispatchEvent(new CustomEvent('novelSelected', {
@@ -981,10 +995,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 url = `/api/novels/${currentNovelId}/chapters/${currentChapterId}`;
                 data = { content };
             } else {
-                // Saving to main novel content
+                // Saving to main novel content: the body goes as a patch, metadata via PUT
+                if (novelSavedContent !== null && content !== novelSavedContent) {
+                    const result = await patchContent(`/api/novels/${currentNovelId}/content`,
+                        novelRevision, novelSavedContent, content);
+                    novelSavedContent = content;
+                    novelRevision = result.revision;
+                }
                 url = `/api/novels/${currentNovelId}`;
                 data = {
-                    content,
                     characters,
                     knowledge,
                     style_prompt: stylePrompt,
@@ -992,6 +1011,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     glossary_tags: novelGlossaryTags, // 使用正确的全局变量
                     style_tags: novelStyleTags // 使用正确的全局变量
                 };
+                if (novelSavedContent === null) {
+                    data.content = content;
+                } else {
+                    // Fails with 409 if the novel was changed elsewhere since it was loaded
+                    data.base_revision = novelRevision;
+                }
             }
             
             const response = await fetch(url, {
@@ -1005,6 +1030,14 @@ document.addEventListener('DOMContentLoaded', () => {
             if (response.ok) {
                 updateStatus('保存成功');
                 
+                if (!currentChapterId) {
+                    // Every save bumps the novel revision, keep the patch base in sync
+                    novelRevision = (await response.json()).revision || 0;
+                    if (data.content !== undefined) {
+                        novelSavedContent = content;
+                    }
+                }
+                
                 // Update the last saved content
                 novelContent.dataset.lastSaved = content;
                 novelContent.dataset.hasChanges = 'false';
@@ -1105,6 +1138,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         let fullPrompt = "";
+        let contextRequest;
         if (isContinuation) {
             // Basic continuation: use existing content as context
             if (!currentContent.trim()) {
@@ -1118,26 +1152,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 alert("请输入提示。");
                 return;
             }
-            // Construct prompt with metadata and user prompt
-            fullPrompt = ``;
-            if (stylePromptInput.value.trim()) {
-                fullPrompt += `风格提示:\n${stylePromptInput.value.trim()}\n\n`;
-            }
-            if (charactersInput.value.trim()) {
-                fullPrompt += `角色设定:\n${charactersInput.value.trim()}\n\n`;
-            }
-            if (knowledgeInput.value.trim()) {
-                fullPrompt += `关联知识:\n${knowledgeInput.value.trim()}\n\n`;
-            }
-            // Include last part of content, unless it's empty
-            if (currentContent.trim()) {
-                fullPrompt += `当前内容 (最后 500 字符):
-${currentContent.slice(-500)}
-\n`;
-            }
-            fullPrompt += `写作提示:
-${currentPrompt}`;
-            // Note: Could also include currentContent as context here if desired.
+            // The server adds the style/character/glossary/previous-chapter context under a token budget,
+            // ranked by what is mentioned near the cursor; only the text before the cursor is sent along
+            // since the editor may hold unsaved changes
+            const cursor = novelContent.selectionStart || currentContent.length;
+            fullPrompt = currentPrompt;
+            contextRequest = {
+                novel_id: currentNovelId,
+                chapter_id: window.currentChapterId || undefined,
+                recent_text: currentContent.slice(Math.max(0, cursor - 4000), cursor)
+            };
 
             updateStatus(`正在根据提示使用 ${selectedModel} 生成文本...`);
         }
@@ -1172,6 +1196,7 @@ ${currentPrompt}`;
                 body: JSON.stringify({
                     model: selectedModel,
                     prompt: fullPrompt,
+                    context: contextRequest,
                     temperature: currentTemperature,
                     // context_length: currentContextLength // Removed context_length
                     // stream: false // Stream handling not implemented yet
@@ -1199,6 +1224,18 @@ ${currentPrompt}`;
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
             let buffer = '';
+            let usage = null; // Token usage reported at the end of the stream
+            // Insert text at the current insert position; called once per read so the editor reflows once
+            const insertGenerated = (text) => {
+                const before = novelContent.value.slice(0, insertPosition);
+                const after = novelContent.value.slice(insertPosition);
+                novelContent.value = before + text + after;
+                insertPosition += text.length; // Update insert position
+                // Optionally scroll to keep the cursor in view
+                novelContent.selectionStart = novelContent.selectionEnd = insertPosition;
+                novelContent.scrollTop = novelContent.scrollHeight; // Scroll to bottom
+                updateWordCount(); // Update count as text streams in
+            };
 
             while (true) {
                 const { done, value } = await reader.read();
@@ -1210,6 +1247,7 @@ ${currentPrompt}`;
                 buffer += decoder.decode(value, { stream: true });
                 const lines = buffer.split('\n');
                 buffer = lines.pop(); // Keep the last partial line in buffer
+                let generated = ''; // Tokens of this read, inserted together
 
                 for (const line of lines) {
                     if (line.startsWith('data: ')) {
@@ -1218,24 +1256,19 @@ ${currentPrompt}`;
                             try {
                                 const data = JSON.parse(jsonData);
                                 if (data.token) {
-                                    // Insert the token at the current insert position
-                                    const before = novelContent.value.slice(0, insertPosition);
-                                    const after = novelContent.value.slice(insertPosition);
-                                    novelContent.value = before + data.token + after;
-                                    insertPosition += data.token.length; // Update insert position
-                                    // Optionally scroll to keep the cursor in view
-                                    novelContent.selectionStart = novelContent.selectionEnd = insertPosition;
-                                    novelContent.scrollTop = novelContent.scrollHeight; // Scroll to bottom
-                                    updateWordCount(); // Update count as text streams in
+                                    generated += data.token;
+                                } else if (data.queue) {
+                                    updateStatus(queueStatus(data.queue));
+                                } else if (data.context) {
+                                    // Token accounting of the server-assembled prompt, sent before the first token
+                                    updateStatus(`正在生成（上下文 ${data.context.used}/${data.context.budget} tokens）...`);
+                                } else if (data.usage) {
+                                    usage = data.usage;
                                 } else if (data.error) {
                                     console.error("Stream error:", data.error);
                                     updateStatus(`生成出错: ${data.error}`, true);
                                     // Optionally display the error inline
-                                    const errorToken = `\n[错误: ${data.error}]\n`;
-                                    const before = novelContent.value.slice(0, insertPosition);
-                                    const after = novelContent.value.slice(insertPosition);
-                                    novelContent.value = before + errorToken + after;
-                                    insertPosition += errorToken.length;
+                                    generated += `\n[错误: ${data.error}]\n`;
                                     reader.cancel(); // Stop reading the stream on error
                                     break;
                                 }
@@ -1245,8 +1278,18 @@ ${currentPrompt}`;
                         }
                     }
                 }
+                if (generated) {
+                    insertGenerated(generated);
+                }
+            }
+            if (usage) {
+                const approx = usage.estimated ? '约 ' : '';
+                const truncated = usage.truncated ? '，提示词过长已截断' : '';
+                const route = usage.route ? `，由 ${usage.route.model} 生成` : '';
+                updateStatus(`生成完毕（输入 ${approx}${usage.prompt_tokens} / 输出 ${approx}${usage.completion_tokens} tokens${truncated}${route}）。`);
+            } else {
+                updateStatus('生成完毕。'); // Update status after stream ends successfully
             }
-            updateStatus('生成完毕。'); // Update status after stream ends successfully
             // --- Streaming Update END ---
 
             // --- Remove Old Non-Streaming Logic START ---
@@ -1307,7 +1350,7 @@ ${currentPrompt}`;
     async function fetchCharacters() {
         updateStatus('正在加载角色库...');
         try {
-            const response = await fetch('/api/characters');
+            const response = await fetchAllPages('/api/characters');
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
@@ -2079,6 +2122,8 @@ ${currentPrompt}`;
                                     // Scroll toolbox output
                                     const preElement = toolboxOutputText.parentElement;
                                     if (preElement) preElement.scrollTop = preElement.scrollHeight;
+                                } else if (data.queue) {
+                                    updateStatus(queueStatus(data.queue));
                                 } else if (data.error) {
                                     console.error("Stream error:", data.error);
                                     toolboxOutputText.textContent += `\n[错误: ${data.error}]\n`;
@@ -2283,7 +2328,7 @@ ${currentPrompt}`;
     async function fetchGlossaryEntries() {
         updateStatus('正在加载词条库...');
         try {
-            const response = await fetch('/api/glossary');
+            const response = await fetchAllPages('/api/glossary');
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
@@ -2840,7 +2885,7 @@ ${currentPrompt}`;
     async function fetchStyleEntries() {
         updateStatus('正在加载风格库...');
         try {
-            const response = await fetch('/api/styles');
+            const response = await fetchAllPages('/api/styles');
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
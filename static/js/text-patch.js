@@ -0,0 +1,69 @@
+/**
+ * Text Patch Module
+ * Sends only the changed part of a chapter/novel body to the content PATCH endpoints
+ */
+
+/**
+ * Build insert/delete ops that turn oldText into newText
+ * Positions are counted in Unicode code points to match the server
+ * @param {string} oldText - The last saved text
+ * @param {string} newText - The current text
+ * @returns {Array} Ops for the PATCH request (empty when nothing changed)
+ */
+export function diffTextOps(oldText, newText) {
+    const oldChars = Array.from(oldText);
+    const newChars = Array.from(newText);
+
+    // Skip the common prefix and suffix, the rest is one replace op
+    let start = 0;
+    const maxStart = Math.min(oldChars.length, newChars.length);
+    while (start < maxStart && oldChars[start] === newChars[start]) {
+        start++;
+    }
+    let oldEnd = oldChars.length;
+    let newEnd = newChars.length;
+    while (oldEnd > start && newEnd > start && oldChars[oldEnd - 1] === newChars[newEnd - 1]) {
+        oldEnd--;
+        newEnd--;
+    }
+
+    if (oldEnd === start && newEnd === start) {
+        return [];
+    }
+    return [{
+        pos: start,
+        delete: oldEnd - start,
+        insert: newChars.slice(start, newEnd).join('')
+    }];
+}
+
+/**
+ * PATCH a body against its base revision
+ * @param {string} url - The content PATCH endpoint
+ * @param {number} baseRevision - The revision oldText was loaded/saved at
+ * @param {string} oldText - The last saved text
+ * @param {string} newText - The current text
+ * @returns {Promise<Object>} The server response ({ id, revision, length })
+ */
+export async function patchContent(url, baseRevision, oldText, newText) {
+    const response = await fetch(url, {
+        method: 'PATCH',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            base_revision: baseRevision,
+            ops: diffTextOps(oldText, newText)
+        })
+    });
+
+    const result = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        // 409 means the body was changed elsewhere since baseRevision
+        const error = new Error(result.error || response.statusText);
+        error.status = response.status;
+        error.revision = result.revision;
+        throw error;
+    }
+    return result;
+}